@@ -0,0 +1,569 @@
+#!/usr/bin/env python
+## **************************************************************************
+##   artifacts.py - content addressed store for build.py outputs
+##
+##   COPYRIGHT 2010 Richard Evans, Ed Spittles
+##
+##   artifacts.py is free software: you can redistribute it and/or modify
+##   it under the terms of the GNU Lesser General Public License as published by
+##   the Free Software Foundation, either version 3 of the License, or
+##   (at your option) any later version.
+##
+##   tube is distributed in the hope that it will be useful,
+##   but WITHOUT ANY WARRANTY; without even the implied warranty of
+##   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##   GNU Lesser General Public License for more details.
+##
+##   You should have received a copy of the GNU Lesser General Public License
+##   along with tube.  If not, see <http://www.gnu.org/licenses/>.
+##
+## **************************************************************************
+"""
+artifacts.py
+
+     Keep the programming files and reports of each build in a content
+     addressed store, so identical files are only stored once, apply a
+     retention policy to it, remove the working directories of old builds and
+     compare the fuse maps or bitstreams of two builds.
+
+"""
+
+from __future__ import print_function
+
+import getopt, glob, hashlib, json, os, os.path, re, shutil, struct, sys, time
+
+# Files kept from a build directory, where they exist, as <module><suffix>
+OUTPUTS = (".jed", ".bit", ".mcs", ".syr", ".rpt", ".tim", ".twr", "_map.mrp", ".par",
+           ".pad", "_gatesim.log")
+
+# Programming files, whose images are compared by diff
+IMAGES = (".jed", ".bit", ".mcs")
+
+# The directory names build.py makes up when -d isn't given. Only these are
+# removed when a build is evicted, never a directory the user named.
+re_timestamped = re.compile(r"-\d\d\.\d\d\.\d{4}_\d\d:\d\d:\d\d$")
+
+# Objects written this recently are never collected, as a build storing its
+# files may not have written its record yet
+COLLECT_GRACE = 600
+
+
+def file_digest( filename ):
+    h = hashlib.sha1()
+    f = open(filename, 'rb')
+    for block in iter(lambda: f.read(1 << 20), b""):
+        h.update(block)
+    f.close()
+    return h.hexdigest()
+
+def read_jedec( filename ):
+    """
+    Return the fuse map of a JEDEC file as a bytearray of b'0'/b'1', one per
+    fuse. Only the QF, F and L fields are used, so notes such as the date the
+    file was written don't make two otherwise identical maps differ.
+    """
+    f = open(filename, 'rb')
+    data = f.read()
+    f.close()
+    start = data.find(b"\x02")
+    end = data.find(b"\x03", start + 1)
+    if start >= 0 and end > start:
+        data = data[start + 1:end]
+    count = 0
+    default = b"0"
+    links = []
+    for field in data.split(b"*"):
+        field = field.strip()
+        if field.startswith(b"QF"):
+            count = int(field[2:])
+        elif field[:1] == b"F" and field[1:2] in (b"0", b"1"):
+            default = field[1:2]
+        elif field.startswith(b"L"):
+            parts = field[1:].split(None, 1)
+            if len(parts) == 2:
+                links.append( (int(parts[0]), re.sub(br"\s", b"", parts[1])) )
+    fuses = bytearray(default * count)
+    for (address, bits) in links:
+        fuses[address:address + len(bits)] = bits
+    return fuses
+
+def read_bitfile( filename ):
+    """
+    Return the configuration data of a Xilinx .bit file as a bytearray, without
+    the header, which holds the date and time it was written.
+    """
+    f = open(filename, 'rb')
+    data = f.read()
+    f.close()
+    try:
+        pos = 2 + struct.unpack(">H", data[0:2])[0] + 2
+        while pos < len(data):
+            key = data[pos:pos + 1]
+            if key == b"e":
+                length = struct.unpack(">I", data[pos + 1:pos + 5])[0]
+                return bytearray(data[pos + 5:pos + 5 + length])
+            length = struct.unpack(">H", data[pos + 1:pos + 3])[0]
+            pos += 3 + length
+    except struct.error:
+        pass
+    return bytearray(data)
+
+def read_mcs( filename ):
+    """
+    Return the contents of an Intel hex PROM file as a bytearray, with any gaps
+    filled with 0xff.
+    """
+    image = bytearray()
+    base = 0
+    f = open(filename, 'r')
+    for line in f:
+        line = line.strip()
+        if not line.startswith(":"):
+            continue
+        record = bytearray.fromhex(line[1:])
+        (length, address, kind) = (record[0], (record[1] << 8) | record[2], record[3])
+        payload = record[4:4 + length]
+        if kind == 0:
+            address += base
+            if len(image) < address + length:
+                image.extend(b"\xff" * (address + length - len(image)))
+            image[address:address + length] = payload
+        elif kind == 2:
+            base = ((payload[0] << 8) | payload[1]) << 4
+        elif kind == 4:
+            base = ((payload[0] << 8) | payload[1]) << 16
+    f.close()
+    return image
+
+def read_image( filename, suffix=None ):
+    """
+    Return the image in a programming file, of the type given by suffix or
+    else by its own suffix.
+    """
+    if suffix is None:
+        suffix = os.path.splitext(filename)[1]
+    if suffix == ".jed":
+        return read_jedec(filename)
+    if suffix == ".bit":
+        return read_bitfile(filename)
+    if suffix == ".mcs":
+        return read_mcs(filename)
+    raise ValueError("%s isn't a programming file" % filename)
+
+def image_digest( filename ):
+    """
+    Return the SHA1 of the programmed image in a .jed, .bit or .mcs file, which
+    is the same for two files that program the device identically.
+    """
+    return hashlib.sha1(bytes(read_image(filename))).hexdigest()
+
+def diff_images( a, b, fuses=False, block=4096 ):
+    """
+    Compare two images from read_image and return (number of differing bits,
+    list of (first, last) offsets of the differing ranges). Fuse maps have one
+    byte per fuse, so offsets are fuse numbers; bitstream offsets are bytes.
+    Equal blocks are skipped without looking at their bytes.
+    """
+    length = max(len(a), len(b))
+    if len(a) < length:
+        a = a + bytearray(length - len(a))
+    if len(b) < length:
+        b = b + bytearray(length - len(b))
+    bits = 0
+    ranges = []
+    for start in range(0, length, block):
+        if a[start:start + block] == b[start:start + block]:
+            continue
+        for i in range(start, min(start + block, length)):
+            if a[i] == b[i]:
+                continue
+            bits += 1 if fuses else bin(a[i] ^ b[i]).count("1")
+            if ranges and ranges[-1][1] == i - 1:
+                ranges[-1] = (ranges[-1][0], i)
+            else:
+                ranges.append( (i, i) )
+    return (bits, ranges)
+
+
+class ArtifactStore(object):
+    """
+    The store keeps each distinct file once in objects/, named by its SHA1, and
+    a JSON record for each build in builds/ listing the files it produced.
+    """
+    def __init__( self, root ):
+        self.root = os.path.abspath(root)
+        self.objects = os.path.join(self.root, "objects")
+        self.records = os.path.join(self.root, "builds")
+        for d in (self.objects, self.records):
+            if not os.path.isdir(d):
+                os.makedirs(d)
+
+    def object_path( self, digest ):
+        return os.path.join(self.objects, digest[:2], digest)
+
+    def put( self, filename ):
+        """
+        Add a file to the store, unless an identical one is already there, and
+        return its digest.
+        """
+        digest = file_digest(filename)
+        path = self.object_path(digest)
+        if os.path.isfile(path):
+            os.utime(path, None)
+            return digest
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                pass
+        temp = "%s.%d.tmp" % (path, os.getpid())
+        shutil.copyfile(filename, temp)
+        os.rename(temp, path)
+        return digest
+
+    def add_build( self, directory, module, info ):
+        """
+        Store the outputs of a build in directory and write its record, which is
+        info plus the build's id, module, directory, files and image digests.
+        Returns the record.
+        """
+        files = dict()
+        images = dict()
+        for suffix in OUTPUTS:
+            filename = os.path.join(directory, "%s%s" % (module, suffix))
+            if os.path.isfile(filename):
+                files[os.path.basename(filename)] = self.put(filename)
+                if suffix in IMAGES:
+                    images[os.path.basename(filename)] = image_digest(filename)
+        record = dict(info)
+        record.update({ "module": module, "directory": os.path.abspath(directory),
+                        "files": files, "images": images, "time": time.time() })
+        base = "%s-%s-%s" % (module, info.get("target", ""), time.strftime("%Y%m%d-%H%M%S"))
+        n = 0
+        while True:
+            record["id"] = base if n == 0 else "%s.%d" % (base, n)
+            try:
+                fd = os.open(os.path.join(self.records, "%s.json" % record["id"]),
+                             os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                break
+            except OSError:
+                n += 1
+        f = os.fdopen(fd, 'w')
+        json.dump(record, f, indent=2, sort_keys=True)
+        f.close()
+        return record
+
+    def builds( self, module="", target="" ):
+        """
+        Return the records of the stored builds of a module and target ("" matches
+        anything), oldest first.
+        """
+        records = []
+        for filename in glob.glob(os.path.join(self.records, "*.json")):
+            try:
+                f = open(filename, 'r')
+                record = json.load(f)
+                f.close()
+            except (IOError, ValueError):
+                continue
+            if module not in ("", record.get("module")) or target not in ("", record.get("target")):
+                continue
+            records.append(record)
+        records.sort(key=lambda r: (r.get("time", 0), r["id"]))
+        return records
+
+    def find( self, ref ):
+        """
+        Return the record for a build id, or a unique prefix of one, or None.
+        """
+        records = self.builds()
+        exact = [ r for r in records if r["id"] == ref ]
+        if exact:
+            return exact[0]
+        matches = [ r for r in records if r["id"].startswith(ref) ]
+        return matches[0] if len(matches) == 1 else None
+
+    def previous( self, record ):
+        """
+        Return the record of the build before this one of the same module and
+        target, or None.
+        """
+        earlier = [ r for r in self.builds(record["module"], record.get("target", ""))
+                    if r["id"] != record["id"] and r.get("time", 0) <= record.get("time", 0) ]
+        return earlier[-1] if earlier else None
+
+    def find_key( self, module, target, key ):
+        """
+        Return the newest record of a build of the module and target with the
+        given result key whose files are all still stored, or None.
+        """
+        for record in reversed(self.builds(module, target)):
+            if record.get("key") == key and record.get("ok") and record["images"] and \
+                    all( os.path.isfile(self.object_path(d)) for d in record["files"].values() ):
+                return record
+        return None
+
+    def restore( self, record, directory ):
+        """
+        Copy the files of a stored build into directory and return their paths.
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        paths = []
+        for (name, digest) in sorted(record["files"].items()):
+            paths.append(os.path.join(directory, name))
+            shutil.copyfile(self.object_path(digest), paths[-1])
+        return paths
+
+    def remove( self, record, remove_directory=True ):
+        """
+        Drop a build's record, and its working directory if build.py named it
+        and no other stored build used it. Its files go at the next collect().
+        """
+        os.unlink(os.path.join(self.records, "%s.json" % record["id"]))
+        directory = record.get("directory", "")
+        if remove_directory and re_timestamped.search(directory) and os.path.isdir(directory) and \
+                not any( r["directory"] == directory for r in self.builds() ):
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def evict( self, keep, max_age=None ):
+        """
+        Apply the retention policy: keep the newest keep builds of each module and
+        target, less any older than max_age days, but always the newest one.
+        Returns the evicted records.
+        """
+        groups = dict()
+        for record in self.builds():
+            groups.setdefault( (record["module"], record.get("target", "")), [] ).append(record)
+        evicted = []
+        now = time.time()
+        for records in groups.values():
+            records.reverse()
+            for (n, record) in enumerate(records):
+                if n == 0:
+                    continue
+                if n >= keep or (max_age is not None and now - record.get("time", now) > max_age * 86400):
+                    self.remove(record)
+                    evicted.append(record)
+        return evicted
+
+    def prune_directories( self, keep ):
+        """
+        Remove the working directories build.py named for all but the newest keep
+        stored builds of each module and target; their outputs are in the
+        store. Returns the directories removed.
+        """
+        groups = dict()
+        for record in self.builds():
+            groups.setdefault( (record["module"], record.get("target", "")), [] ).append(record)
+        kept = set()
+        for records in groups.values():
+            kept.update( r["directory"] for r in records[len(records) - keep:] if keep > 0 )
+        removed = []
+        for records in groups.values():
+            for record in records:
+                directory = record.get("directory", "")
+                if directory in kept or directory in removed or not re_timestamped.search(directory):
+                    continue
+                if os.path.isdir(directory):
+                    shutil.rmtree(directory, ignore_errors=True)
+                    removed.append(directory)
+        return removed
+
+    def collect( self ):
+        """
+        Delete stored files no build record refers to. Returns (number of files,
+        bytes freed).
+        """
+        referenced = set()
+        for record in self.builds():
+            referenced.update(record.get("files", {}).values())
+        count = 0
+        freed = 0
+        now = time.time()
+        for path in glob.glob(os.path.join(self.objects, "*", "*")):
+            name = os.path.basename(path)
+            if name in referenced or now - os.path.getmtime(path) < COLLECT_GRACE:
+                continue
+            freed += os.path.getsize(path)
+            count += 1
+            os.unlink(path)
+        return (count, freed)
+
+    def size( self ):
+        return sum( os.path.getsize(p) for p in glob.glob(os.path.join(self.objects, "*", "*")) )
+
+
+def resolve( store, ref ):
+    """
+    Return a dictionary of programming file suffix to filename for a build id
+    in the store, a build directory or a single file, and a label for it.
+    """
+    if os.path.isfile(ref):
+        return ({ os.path.splitext(ref)[1]: ref }, ref)
+    if os.path.isdir(ref):
+        files = dict()
+        for suffix in IMAGES:
+            found = sorted(glob.glob(os.path.join(ref, "*%s" % suffix)))
+            if found:
+                files[suffix] = found[0]
+        return (files, ref)
+    record = store.find(ref) if store is not None else None
+    if record is None:
+        raise ValueError("%s is neither a file, a directory nor a stored build" % ref)
+    files = dict()
+    for (name, digest) in record["files"].items():
+        for suffix in IMAGES:
+            if name.endswith(suffix):
+                files[suffix] = store.object_path(digest)
+    return (files, record["id"])
+
+def format_ranges( ranges, limit=8 ):
+    text = ", ".join( "%d" % a if a == b else "%d-%d" % (a, b) for (a, b) in ranges[:limit] )
+    if len(ranges) > limit:
+        text += ", ... (%d ranges)" % len(ranges)
+    return text
+
+def diff( store, ref_a, ref_b ):
+    """
+    Print how the programmed images of two builds differ. Returns True if they
+    are identical.
+    """
+    (files_a, label_a) = resolve(store, ref_a)
+    (files_b, label_b) = resolve(store, ref_b)
+    print ("--- %s" % label_a)
+    print ("+++ %s" % label_b)
+    same = True
+    for suffix in IMAGES:
+        if suffix not in files_a and suffix not in files_b:
+            continue
+        if suffix not in files_a or suffix not in files_b:
+            print ("%-5s only in %s" % (suffix, label_a if suffix in files_a else label_b))
+            same = False
+            continue
+        a = read_image(files_a[suffix], suffix)
+        b = read_image(files_b[suffix], suffix)
+        unit = "fuses" if suffix == ".jed" else "bytes"
+        if a == b:
+            print ("%-5s identical, %d %s" % (suffix, len(a), unit))
+            continue
+        same = False
+        (bits, ranges) = diff_images(a, b, fuses=(suffix == ".jed"))
+        if len(a) != len(b):
+            print ("%-5s size differs: %d and %d %s" % (suffix, len(a), len(b), unit))
+        print ("%-5s %d of %d %s differ in %d ranges%s" % \
+            (suffix, bits, len(a) * (1 if suffix == ".jed" else 8),
+             "fuses" if suffix == ".jed" else "bits", len(ranges),
+             "" if suffix == ".jed" else " of bytes"))
+        print ("      at %s" % format_ranges(ranges))
+    return same
+
+def usage() :
+    print (__doc__ + """
+  USAGE:
+
+    artifacts.py -s|--store <dir> list [-m|--module <module>] [-t|--target <target>]
+    artifacts.py -s|--store <dir> diff <build> <build>
+    artifacts.py -s|--store <dir> get <build> [<directory>]
+    artifacts.py -s|--store <dir> gc [--keep <n>] [--max-age <days>] [--keep-dirs <n>]
+
+    A <build> is a stored build id or a unique prefix of one, a build directory
+    or a single .jed, .bit or .mcs file.
+
+  COMMANDS
+
+    list     List the stored builds, oldest first, with the digest of each one's
+             programmed image and whether it changed from the build before.
+    diff     Compare the fuse maps (.jed) or configuration data (.bit/.mcs) of two
+             builds, ignoring headers and notes, and list the differing fuses or
+             byte ranges.
+    get      Copy the stored files of a build into <directory>, by default '.'
+    gc       Evict all but the newest --keep builds (default 20) of each module
+             and target and any older than --max-age days, keeping the newest
+             one always; then delete the build.py named working directories of
+             all but the newest --keep-dirs builds of each (if given) and any
+             stored files no build refers to.
+
+  build.py --store <dir> adds each successful build to the store.
+    """)
+
+def main( argv ):
+    try:
+        opts, args = getopt.gnu_getopt( argv[1:], "s:m:t:h",
+                                    ["store=", "module=", "target=", "keep=", "max-age=",
+                                     "keep-dirs=", "help"])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(1)
+    root = ""
+    module = ""
+    target = ""
+    keep = 20
+    max_age = None
+    keep_dirs = None
+    for opt, arg in opts:
+        if opt in ( "-s", "--store" ):
+            root = arg
+        if opt in ( "-m", "--module" ):
+            module = arg
+        if opt in ( "-t", "--target" ):
+            target = arg.lower()
+        if opt == "--keep":
+            keep = int(arg)
+        if opt == "--max-age":
+            max_age = float(arg)
+        if opt == "--keep-dirs":
+            keep_dirs = int(arg)
+        if opt in ( "-h", "--help" ):
+            usage()
+            sys.exit(0)
+    if not args:
+        usage()
+        sys.exit(1)
+    command = args[0]
+    store = ArtifactStore(root) if root != "" else None
+    if store is None and command != "diff":
+        print ("ERROR: -s|--store is required")
+        sys.exit(1)
+
+    if command == "list":
+        print ("%-48s %-19s %-12s %-6s %-12s %s" % ("Build", "Date", "Commit", "Result", "Image", "Changed"))
+        print ("-" * 108)
+        last = dict()
+        for record in store.builds(module, target):
+            image = ",".join( record["images"][k][:12] for k in sorted(record["images"]) )
+            key = (record["module"], record.get("target", ""))
+            changed = "-" if key not in last else ("no" if last[key] == image else "yes")
+            last[key] = image
+            print ("%-48s %-19s %-12s %-6s %-12s %s" % \
+                (record["id"], record.get("date", ""), record.get("commit", "")[:12],
+                 "PASS" if record.get("ok") else "FAIL", image or "-", changed))
+        print ("-" * 108)
+        print ("%d builds, %.1f MB stored" % (len(store.builds(module, target)), store.size() / 1048576.0))
+    elif command == "diff" and len(args) == 3:
+        try:
+            sys.exit(0 if diff(store, args[1], args[2]) else 1)
+        except ValueError as e:
+            print ("ERROR: %s" % e)
+            sys.exit(2)
+    elif command == "get" and len(args) in (2, 3):
+        record = store.find(args[1])
+        if record is None:
+            print ("ERROR: no stored build %s" % args[1])
+            sys.exit(1)
+        for path in store.restore(record, args[2] if len(args) == 3 else "."):
+            print ("INFO: %s" % path)
+    elif command == "gc":
+        for record in store.evict(keep, max_age):
+            print ("INFO: evicted %s" % record["id"])
+        if keep_dirs is not None:
+            for directory in store.prune_directories(keep_dirs):
+                print ("INFO: removed %s" % directory)
+        (count, freed) = store.collect()
+        print ("INFO: deleted %d unreferenced files, %.1f MB" % (count, freed / 1048576.0))
+    else:
+        usage()
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main( sys.argv )
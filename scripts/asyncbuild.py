@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+## **************************************************************************
+##   asyncbuild.py - asyncio support for the build.py build API
+##
+##   COPYRIGHT 2010 Richard Evans, Ed Spittles
+##
+##   asyncbuild.py is free software: you can redistribute it and/or modify
+##   it under the terms of the GNU Lesser General Public License as published by
+##   the Free Software Foundation, either version 3 of the License, or
+##   (at your option) any later version.
+##
+##   tube is distributed in the hope that it will be useful,
+##   but WITHOUT ANY WARRANTY; without even the implied warranty of
+##   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##   GNU Lesser General Public License for more details.
+##
+##   You should have received a copy of the GNU Lesser General Public License
+##   along with tube.  If not, see <http://www.gnu.org/licenses/>.
+##
+## **************************************************************************
+"""
+asyncbuild.py
+
+     Run a build.py build in an asyncio event loop, with the tools launched
+     as asyncio subprocesses of the loop. Used by build.build_async(); kept
+     apart from build.py since it needs Python 3, which build.py doesn't.
+
+"""
+
+import asyncio, os, signal
+from asyncio.subprocess import PIPE, STDOUT
+
+
+async def run_command( flow, command_line, input, output, processes ):
+    """
+    Run a command line through the shell as an asyncio subprocess in a new
+    session, passing each line of its output to output() until that returns
+    False, when the command and the tools it runs are killed. The process is
+    kept in processes while it runs. Return its shell style exit status.
+    """
+    proc = await asyncio.create_subprocess_shell( command_line, stdout=PIPE, stderr=STDOUT,
+                                                  stdin=(PIPE if input != "" else None),
+                                                  start_new_session=True )
+    processes.add(proc)
+    try:
+        # Stopping the flow and starting commands both happen in the loop, so
+        # a command started after the flow was stopped is always killed here
+        if flow.stopping:
+            kill(proc, signal.SIGTERM)
+        if input != "":
+            proc.stdin.write(input.encode())
+            proc.stdin.close()
+        while True:
+            line = await proc.stdout.readline()
+            if not line:
+                break
+            if not output(line):
+                kill(proc, signal.SIGKILL)
+                break
+        rc = await proc.wait()
+    finally:
+        processes.discard(proc)
+    return rc if rc >= 0 else 128 - rc
+
+def kill( proc, sig ):
+    try:
+        os.killpg(proc.pid, sig)
+    except OSError:
+        pass
+
+async def build( config, start_build, run_build ):
+    """
+    Run the build described by a BuildConfig in the running event loop and
+    return its BuildResult. start_build and run_build are those of build.py,
+    which passes them in as it may be running as __main__ rather than as the
+    build module. The steps run in threads, in the loop's default executor,
+    and launch their tools through the loop. If this is cancelled the flow is
+    stopped, its tools are killed and it is waited for before re-raising.
+    """
+    loop = asyncio.get_event_loop()
+    flow = start_build(config)
+    processes = set()
+
+    def launch( command_line, input, output ):
+        # Called from the step threads, which wait for the command to finish
+        future = asyncio.run_coroutine_threadsafe(
+            run_command(flow, command_line, input, output, processes), loop)
+        return (future.result(), None)
+
+    flow.launch = launch
+    result = loop.run_in_executor(None, run_build, flow)
+    try:
+        return await asyncio.shield(result)
+    except asyncio.CancelledError:
+        flow.stopping = True
+        for proc in list(processes):
+            kill(proc, signal.SIGTERM)
+        await result
+        raise
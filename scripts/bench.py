@@ -0,0 +1,412 @@
+#!/usr/bin/env python
+## **************************************************************************
+##   bench.py - benchmark build and simulation throughput
+##
+##   COPYRIGHT 2010 Richard Evans, Ed Spittles
+##
+##   bench.py is free software: you can redistribute it and/or modify
+##   it under the terms of the GNU Lesser General Public License as published by
+##   the Free Software Foundation, either version 3 of the License, or
+##   (at your option) any later version.
+##
+##   tube is distributed in the hope that it will be useful,
+##   but WITHOUT ANY WARRANTY; without even the implied warranty of
+##   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##   GNU Lesser General Public License for more details.
+##
+##   You should have received a copy of the GNU Lesser General Public License
+##   along with tube.  If not, see <http://www.gnu.org/licenses/>.
+##
+## **************************************************************************
+"""
+bench.py
+
+     Run a fixed matrix of builds and testbench simulations several times,
+     report the median time of each and compare them against a stored
+     baseline. Tool runs can be recorded and replayed by stub tools, so the
+     orchestration can be benchmarked without the Xilinx tools or iverilog.
+
+"""
+
+from __future__ import print_function
+
+import base64, collections, errno, getopt, hashlib, itertools, json, os, os.path, shutil, stat, sys
+import tempfile, time
+from subprocess import Popen, PIPE, STDOUT
+
+import regress
+
+g_script_dir = os.path.dirname(os.path.abspath(__file__))
+g_rtl_dir = os.path.normpath(os.path.join(g_script_dir, "..", "rtl"))
+g_directory = "bench"
+g_repeats = 3
+g_threshold = 10.0
+
+# Every tool a build or simulation can run, for the record/replay shims
+TOOLS = [ "xst", "ngdbuild", "cpldfit", "taengine", "tsim", "hprep6", "map", "par",
+          "trce", "bitgen", "promgen", "netgen", "iverilog", "vvp" ]
+
+# A case is a named command run in a directory. fresh means the directory is
+# emptied before every run, otherwise only before the first, so later runs
+# measure a rebuild with nothing changed.
+Case = collections.namedtuple("Case", ["name", "kind", "args", "fresh"])
+
+def build_case( module, target, fresh=True ):
+    name = "build-%s-%s%s" % (module, target, "" if fresh else "-nochange")
+    return Case(name, "build", dict(module=module, target=target), fresh)
+
+def sim_cases( top, variant ):
+    name = "-".join([ top ] + [ d for d in variant.split(",") if d ])
+    return [ Case("sim-compile-%s" % name, "compile", dict(top=top, variant=variant), True),
+             Case("sim-run-%s" % name, "simulate", dict(top=top, variant=variant), False) ]
+
+CASES = [ build_case("level1b_mk2_m", "xc95108-15-pc84"),
+          build_case("level1b_mk2_m", "xc95144xl-10-tq100"),
+          build_case("cpld_jnr", "xc9536-10-pc44"),
+          build_case("level1b_mk2_m", "xc95108-15-pc84", fresh=False) ] + \
+        sim_cases("testbench", "STOP_ON_PHI2") + \
+        sim_cases("testbench", "STOP_ON_PHI2,MARK2B") + \
+        sim_cases("clkctrl_tb", "")
+
+
+def usage() :
+    print (__doc__ + """
+  USAGE:
+
+    bench.py [-c|--case <substring>] ... [-r|--repeats <n>] [-d|--dir <directory>] \\
+             [-b|--baseline <file>] [-T|--threshold <percent>] [--save-baseline <file>] \\
+             [--record <directory> | --stub <directory>] [-l|--list] [-h|--help]
+
+  OPTIONAL SWITCHES
+
+    -c --case <substring>        Only run cases whose names contain this. May be given
+                                 more than once.
+    -r --repeats <n>             Number of runs of each case. Default is %d.
+    -d --dir <directory>         Working directory for the runs. Default is ./%s
+    -b --baseline <file>         Compare the medians against a baseline written with
+                                 --save-baseline, and exit with status 1 if any case
+                                 is slower by more than the threshold.
+    -T --threshold <percent>     Allowed slow down against the baseline. Default is %.0f%%.
+       --save-baseline <file>    Write the medians to this file as a new baseline.
+       --record <directory>      Run the real tools but record the time, output, exit
+                                 status and files written by each run into this directory.
+       --stub <directory>        Replace the tools by stubs which replay a recording made
+                                 with --record, sleeping for the recorded time.
+    -l --list                    List the cases and exit.
+    -h --help                    Produce this help information.
+    """ % (g_repeats, g_directory, g_threshold))
+    return
+
+def median( values ):
+    values = sorted(values)
+    n = len(values)
+    if n == 0:
+        return None
+    if n % 2:
+        return values[n // 2]
+    return (values[n // 2 - 1] + values[n // 2]) / 2.0
+
+def snapshot( directory ):
+    """
+    Return a dictionary of file name, relative to the directory and with /
+    separators, to (size, mtime) for the files in a directory and all its
+    subdirectories. The logs of bench.py itself are left out.
+    """
+    files = dict()
+    for (root, dirs, names) in os.walk(directory):
+        for name in names:
+            path = os.path.join(root, name)
+            relative = os.path.relpath(path, directory).replace(os.sep, "/")
+            if relative.startswith("bench-"):
+                continue
+            st = os.stat(path)
+            files[relative] = (st.st_size, st.st_mtime)
+    return files
+
+def recording_file( tool, args, module ):
+    """
+    Return the recording of this run of a tool: the tool, a hash of its
+    arguments and the number of earlier runs with the same arguments in this
+    run of the case, so that a tool run more than once in a build, maybe at
+    the same time by steps running in parallel, has a recording for each run.
+    The runs are counted by claiming files in BENCH_CALLS.
+    """
+    text = "\0".join(args).replace(os.getcwd(), "{cwd}")
+    if module:
+        text = text.replace(module, "{module}")
+    digest = hashlib.sha1(text.encode("utf-8")).hexdigest()[:12]
+    for n in itertools.count():
+        try:
+            os.close(os.open(os.path.join(os.environ["BENCH_CALLS"], "%s-%s-%d" % (tool, digest, n)),
+                             os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            break
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    return os.path.join(os.environ["BENCH_RECORDING"], os.environ["BENCH_CASE"],
+                        "%s-%s-%d.json" % (tool, digest, n))
+
+def shim( tool, args ):
+    """
+    Stand in for a tool when benchmarking. BENCH_MODE is 'record', to run the
+    real tool found on BENCH_REAL_PATH and save what it did, or 'replay', to
+    repeat a saved run. Runs are saved per case in BENCH_RECORDING, one file
+    per run of a tool (see recording_file()).
+    """
+    mode = os.environ["BENCH_MODE"]
+    case = os.environ["BENCH_CASE"]
+    module = os.environ.get("BENCH_MODULE", "")
+    recording = recording_file(tool, args, module)
+
+    if mode == "replay":
+        if not os.path.isfile(recording):
+            print ("ERROR: no recording of %s for case %s" % (tool, case))
+            sys.exit(1)
+        f = open(recording, 'r')
+        run = json.load(f)
+        f.close()
+        time.sleep(run["seconds"])
+        sys.stdout.write(run["output"])
+        for (name, data) in run["files"].items():
+            name = name.replace("{module}", module)
+            if os.path.dirname(name) and not os.path.isdir(os.path.dirname(name)):
+                os.makedirs(os.path.dirname(name))
+            f = open(name, 'wb')
+            f.write(base64.b64decode(data.encode()))
+            f.close()
+        sys.exit(run["returncode"])
+
+    env = dict(os.environ)
+    env["PATH"] = os.environ["BENCH_REAL_PATH"]
+    before = snapshot(".")
+    start = time.time()
+    p = Popen([ tool ] + args, stdout=PIPE, stderr=STDOUT, env=env, universal_newlines=True)
+    (output, err) = p.communicate()
+    seconds = time.time() - start
+    sys.stdout.write(output)
+    files = dict()
+    for (name, info) in snapshot(".").items():
+        if before.get(name) != info:
+            f = open(name, 'rb')
+            files[name.replace(module, "{module}") if module else name] = \
+                base64.b64encode(f.read()).decode()
+            f.close()
+    if not os.path.isdir(os.path.dirname(recording)):
+        os.makedirs(os.path.dirname(recording))
+    f = open(recording, 'w')
+    json.dump({ "args": args, "seconds": round(seconds, 3), "returncode": p.returncode,
+                "output": output, "files": files }, f, indent=1, sort_keys=True)
+    f.close()
+    sys.exit(p.returncode)
+
+def make_shims( directory ):
+    """
+    Write a shim script for every tool into a directory to put first on the PATH.
+    """
+    for tool in TOOLS:
+        path = os.path.join(directory, tool)
+        f = open(path, 'w')
+        f.write('#!/bin/sh\nexec "%s" "%s" --shim %s "$@"\n' % \
+            (sys.executable, os.path.abspath(__file__), tool))
+        f.close()
+        os.chmod(path, stat.S_IRWXU | stat.S_IRGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH)
+
+def case_command( case, rundir ):
+    """
+    Return (command, working directory, module) for a run of a case.
+    """
+    args = case.args
+    if case.kind == "build":
+        command = [ sys.executable, os.path.join(g_script_dir, "build.py"),
+                    "-m", args["module"], "-t", args["target"], "-o", "speed",
+                    "-c", "%s.ucf" % args["module"], "-d", rundir, "-M", "" ]
+        return (command, g_rtl_dir, args["module"])
+    test = regress.make_test(args["top"], args["variant"])
+    if case.kind == "compile":
+        command = [ "iverilog", "-s", test.top, "-o", "sim.vvp" ]
+        for d in test.defines:
+            command.extend([ "-D", d ])
+        return (command + test.files, rundir, test.top)
+    return ([ "vvp", "-n", "sim.vvp" ], rundir, test.top)
+
+def run_case( case, env ):
+    """
+    Run a case g_repeats times and return the list of elapsed times, or None
+    if any run failed.
+    """
+    rundir = os.path.abspath(os.path.join(g_directory, case.name))
+    if case.kind == "simulate":
+        # Simulations run the executable left by the matching compile case
+        rundir = os.path.abspath(os.path.join(g_directory, case.name.replace("sim-run-", "sim-compile-")))
+    elif os.path.isdir(rundir):
+        shutil.rmtree(rundir)
+    if not os.path.isdir(rundir):
+        os.makedirs(rundir)
+    if case.kind == "simulate" and not os.path.isfile(os.path.join(rundir, "sim.vvp")):
+        if run_case(Case(case.name.replace("sim-run-", "sim-compile-"), "compile", case.args, True),
+                     env) is None:
+            return None
+    if not case.fresh and case.kind == "build":
+        # Prime the working directory so that the timed runs are all rebuilds
+        if run_once(case, rundir, env, "prime") is None:
+            return None
+
+    times = []
+    for i in range(g_repeats):
+        if case.fresh and case.kind == "build":
+            clean_directory(rundir)
+        elapsed = run_once(case, rundir, env, str(i))
+        if elapsed is None:
+            return None
+        times.append(elapsed)
+    return times
+
+def clean_directory( directory ):
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif not name.startswith("bench-"):
+            os.unlink(path)
+
+def run_once( case, rundir, env, label ):
+    (command, cwd, module) = case_command(case, rundir)
+    env = dict(env)
+    env["BENCH_CASE"] = case.name
+    env["BENCH_MODULE"] = module
+    # Where the shims count the runs of each tool in this run of the case
+    env["BENCH_CALLS"] = tempfile.mkdtemp(prefix="bench-calls-")
+    log = open(os.path.join(rundir, "bench-%s.log" % label), 'w')
+    start = time.time()
+    try:
+        rc = Popen(command, cwd=cwd, env=env, stdout=log, stderr=STDOUT).wait()
+    except OSError as e:
+        log.write("%s\n" % e)
+        rc = 1
+    elapsed = time.time() - start
+    log.close()
+    shutil.rmtree(env["BENCH_CALLS"], ignore_errors=True)
+    if rc != 0:
+        print ("ERROR: %s failed, see %s" % (case.name, log.name))
+        return None
+    return elapsed
+
+def read_baseline( filename ):
+    f = open(filename, 'r')
+    baseline = json.load(f)
+    f.close()
+    return baseline.get("medians", {})
+
+def main( argv ):
+    global g_directory, g_repeats, g_threshold
+
+    if len(argv) > 2 and argv[1] == "--shim":
+        shim(argv[2], argv[3:])
+
+    try:
+        opts, args = getopt.getopt( argv[1:], "c:r:d:b:T:lh",
+                                    ["case=", "repeats=", "dir=", "baseline=", "threshold=",
+                                     "save-baseline=", "record=", "stub=", "list", "help"])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(1)
+
+    filters = []
+    baseline = ""
+    save_baseline = ""
+    record = ""
+    stub = ""
+    for opt, arg in opts:
+        if opt in ( "-c", "--case" ):
+            filters.append(arg)
+        if opt in ( "-r", "--repeats" ):
+            g_repeats = int(arg)
+        if opt in ( "-d", "--dir" ):
+            g_directory = arg
+        if opt in ( "-b", "--baseline" ):
+            baseline = arg
+        if opt in ( "-T", "--threshold" ):
+            g_threshold = float(arg)
+        if opt == "--save-baseline":
+            save_baseline = arg
+        if opt == "--record":
+            record = os.path.abspath(arg)
+        if opt == "--stub":
+            stub = os.path.abspath(arg)
+        if opt in ( "-l", "--list" ):
+            for case in CASES:
+                print (case.name)
+            sys.exit(0)
+        if opt in ( "-h", "--help" ):
+            usage()
+            sys.exit(0)
+    if record and stub:
+        print ("ERROR: --record and --stub can't be used together")
+        sys.exit(1)
+
+    cases = [ c for c in CASES if not filters or any( f in c.name for f in filters ) ]
+    if not os.path.isdir(g_directory):
+        os.makedirs(g_directory)
+
+    env = dict(os.environ)
+    shimdir = None
+    if record or stub:
+        shimdir = tempfile.mkdtemp(prefix="bench-shims-")
+        make_shims(shimdir)
+        env["BENCH_MODE"] = "record" if record else "replay"
+        env["BENCH_RECORDING"] = record or stub
+        env["BENCH_REAL_PATH"] = os.environ.get("PATH", "")
+        env["PATH"] = shimdir + os.pathsep + os.environ.get("PATH", "")
+        print ("INFO: %s tool runs in %s" % ("Recording" if record else "Replaying", record or stub))
+
+    results = collections.OrderedDict()
+    try:
+        for case in cases:
+            print ("INFO: %s x%d ..." % (case.name, g_repeats))
+            results[case.name] = run_case(case, env)
+    finally:
+        if shimdir is not None:
+            shutil.rmtree(shimdir)
+
+    reference = read_baseline(baseline) if baseline else {}
+    medians = dict()
+    regressions = 0
+    print ("")
+    print ("%-48s %8s %8s %8s %10s %8s" % ("Case", "Median", "Min", "Max", "Baseline", "Change"))
+    print ("-" * 96)
+    for (name, times) in results.items():
+        if times is None:
+            print ("%-48s %8s" % (name, "FAILED"))
+            regressions += 1
+            continue
+        medians[name] = round(median(times), 3)
+        base = reference.get(name)
+        change = "-"
+        if base:
+            percent = 100.0 * (medians[name] - base) / base
+            change = "%+.1f%%" % percent
+            if percent > g_threshold:
+                change += " SLOW"
+                regressions += 1
+        print ("%-48s %8.2f %8.2f %8.2f %10s %8s" % (name, medians[name], min(times), max(times),
+                                                    "%.2f" % base if base else "-", change))
+    print ("-" * 96)
+
+    entry = { "date": time.strftime("%Y-%m-%d %H:%M:%S"), "repeats": g_repeats,
+              "stub": stub != "", "medians": medians,
+              "times": dict( (n, t) for (n, t) in results.items() if t is not None ) }
+    f = open(os.path.join(g_directory, "bench_results.json"), 'w')
+    json.dump(entry, f, indent=2, sort_keys=True)
+    f.close()
+    if save_baseline:
+        f = open(save_baseline, 'w')
+        json.dump(entry, f, indent=2, sort_keys=True)
+        f.close()
+        print ("INFO: baseline written to %s" % save_baseline)
+    if regressions:
+        print ("FAIL: %d case(s) failed or slower than the baseline by more than %.0f%%" % \
+            (regressions, g_threshold))
+    sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main( sys.argv )
@@ -25,8 +25,21 @@ build.py
 
 """
 
-import getopt, os, os.path, shutil, sys, time
-from subprocess import Popen, PIPE, call
+from __future__ import print_function
+
+import collections, errno, getopt, hashlib, itertools, json, multiprocessing, os, os.path, re
+import shutil, signal, socket, sys, threading, time
+from subprocess import Popen, PIPE, STDOUT
+
+import artifacts, pins, reports, verilog
+
+# Popen arguments to start a command in a new session, so that it and the tools
+# it runs can be killed together. preexec_fn isn't safe when there are threads,
+# as the child can deadlock before the exec, so it is only used on Python 2.
+if sys.version_info[0] >= 3:
+    NEW_SESSION = dict(start_new_session=True)
+else:
+    NEW_SESSION = dict(preexec_fn=os.setsid)
 
 # Use globals to hold all command line arguments
 g_directory = ""
@@ -41,17 +54,63 @@ g_target = "xc9500"
 g_optimize = "area"
 g_fresh = False
 g_fpga_flow = False
+g_all_sources = False
+g_sweep = False
+g_variants = []
+g_closure = None
+g_gatesim = ""
+g_argv = []
+g_jobs = 0
+g_explore = False
+g_metrics = "build_metrics.jsonl"
+g_abort_patterns = [ r"^FATAL_ERROR" ]
+g_synth_cache = ""
+g_synth_cache_size = 2048
+g_store = ""
+g_store_keep = 20
+g_explore_space = ""
+g_explore_prune = False
+g_source_dir = "."
+g_json = False
+g_pin_check = True
+g_boards = []
+g_show_profile = False
+
+# Tool output lines which are counted as warnings and errors, or which mark the
+# start of a new phase of the tool run (xst section banners, map/par phases)
+re_warning = re.compile(r"^WARNING", re.I)
+re_error = re.compile(r"^(ERROR|FATAL_ERROR)", re.I)
+re_phases = [ re.compile(r"^\*\s+(\S.*?)\s+\*$"),
+              re.compile(r"^(Phase\s+\d+(?:\.\d+)*\s+\S.*?)(?:\s+\(.*\))?$"),
+              re.compile(r"^(Starting \S.*?)\s*\.*$") ]
+
+# Default cpldfit parameter space for --explore
+g_explore_defaults = { "inputs"   : "16,20,24,28,32,36",
+                       "pterms"   : "10,15,20,25,30,40,50",
+                       "optimize" : "density,speed",
+                       "fbk"      : "on,off" }
+
+# Builds run their steps in threads, so messages are printed one at a time
+g_print_lock = threading.Lock()
+
+# The build flow is a graph of steps, each producing a set of artifacts (file
+# extensions appended to the module name) from those of the steps before it.
+# g_goals lists the artifacts or step names to build, or is empty for all. The
+# state of a build while it runs, including the step cache manifest and the
+# hashes of the steps run so far, is held in a Flow (see below).
+Step = collections.namedtuple("Step", ["name", "function", "inputs", "outputs"])
+g_goals = []
 
 
 def usage() :
     """
     Print usage message.
     """
-    print __doc__ + """
+    print (__doc__ + """
   USAGE:
 
     build.py -m|--module <verilog or vhdl module name>  \\
-             -p|--project <project filename> \\
+             -p|--project <project filename> | --all-sources \\
              -t|--target <target device> \\
              -c|--constraints <constraints filename> \\
              -o|--optimize <optimization setting> \\
@@ -60,6 +119,20 @@ def usage() :
              -k|--keephierarchy \\
              -n|--no-execute \\
              -f|--fresh \\
+             -s|--sweep \\
+             -j|--jobs <number of parallel builds> \\
+             -x|--explore [--space "<parameter space>"] [--prune] \\
+             -M|--metrics <metrics filename> \\
+             -A|--abort-on <regular expression> \\
+             -P|--profile \\
+             -g|--goal <artifact or step name> \\
+             -S|--synth-cache <directory> [--synth-cache-size <MB>] \\
+             --store <directory> [--store-keep <n>] \\
+             -V|--variant "[name:]DEFINE,DEFINE=value..." \\
+             --closure <ns> | --reuse <closure file> \\
+             --gatesim <testbench directory> \\
+             --json \\
+             --board <pcb netlist> | --no-pin-check \\
              -h|--help
 
   REQUIRED SWITCHES
@@ -70,26 +143,140 @@ def usage() :
   OPTIONAL SWITCHES
 
     -a --toolargs "toolname: args..."     Specifies a string of arguments to be passed verbatim
-                                          to the named tool.
+                                          to the named tool. May be given more than once, and
+                                          the arguments for the same tool are joined.
+    -A --abort-on <regexp>                Kill a step as soon as a line of tool output matches
+                                          this regular expression. May be given more than once.
+                                          FATAL_ERROR messages always abort.
     -c --constraints <filename>           Name of a constraints file. Default is to run with
-                                          no constraints.
+                                          no constraints. Any '%m' in the name is replaced
+                                          by the module name.
     -d --directory <dirname>              Name for working directory to be created in current
                                           directory. Default is to create a directory named
                                           <module>-<target>-<datestamp>
     -f --fresh                            Cleans out all data in the build directory if it
-                                          already exists before starting build.py
+                                          already exists before starting build.py. Without
+                                          this, steps whose inputs and outputs are unchanged
+                                          since the last build in the directory are skipped.
+                                          Verilog sources count as unchanged if they only
+                                          differ in comments, layout or disabled `ifdefs.
     -o --optimize <speed|area>            Specify speed or area optimization. Default is
                                           to optimize for area.
     -k --keephierarchy                    Synthesis should try not to flatten hierarchy
+    -M --metrics <filename>               Append a JSON record of step times, resource usage
+                                          and timing for each build to this file, keyed by
+                                          module, target and git commit. Default is
+                                          build_metrics.jsonl in the current directory, use
+                                          an empty name to disable. View the trend with
+                                          scripts/reports.py <filename>
     -n --no-execute                       Show steps without running
+    -P --profile                          Print a summary of where the build time went. The
+                                          wall clock and CPU time, peak memory and output size
+                                          of every step and tool are always written to
+                                          <module>.profile.json in the build directory.
     -p --project <filename>               Name of project file with paths to verilog/vhdl
                                           source. Default it to generate one automatically
-                                          with all rtl files in the current directory
+                                          with the Verilog files in the current directory
+                                          which the module's hierarchy uses, and any VHDL
+       --all-sources                      Generate the project file with all Verilog/VHDL
+                                          files in the current directory
+    -S --synth-cache <dirname>            Synthesize CPLDs for the device family rather than the
+                                          device, and keep the results in this shared cache
+                                          directory keyed by module, family, optimization,
+                                          xst arguments (eg defines) and sources. Builds for
+                                          other devices in the same family then reuse them.
+       --synth-cache-size <MB>            Size limit for the shared synthesis cache, least
+                                          recently used entries are removed. Default 2048.
+       --store <dirname>                  Add the programming files and reports of each
+                                          successful build to this artifact store, where
+                                          identical files are kept once. See artifacts.py -h
+                                          to list, compare and fetch stored builds. If a
+                                          stored build has the same options and sources, once
+                                          normalized (without comments, layout or disabled
+                                          `ifdef branches), its results are reused instead of
+                                          running the flow, unless -f is given.
+       --store-keep <n>                   Keep the newest <n> stored builds of each module and
+                                          target, evicting older ones and removing their
+                                          working directories if build.py named them.
+                                          Default 20.
     -t --target  <device_name or family>  Name of specific Xilinx device or family (for CPLDs
                                           only - FPGAs require a device to be specified for 
                                           mapping). Defaults to xc9500. 
     -v --verbose                          Writes stdout from tools to screen in place of 
-                                          shorter summary messages
+                                          shorter summary messages. The output of each step is
+                                          always written to run_<step>_<module>.log
+    -s --sweep                            Build every combination of the comma separated
+                                          lists of modules, targets and optimization settings
+                                          given with -m, -t and -o. Each build runs in its own
+                                          <module>-<target>-<optimize> directory inside the
+                                          -d directory (default sweep-<datestamp>) and logs
+                                          to build.log there. A summary table is printed at
+                                          the end.
+    -V --variant "[name:]DEF,DEF=val..."  Build a variant of the module with these Verilog
+                                          defines passed to xst. May be given more than once;
+                                          all variants are built from the same sources,
+                                          concurrently, each in a <name> directory inside the
+                                          -d directory, and their fit and timing are printed
+                                          side by side. Defines no source refers to are
+                                          ignored and variants left with the same defines share
+                                          one build. Any '%v' in the constraints file name is
+                                          replaced by the variant name.
+       --closure <ns>                     Search for a build which fits the target device with a
+                                          worst pad to pad delay (or worst path delay if there is
+                                          none) of at most <ns>. Builds with optimize speed and
+                                          area, keep hierarchy, several cpldfit input and pterm
+                                          limits and then each faster speed grade of the device
+                                          are tried in that order, -j at a time, each in its own
+                                          subdirectory of -d. The search stops at the first
+                                          build to meet the goal and saves its options to
+                                          <module>.closure.json.
+       --reuse <file>                     Use the options saved by --closure in <file>. Options
+                                          given after it take precedence.
+       --gatesim <directory>              Also generate a timing simulation netlist of the fitted
+                                          design (alongside sta) and run the testbench in
+                                          <directory> which instantiates the module against it
+                                          with GATESIM_D defined, failing the build if its
+                                          output reports FAIL or ERROR. The compiled simulation
+                                          is kept in gatesim/ by the hash of the netlist and
+                                          testbench sources. Needs iverilog and vvp on the path.
+       --json                             Write the build's messages to build.log in its
+                                          directory and print only the result as JSON: success,
+                                          directory, elapsed time, parsed reports and profile.
+                                          Not for sweep, variant, explore or closure builds.
+                                          Other programs can run builds in-process, concurrently,
+                                          with build.build(build.BuildConfig(...)).
+       --board <filename>                 Check the constraints against the pins of the target
+                                          device on this PCB netlist. May be given more than
+                                          once. Default is the netlist in ../pcb whose nets on
+                                          the device's pins match the constraints, if exactly
+                                          one does. Before any tool is run, the LOCs
+                                          in a .ucf constraints file are checked against the
+                                          ports of the module and the boards, and the build
+                                          stops if any net isn't a port, a net or pin is
+                                          located twice, a pin isn't in the package, or a
+                                          board leaves a pin unconnected or has power on it.
+       --no-pin-check                     Don't check the constraints before building.
+    -j --jobs <n>                         Number of sweep, variant or closure builds, or
+                                          exploration fits, to run in parallel. Default is the
+                                          number of CPUs.
+    -x --explore                          Synthesize once and then fit the .ngd with every
+                                          combination of cpldfit settings in the parameter
+                                          space, each in its own explore/ subdirectory, and
+                                          print the resource usage of each (CPLD targets only).
+       --space "<parameter space>"        Parameter space for --explore, eg
+                                          "inputs=16,20,24 pterms=10,20 optimize=speed fbk=on"
+                                          Any parameter not given takes the defaults:
+                                          "inputs=16,20,24,28,32,36 pterms=10,15,20,25,30,40,50
+                                           optimize=density,speed fbk=on,off"
+       --prune                            For --explore, once the fitter reports that a point
+                                          doesn't fit, skip the points with the same optimize
+                                          and fbk settings and at least as many inputs and
+                                          pterms. This assumes that raising the limits never
+                                          makes a design fit, which cpldfit doesn't promise.
+    -g --goal <artifact[,artifact...]>    Only run the steps needed to build the given
+                                          artifacts, eg "jed", "tim", "twr", "bit", or steps,
+                                          eg "sta". Default is to run the whole flow. Steps
+                                          which don't depend on each other run concurrently.
     -h --help                             Produce this help information.
 
   COMMON TARGETS
@@ -122,7 +309,13 @@ def usage() :
       and using user created project and constraints files, apply command options
       to cpldfit and xst.
 
-    """
+    build.py -s -m level1b_mk2_m,cpld_jnr -t xc9536-10-pc44,xc95108-10-pc84 \\
+             -o speed,area -c %m.ucf -j 4
+
+    - build both modules for both devices with both optimization settings, four
+      builds at a time, each using its own constraints file.
+
+    """)
     return
 
 
@@ -141,13 +334,442 @@ def timestamp():
     lt = time.localtime(time.time())
     return "%02d.%02d.%04d_%02d:%02d:%02d" % (lt[2], lt[1], lt[0], lt[3], lt[4], lt[5])
 
-def create_files():
+def file_digest( filename ):
+    """
+    Return the SHA1 hex digest of a file's contents, or "" if it doesn't exist.
+    """
+    if not os.path.isfile(filename):
+        return ""
+    h = hashlib.sha1()
+    f = open(filename, 'rb')
+    while True:
+        block = f.read(1 << 16)
+        if not block:
+            break
+        h.update(block)
+    f.close()
+    return h.hexdigest()
+
+def project_sources( flow ):
+    """
+    Return a list of the absolute paths of all source files named in the
+    project file, in the order xst reads them.
+    """
+    sources = []
+    prjfile = os.path.join(flow.directory, flow.project_file)
+    if not os.path.isfile(prjfile):
+        return sources
+    f = open(prjfile, 'r')
+    for line in f:
+        fields = line.split()
+        if len(fields) >= 3 and fields[0] in ("verilog", "vhdl"):
+            path = " ".join(fields[2:]).strip('"')
+            sources.append(os.path.abspath(os.path.join(flow.directory, path)))
+    f.close()
+    return sources
+
+def sources_digest( flow ):
+    """
+    Return a digest of the project sources in which the Verilog files are
+    normalized with the xst defines applied (see verilog.normalize()), so that
+    edits to comments, layout or disabled `ifdef branches don't change it.
+    VHDL files, and Verilog which can't be normalized, are hashed as they are.
+    The Verilog is normalized in project file order since macros defined in one
+    file carry over to the next, but plain hashes don't depend on the order.
+    """
+    sources = project_sources(flow)
+    verilog_files = [ f for f in sources if f.endswith(".v") ]
+    h = hashlib.sha1()
+    try:
+        h.update(("verilog:%s\n" % verilog.normalized_digest(
+            verilog_files, xst_defines(flow.toolargs.get("xst", "")))).encode())
+        others = [ f for f in sources if not f.endswith(".v") ]
+    except (ValueError, IOError) as e:
+        log_message (flow, "WARNING: can't normalize Verilog sources, hashing them as they are: %s" % e)
+        others = sources + flow.include_files
+    for filename in sorted(others):
+        h.update(("%s:%s\n" % (os.path.basename(filename), file_digest(filename))).encode())
+    return h.hexdigest()
+
+def result_key( flow ):
+    """
+    Return the key of the results of the whole build: the normalized sources,
+    the constraints, every option which affects the tools and this script.
+    """
+    h = hashlib.sha1()
+    for item in ( flow.module, flow.target, flow.optimize, flow.keephierarchy, flow.fpga_flow,
+                  ",".join(sorted(flow.goals)), sources_digest(flow), file_digest(flow.constraints),
+                  file_digest(os.path.abspath(__file__).replace(".pyc", ".py")) ):
+        h.update(("%s\n" % (item,)).encode())
+    for tool in sorted(flow.toolargs):
+        h.update(("%s:%s\n" % (tool, flow.toolargs[tool])).encode())
+    if flow.gatesim:
+        for f in sorted(os.listdir(flow.gatesim)):
+            if f.endswith(".v") or f.endswith(".vh"):
+                h.update(("%s:%s\n" % (f, file_digest(os.path.join(flow.gatesim, f)))).encode())
+    return h.hexdigest()
+
+def manifest_filename( flow ):
+    return os.path.join(flow.directory, "%s.manifest" % flow.module)
+
+def load_manifest( flow ):
+    """
+    Read the step manifest from the working directory, if there is one.
+    """
+    flow.manifest = dict()
+    if os.path.isfile(manifest_filename(flow)):
+        try:
+            f = open(manifest_filename(flow), 'r')
+            flow.manifest = json.load(f)
+            f.close()
+        except ValueError:
+            log_message (flow, "WARNING: ignoring corrupt manifest %s" % manifest_filename(flow))
+            flow.manifest = dict()
+
+def save_manifest( flow ):
+    f = open(manifest_filename(flow), 'w')
+    json.dump(flow.manifest, f, indent=2, sort_keys=True)
+    f.close()
+
+def step_hash( flow, name, runfile, inputs, tools, keys=() ):
+    """
+    Compute the input hash for a step from the hashes of the steps it depends on,
+    the generated run script, any additional input files, the arguments for
+    the tools used and any other keys (strings) given.
+    """
+    h = hashlib.sha1()
+    for d in step_dependencies(flow, find_step(flow, name)):
+        h.update(flow.step_hashes[d.name].encode())
+    # Hash the run script without the profiling wrappers, which depend on the
+    # python interpreter in use
+    f = open(os.path.join(flow.directory, runfile), 'r')
+    h.update(f.read().replace(profile_wrapper(runfile), "").encode())
+    f.close()
+    for filename in inputs:
+        h.update(("%s:%s\n" % (filename, file_digest(filename))).encode())
+    for tool in tools:
+        h.update(("%s:%s\n" % (tool, flow.toolargs.get(tool, ""))).encode())
+    for key in keys:
+        h.update(("%s\n" % key).encode())
+    return h.hexdigest()
+
+def log_message( flow, text ):
+    """
+    Print a message from a build to its log, or to stdout if it has none,
+    while holding the print lock, so that the lines from steps running
+    concurrently don't interleave.
+    """
+    with g_print_lock:
+        print (text, file=flow.log or sys.stdout)
+        if flow.log is not None:
+            flow.log.flush()
+
+def run_step( flow, name, runfile, inputs=(), tools=(), shared_key=None, shared_files=(), keys=() ):
+    """
+    Run a step's generated script unless the manifest shows that it has
+    already been run with identical inputs and keys and that all of its
+    outputs are still present and unchanged. Return True if successful, False
+    otherwise.
+
+    If a shared_key is given the step's outputs and shared_files are fetched
+    from the shared cache instead of running the step, if they are there, and
+    stored there after a successful run.
+    """
+    command_line = "cd %s ; ./%s" % (flow.directory, runfile)
+    if flow.noexecute:
+        return launch_command( flow, command_line )
+
+    digest = step_hash( flow, name, runfile, inputs, tools, keys )
+    outputs = [ os.path.join(flow.directory, "%s%s" % (flow.module, ext)) for ext in find_step(flow, name).outputs ]
+    entry = flow.manifest.get(name)
+    if entry and entry["hash"] == digest and \
+            all( entry["outputs"].get(os.path.basename(o)) == file_digest(o) != ""
+                 for o in outputs ):
+        log_message (flow, "INFO: %s inputs unchanged, skipping" % name)
+        flow.profile.append( { "step": name, "skipped": True, "wall": 0.0, "user": 0.0,
+                            "sys": 0.0, "maxrss_kb": 0, "output_bytes": 0, "tools": [] } )
+        flow.step_hashes[name] = digest
+        return True
+
+    with flow.lock:
+        flow.manifest.pop(name, None)
+        save_manifest(flow)
+    shared = outputs + [ os.path.join(flow.directory, f) for f in shared_files ]
+    if shared_key is not None and shared_cache_fetch( flow, shared_key, shared ):
+        log_message (flow, "INFO: %s restored from shared cache entry %s" % (name, shared_key))
+        flow.profile.append( { "step": name, "skipped": True, "wall": 0.0, "user": 0.0,
+                            "sys": 0.0, "maxrss_kb": 0, "output_bytes": 0, "tools": [] } )
+        ok = True
+    else:
+        runbase = os.path.splitext(runfile)[0]
+        toolprofile = os.path.join(flow.directory, "%s.prof" % runbase)
+        if os.path.exists(toolprofile):
+            os.unlink(toolprofile)
+        usage = dict()
+        try:
+            ok = launch_command( flow, command_line, logfile=os.path.join(flow.directory, "%s.log" % runbase),
+                                 usage=usage, label=name )
+            if ok and shared_key is not None:
+                shared_cache_store( flow, shared_key, shared )
+        finally:
+            if shared_key is not None:
+                shared_cache_unlock( flow, shared_key )
+        flow.profile.append( step_profile(name, usage, outputs, toolprofile) )
+    if not ok:
+        return False
+    with flow.lock:
+        flow.manifest[name] = { "hash": digest,
+                             "outputs": dict( (os.path.basename(o), file_digest(o)) for o in outputs ) }
+        save_manifest(flow)
+    flow.step_hashes[name] = digest
+    return True
+
+def lock_owner( lockfile ):
+    """
+    Return the (pid, host) written into a lock file, or None if it can't be read.
+    """
+    try:
+        with open(lockfile) as f:
+            pid, host = f.read().split()
+        return int(pid), host
+    except (IOError, OSError, ValueError):
+        return None
+
+def lock_stale( lockfile, owner ):
+    """
+    A lock is stale if its owner ran on this host and is no longer running.
+    Locks from other hosts, or which can't be read, are assumed stale after a day.
+    """
+    if owner and owner[1] == socket.gethostname():
+        try:
+            os.kill(owner[0], 0)
+        except OSError as e:
+            return e.errno == errno.ESRCH
+        return False
+    return time.time() - os.path.getmtime(lockfile) > 24 * 3600
+
+def shared_cache_lock( flow, key, wait=True ):
+    """
+    Take the lock for a shared cache entry, waiting while another build holds it,
+    or if wait is False return False straight away. Returns True once the lock
+    is taken. The lock records the pid and host of its owner, so that a lock
+    left behind by a build which was killed can be broken.
+    """
+    lockfile = os.path.join(flow.synth_cache, "%s.lock" % key)
+    waiting = None
+    while True:
+        try:
+            fd = os.open(lockfile, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            os.write(fd, ("%d %s\n" % (os.getpid(), socket.gethostname())).encode())
+            os.close(fd)
+            return True
+        except OSError:
+            pass
+        owner = lock_owner(lockfile)
+        try:
+            if lock_stale(lockfile, owner):
+                # Only break the lock if it hasn't changed hands since it was read
+                if lock_owner(lockfile) == owner:
+                    log_message (flow, "WARNING: Breaking stale lock %s" % lockfile)
+                    os.unlink(lockfile)
+                continue
+        except OSError:
+            continue
+        if not wait:
+            return False
+        if owner != waiting:
+            holder = "pid %d on %s" % owner if owner else "unknown build"
+            log_message (flow, "INFO: Waiting for lock held by %s (%s)" % (holder, lockfile))
+            waiting = owner
+        time.sleep(1)
+
+def shared_cache_unlock( flow, key ):
+    lockfile = os.path.join(flow.synth_cache, "%s.lock" % key)
+    if os.path.exists(lockfile):
+        os.unlink(lockfile)
+
+def shared_cache_fetch( flow, key, files ):
+    """
+    Copy files from the shared cache entry for key into the working directory
+    and return True, or if there is no such entry take its lock and return False.
+    If another build is creating the entry this waits for it to finish.
+    """
+    if not os.path.isdir(flow.synth_cache):
+        os.makedirs(flow.synth_cache)
+    shared_cache_lock( flow, key )
+    entry = os.path.join(flow.synth_cache, key)
+    if not all( os.path.isfile(os.path.join(entry, os.path.basename(f))) for f in files ):
+        return False
+    try:
+        for f in files:
+            shutil.copyfile(os.path.join(entry, os.path.basename(f)), f)
+        # Entries are evicted least recently used first
+        os.utime(entry, None)
+    except (IOError, OSError) as e:
+        # Treat a damaged entry as missing, keeping the lock while the step runs
+        log_message (flow, "WARNING: can't restore shared cache entry %s: %s" % (key, e))
+        return False
+    except BaseException:
+        shared_cache_unlock( flow, key )
+        raise
+    shared_cache_unlock( flow, key )
+    return True
+
+def shared_cache_store( flow, key, files ):
+    """
+    Store files in the shared cache entry for key, then evict the least recently
+    used entries until the cache is within its size limit. Entries which another
+    build has locked, to fetch or store them, are left alone.
+    """
+    entry = os.path.join(flow.synth_cache, key)
+    if os.path.isdir(entry):
+        shutil.rmtree(entry)
+    os.mkdir(entry)
+    for f in files:
+        if os.path.isfile(f):
+            shutil.copyfile(f, os.path.join(entry, os.path.basename(f)))
+
+    entries = []
+    total = 0
+    for d in os.listdir(flow.synth_cache):
+        path = os.path.join(flow.synth_cache, d)
+        if os.path.isdir(path):
+            size = sum( os.path.getsize(os.path.join(path, f)) for f in os.listdir(path) )
+            entries.append( (os.path.getmtime(path), size, path) )
+            total += size
+    entries.sort()
+    while entries and total > flow.synth_cache_size * 1024 * 1024:
+        (mtime, size, path) = entries.pop(0)
+        if path == entry or not shared_cache_lock( flow, os.path.basename(path), wait=False ):
+            continue
+        try:
+            log_message (flow, "INFO: evicting shared cache entry %s" % os.path.basename(path))
+            shutil.rmtree(path, ignore_errors=True)
+        finally:
+            shared_cache_unlock( flow, os.path.basename(path) )
+        total -= size
+
+def device_family( target ):
+    """
+    Return the CPLD family of a target device, as accepted by xst, or the target
+    itself for FPGAs and unknown devices.
+    """
+    if target.startswith("xc95"):
+        for suffix in ("xl", "xv"):
+            if re.match(r"xc95\d+%s" % suffix, target):
+                return "xc9500%s" % suffix
+        return "xc9500"
+    if target.startswith("xc2c"):
+        return "acr2"
+    if target.startswith("xcr3"):
+        return "xpla3"
+    return target
+
+def step_profile( name, usage, outputs, toolprofile ):
+    """
+    Return the profile record of a step from the resource usage of its run
+    script, the total size of its declared outputs and the per-tool records
+    left in the toolprofile file by profile_tool().
+    """
+    output_bytes = sum( os.path.getsize(o) for o in outputs if os.path.isfile(o) )
+    tools = []
+    if os.path.isfile(toolprofile):
+        f = open(toolprofile, 'r')
+        tools = [ json.loads(line) for line in f if line.strip() != "" ]
+        f.close()
+    wall = usage["wall"]
+    if "user" in usage:
+        (user, system, maxrss) = ( usage["user"], usage["sys"], usage["maxrss_kb"] )
+    else:
+        # The launcher couldn't measure the run script, so add up its tools
+        user = sum( t["user"] for t in tools )
+        system = sum( t["sys"] for t in tools )
+        maxrss = max( [ t["maxrss_kb"] for t in tools ] + [ 0 ] )
+    return { "step": name, "skipped": False, "wall": round(wall, 3), "user": round(user, 3),
+             "sys": round(system, 3), "maxrss_kb": maxrss, "output_bytes": output_bytes,
+             "tools": tools }
+
+def profile_tool( profile_file, command ):
+    """
+    Run a single tool from a generated run script, passing its output straight
+    through, and append its resource usage to profile_file. Exits with the
+    tool's return code.
+    """
+    start = time.time()
+    try:
+        p = Popen( command )
+    except OSError as e:
+        print ("ERROR: %s: %s" % (command[0], e))
+        sys.exit(127)
+    (pid, status, ru) = os.wait4(p.pid, 0)
+    p.returncode = rc = exit_status(status)
+    f = open(profile_file, 'a')
+    f.write(json.dumps({ "tool": os.path.basename(command[0]), "wall": round(time.time() - start, 3),
+                         "user": round(ru.ru_utime, 3), "sys": round(ru.ru_stime, 3),
+                         "maxrss_kb": ru.ru_maxrss, "rc": rc }) + "\n")
+    f.close()
+    sys.exit(rc)
+
+def exit_status( status ):
+    """
+    Convert a wait() status into a shell style return code.
+    """
+    if os.WIFSIGNALED(status):
+        return 128 + os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+def write_profile( flow, ok ):
+    """
+    Write the machine readable profile of the build into the working directory.
+    """
+    f = open(os.path.join(flow.directory, "%s.profile.json" % flow.module), 'w')
+    json.dump({ "module": flow.module, "target": flow.target, "optimize": flow.optimize, "ok": ok,
+                "steps": flow.profile }, f, indent=2, sort_keys=True)
+    f.close()
+
+def print_profile( flow ):
+    """
+    Print a flame style summary of the build profile: one bar per step, and
+    below that one per tool, scaled to the total wall clock time of the build.
+    """
+    total = sum( step["wall"] for step in flow.profile )
+    width = 50
+    bar = lambda t: "#" * int(round(width * t / total)) if total > 0 else ""
+    log_message (flow, "")
+    log_message (flow, "%-24s %9s |%-50s| %8s %8s %9s %10s" % \
+        ("Profile", "Wall(s)", "", "User(s)", "Sys(s)", "RSS(MB)", "Output(KB)"))
+    log_message (flow, "%-24s %9.1f |%-50s|" % ("build", total, bar(total)))
+    for step in flow.profile:
+        name = step["step"] + (" (skipped)" if step["skipped"] else "")
+        log_message (flow, "  %-22s %9.1f |%-50s| %8.1f %8.1f %9.1f %10d" % \
+            (name, step["wall"], bar(step["wall"]), step["user"], step["sys"],
+             step["maxrss_kb"] / 1024.0, step["output_bytes"] // 1024))
+        for tool in step["tools"]:
+            log_message (flow, "    %-20s %9.1f |%-50s| %8.1f %8.1f %9.1f" % \
+                (tool["tool"], tool["wall"], bar(tool["wall"]), tool["user"], tool["sys"],
+                 tool["maxrss_kb"] / 1024.0))
+
+def write_if_changed( filename, text ):
+    """
+    Write text to a file unless it already holds exactly that, so that reused
+    working directories keep their timestamps.
+    """
+    if os.path.isfile(filename):
+        f = open(filename, 'r')
+        same = f.read() == text
+        f.close()
+        if same:
+            return
+    f = open(filename, 'w')
+    f.write(text)
+    f.close()
+
+def create_files( flow ):
     """
     Ensure that all working directories and temporary files exist. Create any
     files with design data as required.
     """
-    global g_project_file
-    workdir=g_directory
+    workdir=flow.directory
 
     #ensure that the working and temp directories exist
     for d in ( workdir, os.path.join(workdir,"tmp"), os.path.join(workdir,"xst")):
@@ -155,97 +777,320 @@ def create_files():
             os.mkdir(d)
 
     # Write the .lso file
-    f = open( os.path.join(workdir, "%s.lso" % g_module), 'w')
-    f.write("work\n")
-    f.close()
+    write_if_changed( os.path.join(workdir, "%s.lso" % flow.module), "work\n")
 
     # create the project file if required
-    if g_project_file == "" :
-        g_project_file = "%s.%s" % (g_module,"prj")
-        f = open( os.path.join(workdir,"%s" % g_project_file), 'w' )
-        for filename in os.listdir("."):
-            if filename.endswith(".v") and not filename.startswith(".#"):
-                f.write("verilog work %s\n" % (os.path.abspath(filename) ))
-            if filename.endswith(".vhd") and not filename.startswith(".#"):
-                f.write("vhdl work %s\n" % (os.path.abspath(filename) ))
-        f.close()
+    if flow.project_file == "" :
+        flow.project_file = "%s.%s" % (flow.module,"prj")
+        lines = []
+        for filename in project_candidates(flow):
+            if filename.endswith(".v"):
+                lines.append("verilog work %s\n" % (os.path.abspath(filename) ))
+            if filename.endswith(".vhd"):
+                lines.append("vhdl work %s\n" % (os.path.abspath(filename) ))
+        write_if_changed( os.path.join(workdir,"%s" % flow.project_file), "".join(lines))
 
     return
 
-
-def launch_command( command_line, input = "") :
+def project_candidates( flow ):
     """
-    Launch a command line string via Popen and return True if successful, False if not.
-
-    When the verbose flag is True, the stdout of the process is printed to screen otherwise
-    it is suppressed.
+    Return the source files in flow.source_dir needed to build the module.
+    Verilog files are scanned for the module hierarchy below flow.module and only
+    those in it are used, with any files they `include noted in
+    flow.include_files. VHDL can't be scanned so is always used. With
+    flow.all_sources, or if the module isn't found in any Verilog file, every
+    source file is used.
     """
-    if g_noexecute:
-        print "launch_command(g_noexecute): %s" % command_line
+    del flow.include_files[:]
+    verilog_files = [ os.path.join(flow.source_dir, f) for f in sorted(os.listdir(flow.source_dir))
+                      if f.endswith(".v") and not f.startswith(".#") ]
+    vhdl_files = [ os.path.join(flow.source_dir, f) for f in sorted(os.listdir(flow.source_dir))
+                   if f.endswith(".vhd") and not f.startswith(".#") ]
+    if flow.all_sources:
+        return verilog_files + vhdl_files
+
+    cache = verilog.ScanCache(os.path.join(flow.directory, "verilog_scan.json"))
+    (files, includes, missing) = verilog.hierarchy(flow.module, verilog_files, scan=cache.scan)
+    cache.save()
+    if not files:
+        log_message (flow, "WARNING: module %s not found in any Verilog file, using all sources" % flow.module)
+        return verilog_files + vhdl_files
+    flow.include_files.extend(includes)
+    if flow.verbose and missing:
+        log_message (flow, "INFO: modules not defined in any source file (primitives or VHDL): %s" % \
+            " ".join(sorted(missing)))
+    log_message (flow, "INFO: Project uses %d of %d Verilog files for %s" % (len(files), len(verilog_files), flow.module))
+    return files + vhdl_files
+
+
+def launch_command( flow, command_line, input = "", logfile = None, usage = None, label = "" ) :
+    """
+    Launch a command line string with flow.launch (by default via Popen, see
+    popen_launch()) and return True if successful, False if not. If usage is a
+    dictionary, the wall clock and CPU time and peak memory use of the command
+    are added to it, as far as the launcher can tell.
+
+    The output of the process is streamed line by line into logfile, if given.
+    When the verbose flag is True, it is also printed to screen, otherwise it is
+    suppressed and a summary of the current tool phase and the number of warnings
+    and errors so far is shown instead. If a line matches one of the abort
+    patterns the process is killed straight away and the launch has failed.
+    """
+    if flow.noexecute:
+        log_message (flow, "launch_command(noexecute): %s" % command_line)
         if input != "":
-            print "launch_command(g_noexecute-input-begins):\n"
-            print input
-            print "launch_command(g_noexecute-input-ends)\n"
+            log_message (flow, "launch_command(noexecute-input-begins):\n")
+            log_message (flow, input)
+            log_message (flow, "launch_command(noexecute-input-ends)\n")
+        return True
+    if flow.stopping:
+        return False
+
+    start = time.time()
+    log = open(logfile, 'wb') if logfile else None
+    # Only show an updating progress line when no other step is running
+    interactive = flow.log is None and sys.stdout.isatty() and not flow.verbose and flow.running <= 1
+    prefix = "[%s] " % label if label != "" and not interactive else ""
+    state = { "phase": "", "warnings": 0, "errors": 0, "fatal": None, "last_update": 0 }
+
+    def output( line ):
+        if log:
+            log.write(line)
+        text = line.decode("latin-1").rstrip()
+        if flow.verbose:
+            log_message (flow, text)
+        if re_warning.match(text):
+            state["warnings"] += 1
+        elif re_error.match(text):
+            state["errors"] += 1
+        for pattern in flow.abort_patterns:
+            if re.search(pattern, text):
+                state["fatal"] = text
+        if state["fatal"]:
+            return False
+        for pattern in re_phases:
+            m = pattern.match(text)
+            if m and m.group(1) != state["phase"]:
+                state["phase"] = m.group(1)
+                if not interactive and not flow.verbose:
+                    log_message (flow, "INFO:   %s%s" % (prefix, state["phase"]))
+        if interactive and time.time() - state["last_update"] > 0.2:
+            state["last_update"] = time.time()
+            with g_print_lock:
+                sys.stdout.write("\rINFO:   %-50.50s  warnings: %d  errors: %d " % \
+                    (state["phase"], state["warnings"], state["errors"]))
+                sys.stdout.flush()
         return True
-    
-    if g_verbose and input == "":
-        # provide raw IO without prefiltering
-        rc = call( command_line, shell=True) 
-    else :
-        f = Popen( command_line, stdout=PIPE, stdin=PIPE, shell=True)
-        if input == "":
-            (sout, serr) = f.communicate()
-        else:
-            (sout, serr) = f.communicate(input=input)
-        if g_verbose:
-            print sout
-        rc = f.wait()
 
-    return (rc == 0 )
+    try:
+        (rc, ru) = flow.launch( command_line, input, output )
+    finally:
+        if log:
+            log.close()
+    if usage is not None:
+        usage["wall"] = time.time() - start
+        if ru is not None:
+            usage.update({ "user": ru.ru_utime, "sys": ru.ru_stime, "maxrss_kb": ru.ru_maxrss })
+
+    if interactive:
+        with g_print_lock:
+            sys.stdout.write("\r%s\r" % (" " * 90))
+    if state["fatal"]:
+        log_message (flow, "ERROR: %saborted on fatal message: %s" % (prefix, state["fatal"]))
+    if state["warnings"] or state["errors"]:
+        log_message (flow, "INFO:   %s%d warnings, %d errors%s" % \
+            (prefix, state["warnings"], state["errors"], " - see %s" % logfile if logfile else ""))
+    return (rc == 0 and state["fatal"] is None)
+
+def popen_launch( command_line, input, output ):
+    """
+    Run a command line through the shell with Popen, passing each line of its
+    output to output() until that returns False, when the command is killed.
+    Return its exit status and resource usage, which includes all of the tools
+    it has run.
+    """
+    # Run in a new session so that the shell and the tools it runs can be
+    # killed together on a fatal error
+    f = Popen( command_line, stdout=PIPE, stderr=STDOUT, shell=True,
+               stdin=(PIPE if input != "" else None), **NEW_SESSION )
+    if input != "":
+        f.stdin.write(input.encode())
+        f.stdin.close()
+    for line in iter(f.stdout.readline, b""):
+        if not output(line):
+            os.killpg(f.pid, signal.SIGKILL)
+            break
+    f.stdout.close()
+    # Wait with wait4() to collect the resource usage of the run script
+    (pid, status, ru) = os.wait4(f.pid, 0)
+    f.returncode = rc = exit_status(status)
+    return (rc, ru)
+
+def profile_wrapper( runfile ):
+    """
+    Return the prefix used in a run script to profile each tool.
+    """
+    return '"%s" "%s" --profile-tool %s.prof ' % \
+        (sys.executable, os.path.abspath(__file__).replace(".pyc", ".py"),
+         os.path.splitext(runfile)[0])
 
-def create_run_file( filename, command_list ):
+def create_run_file( flow, filename, command_list, directory=None ):
     """
     Write a shell command to run a list of commands saving the file in the workdir, 
+
+    Each command is run through 'build.py --profile-tool' so that the resource
+    usage of every tool is recorded in <runfile>.prof.
     """
-    f = open(os.path.join(g_directory, filename), 'w')
+    if directory is None:
+        directory = flow.directory
+    wrapper = profile_wrapper(filename)
+    lines = []
+    continuation = False
+    for line in "\n".join(command_list).split("\n"):
+        if not continuation and line.strip() != "":
+            line = wrapper + line
+        continuation = line.rstrip().endswith("\\")
+        lines.append(line)
+    f = open(os.path.join(directory, filename), 'w')
     f.write("#!/bin/sh\n")
     f.write("#   build script written by build.py\n")
-    f.write("\n".join(command_list) )
+    f.write("\n".join(lines) )
     f.write("\n")
     f.close()
-    os.chmod( os.path.join(g_directory, filename), 0777)
+    os.chmod( os.path.join(directory, filename), 0o777)
     return
 
-def create_sim_netlist():
+def create_sim_netlist( flow ):
     """
     Create simulation netlist.
     """
-    print "INFO: Generating simulation netlist ..."
-
-    if "netgen" in g_toolargs:
-        arg_string = g_toolargs["netgen"]
+    log_message (flow, "INFO: Generating simulation netlist ...")
+    if "netgen" in flow.toolargs:
+        arg_string = flow.toolargs["netgen"]
     else:
         arg_string = "" 
 
     command_list = ["netgen -w -ofmt verilog -aka %s_map.ncd %s" % \
-        (g_module, arg_string)]
+        (flow.module, arg_string)]
 
     # Write a shell command to run the process, 
-    runfile = "run_create_netlist_%s.sh" % g_module 
-    create_run_file(runfile, command_list)
+    runfile = "run_create_netlist_%s.sh" % flow.module 
+    create_run_file(flow, runfile, command_list)
 
-    return launch_command(  "cd %s ; ./%s" % (g_directory, runfile))
+    return run_step( flow, "create_sim_netlist", runfile, tools=("netgen",) )
 
-   
-def create_jedec():
+def create_timesim_netlist( flow ):
     """
-    Create JEDEC file for programming hardware
+    Create a post-fit timing simulation netlist for a CPLD. tsim is run again
+    into a separate .nga so that this can run alongside sta.
     """
-    print "INFO: Generating JEDEC programming file ..."
+    log_message (flow, "INFO: Generating timing simulation netlist ...")
+    if "netgen" in flow.toolargs:
+        arg_string = flow.toolargs["netgen"]
+    else:
+        arg_string = ""
 
-    if g_fpga_flow:
-       if "bitgen" in g_toolargs:
-            arg_string = g_toolargs["bitgen"]
+    command_list = ["tsim %s %s_timesim.nga\n" % (flow.module, flow.module)]
+    command_list.append("netgen -intstyle xflow -w -ofmt verilog -sim -tm %s %s_timesim.nga %s_timesim.v %s\n" % \
+        (flow.module, flow.module, flow.module, arg_string))
+
+    runfile = "run_create_timesim_%s.sh" % flow.module
+    create_run_file(flow, runfile, command_list)
+    return run_step( flow, "create_timesim_netlist", runfile, tools=("tsim", "netgen") )
+
+def gatesim_sources( flow ):
+    """
+    Return (top, files, includes) for the testbench in the flow.gatesim directory
+    which instantiates flow.module: its top level module, the files it needs less
+    the module itself which comes from the netlist, and the files they include.
+    """
+    candidates = sorted( os.path.abspath(os.path.join(flow.gatesim, f)) for f in os.listdir(flow.gatesim)
+                         if f.endswith(".v") and not f.startswith(".#") )
+    scans = dict( (f, verilog.scan_file(f)) for f in candidates )
+    instantiated = set()
+    for s in scans.values():
+        instantiated.update(s.instances)
+    # Scans are per file, so try the modules in a file last first: helper
+    # modules and primitives usually come before the testbench itself
+    for filename in candidates:
+        for top in reversed(scans[filename].modules):
+            if top in instantiated:
+                continue
+            (files, includes, missing) = verilog.hierarchy(top, candidates, scan=lambda f: scans[f])
+            if flow.module in missing:
+                return (top, files, includes)
+    return (None, [], [])
+
+def gatesim( flow ):
+    """
+    Compile the testbench against the post-fit netlist and run it. The compiled
+    simulation is kept in gatesim/ named by the hash of the netlist, testbench
+    sources, iverilog options and simulation library, so it is only compiled
+    again when one of them changes, and the run is skipped as usual if the
+    compiled simulation is unchanged.
+    """
+    log_message (flow, "INFO: Running gate level simulation ...")
+    (top, files, includes) = gatesim_sources(flow)
+    if top is None:
+        log_message (flow, "ERROR: no testbench in %s instantiates %s" % (flow.gatesim, flow.module))
+        return False
+    netlist = os.path.join(flow.directory, "%s%s" % (flow.module, "_map.v" if flow.fpga_flow else "_timesim.v"))
+
+    libraries = ""
+    if "XILINX" in os.environ:
+        src = os.path.join(os.environ["XILINX"], "verilog", "src")
+        libraries = "-y %s %s" % (os.path.join(src, "simprims"), os.path.join(src, "glbl.v"))
+    options = "-D GATESIM_D -I %s -s %s" % (flow.gatesim, top)
+
+    # The iverilog options, defines and simulation library go into the name too
+    h = hashlib.sha1()
+    for filename in [ netlist ] + files + includes:
+        h.update(("%s:%s\n" % (os.path.basename(filename), file_digest(filename))).encode())
+    h.update(("%s\n%s\n%s\n" % (options, libraries, flow.toolargs.get("iverilog", ""))).encode())
+    simdir = os.path.join(flow.directory, "gatesim")
+    if not os.path.exists(simdir):
+        os.mkdir(simdir)
+    exe = os.path.join("gatesim", "%s.vvp" % h.hexdigest()[:16])
+
+    if not os.path.isfile(os.path.join(flow.directory, exe)):
+        runfile = "run_gatesim_compile_%s.sh" % flow.module
+        create_run_file(flow, runfile, ["iverilog %s -o %s.tmp %s %s %s %s\n" % \
+            (options, exe, " ".join(files), os.path.basename(netlist), libraries,
+             flow.toolargs.get("iverilog", ""))])
+        if not launch_command( flow, "cd %s ; ./%s" % (flow.directory, runfile),
+                               logfile=os.path.join(flow.directory, "run_gatesim_compile_%s.log" % flow.module),
+                               label="gatesim" ):
+            return False
+        if not flow.noexecute:
+            os.rename(os.path.join(flow.directory, exe + ".tmp"), os.path.join(flow.directory, exe))
+
+    runfile = "run_gatesim_%s.sh" % flow.module
+    create_run_file(flow, runfile, ["vvp -n %s %s > %s_gatesim.log 2>&1\n" % \
+        (exe, flow.toolargs.get("vvp", ""), flow.module)])
+    if not run_step( flow, "gatesim", runfile, [ os.path.join(flow.directory, exe) ], tools=("iverilog", "vvp") ):
+        return False
+
+    # The testbench reports failures in its output rather than its exit status
+    log = os.path.join(flow.directory, "%s_gatesim.log" % flow.module)
+    f = open(log, 'r')
+    failures = [ line for line in f if re.match(r"^\s*(FAIL|ERROR|Error)\b", line) ]
+    f.close()
+    if failures:
+        log_message (flow, "ERROR: gate level simulation failed, see %s" % log)
+        with flow.lock:
+            flow.manifest.pop("gatesim", None)
+            save_manifest(flow)
+        return False
+    return True
+
+def create_jedec( flow ):
+    """
+    Create JEDEC file for programming hardware
+    """
+    log_message (flow, "INFO: Generating JEDEC programming file ...")
+    if flow.fpga_flow:
+       if "bitgen" in flow.toolargs:
+            arg_string = flow.toolargs["bitgen"]
        else:
             arg_string = "" 
 
@@ -278,217 +1123,1226 @@ def create_jedec():
        command_list.append("-g Security:None            \\")
        command_list.append("-g DonePipe:No              \\")
        command_list.append("-g DriveDone:No             \\")
-       command_list.append("%s.ncd  %s" % (g_module, arg_string))
+       command_list.append("%s.ncd  %s" % (flow.module, arg_string))
        # generate the PROM file for the GODIL - hard coded parameters for now, size and ROM type
-       command_list.append("promgen -w -spi -p mcs -s 16384 -u 0 %s.bit" % g_module)
+       command_list.append("promgen -w -spi -p mcs -s 16384 -u 0 %s.bit" % flow.module)
 
     else:
         # CPLD Flow
-        if "hprep6" in g_toolargs:
-            arg_string = g_toolargs["hprep6"]
+        if "hprep6" in flow.toolargs:
+            arg_string = flow.toolargs["hprep6"]
         else:
             arg_string = ""
         
         command_list = ["hprep6  -s IEEE1149 -n %s -i %s %s" % \
-            (g_module,g_module,arg_string)]
+            (flow.module,flow.module,arg_string)]
 
     # Write a shell command to run the process, 
-    runfile = "run_create_jedec_%s.sh" % g_module 
-    create_run_file(runfile, command_list)
+    runfile = "run_create_jedec_%s.sh" % flow.module 
+    create_run_file(flow, runfile, command_list)
 
-    return launch_command(  "cd %s ; ./%s" % (g_directory, runfile))
+    return run_step( flow, "create_jedec", runfile, tools=("bitgen", "hprep6") )
 
 
-def fpgapnr( ):
+def fpgapnr( flow ):
     """
     Run mapping and PNR for a FPGA target
     """
-    print "INFO: Running FPGA mapping and PNR ..."
-    if "map" in g_toolargs:
-        arg_string = g_toolargs["map"]
+    log_message (flow, "INFO: Running FPGA mapping and PNR ...")
+    if "map" in flow.toolargs:
+        arg_string = flow.toolargs["map"]
     else:
         arg_string = ""
 
     command_list = ["map -p %s -cm %s -ir off -pr off -c 100 -o %s_map.ncd %s.ngd %s.pcf"  \
-        % (g_target,g_optimize,g_module,g_module,g_module)]
-    if "par" in g_toolargs:
-        arg_string = g_toolargs["par"]
+        % (flow.target,flow.optimize,flow.module,flow.module,flow.module)]
+    if "par" in flow.toolargs:
+        arg_string = flow.toolargs["par"]
     else:
         arg_string = ""
     command_list.append("par -w -ol std -t 1 %s_map.ncd %s.ncd %s.pcf" % \
-            (g_module, g_module, g_module))
+            (flow.module, flow.module, flow.module))
 
     # Write a shell command to run the process, 
-    runfile = "run_fpgapnr_%s.sh" % g_module 
-    create_run_file(runfile, command_list)
+    runfile = "run_fpgapnr_%s.sh" % flow.module 
+    create_run_file(flow, runfile, command_list)
 
-    return launch_command(  "cd %s ; ./%s" % (g_directory, runfile))
+    return run_step( flow, "fpgapnr", runfile, tools=("map", "par") )
 
-def sta ():
+def sta( flow ):
     """
     Run Static timing analysis and generate reports
     """
-    print "INFO: Running STA ..."
-
-    if g_fpga_flow:
-        if "trce" in g_toolargs:
-            arg_string = g_toolargs["trce"]
+    log_message (flow, "INFO: Running STA ...")
+    if flow.fpga_flow:
+        if "trce" in flow.toolargs:
+            arg_string = flow.toolargs["trce"]
         else:
             arg_string = ""
         command_list = ["trce -v 3 -s 5 -fastpaths -xml %s.twx %s.ncd -o %s.twr %s.pcf\n" % \
-            (g_module,g_module,g_module,g_module)]
+            (flow.module,flow.module,flow.module,flow.module)]
     else:
         # CPLD specific flow
-        if "tsim" in g_toolargs:
-            arg_string = g_toolargs["tsim"]
+        if "tsim" in flow.toolargs:
+            arg_string = flow.toolargs["tsim"]
         else:
             arg_string = ""
     
-        command_list = ["tsim %s %s.nga %s\n" % (g_module,g_module,arg_string)]
-        if "taengine" in g_toolargs:
-            arg_string = g_toolargs["taengine"]
+        command_list = ["tsim %s %s.nga %s\n" % (flow.module,flow.module,arg_string)]
+        if "taengine" in flow.toolargs:
+            arg_string = flow.toolargs["taengine"]
         else:
             arg_string = ""
-        command_list.append( "taengine -f %s -detail %s\n" % (g_module,arg_string))
+        command_list.append( "taengine -f %s -detail %s\n" % (flow.module,arg_string))
 
     # Write a shell command to run the process, 
-    runfile = "run_sta_%s.sh" % g_module 
-    create_run_file(runfile, command_list)
+    runfile = "run_sta_%s.sh" % flow.module 
+    create_run_file(flow, runfile, command_list)
 
-    return launch_command(  "cd %s ; ./%s" % (g_directory, runfile))
+    return run_step( flow, "sta", runfile, tools=("trce", "tsim", "taengine") )
 
 
-def cpldfit( ):
+def has_feedback_options( flow ):
     """
-    Fit the selected device and generate reports
+    True if the target takes the additional xc9500 power/feedback fitter options.
     """
-    
-    print "INFO: Starting CPLD fitting process ..."
-    optimize = g_optimize
-    if g_optimize == "area":
-        optimize = "density"
-        
+    return flow.target.startswith("xc95") and not ( flow.target.endswith("100") or flow.target.endswith("144"))
 
-    if "cpldfit" in g_toolargs:
-        arg_string = g_toolargs["cpldfit"]
+def cpldfit_command_list( flow, optimize, inputs=20, pterms=20, feedback=True ):
+    """
+    Return the cpldfit command for the given optimization (density or speed),
+    input and pterm limits, and feedback setting.
+    """
+    if "cpldfit" in flow.toolargs:
+        arg_string = flow.toolargs["cpldfit"]
     else:
         arg_string = ""
 
-    # we need some options to set the effort:
-    #    make inputs, pterms and exhaust optional
-    #    ideally we should write these options to a file in the subdir
-    #    and have an option to allow reuse, so the file can be tweaked
-    #
-    command_list = [ "cpldfit -p %s \\" % g_target]
+    command_list = [ "cpldfit -p %s \\" % flow.target]
     command_list.append("-ofmt vhdl \\")
     command_list.append("-optimize %s \\" % optimize)
     command_list.append("-loc on \\")
     command_list.append("-slew slow \\")
     command_list.append("-exhaust \\")
     command_list.append("-init low \\")
-    command_list.append("-inputs 20 \\")
-    command_list.append("-pterms 20 \\")
+    command_list.append("-inputs %d \\" % inputs)
+    command_list.append("-pterms %d \\" % pterms)
     # Additional options for xc9500
-    if g_target.startswith("xc95") and not ( g_target.endswith("100") or g_target.endswith("144")) :
-        command_list.append("-power std -localfbk -pinfbk \\")
+    if has_feedback_options(flow):
+        if feedback:
+            command_list.append("-power std -localfbk -pinfbk \\")
+        else:
+            command_list.append("-power std \\")
         command_list.append("-unused float \\")        
 ##    command_list.append("-exhaust \\")
-    command_list.append("%s.ngd %s" % (g_module, arg_string))
+    command_list.append("%s.ngd %s" % (flow.module, arg_string))
+    return command_list
+
+def cpldfit( flow ):
+    """
+    Fit the selected device and generate reports
+    """
+    
+    log_message (flow, "INFO: Starting CPLD fitting process ...")
+    optimize = flow.optimize
+    if flow.optimize == "area":
+        optimize = "density"
+
+    # Use --explore to find the best effort settings (inputs, pterms etc) and
+    # then pass them in with -a "cpldfit: ..."
+    command_list = cpldfit_command_list( flow, optimize )
 
     # Write a shell command to run the process, 
-    runfile = "run_cpldfit_%s.sh" % g_module 
-    create_run_file( runfile, command_list )
-    return launch_command( "cd %s ; ./%s" % (g_directory, runfile) )
+    runfile = "run_cpldfit_%s.sh" % flow.module 
+    create_run_file( flow, runfile, command_list )
+    return run_step( flow, "cpldfit", runfile, tools=("cpldfit",) )
 
 
-def ngdbuild():
+def ngdbuild( flow ):
     '''
     Run the ngdbuild process (backend for synthesis)
     '''
-    print "INFO: Starting ngdbuild process ..."
-
-    if "ngdbuild" in g_toolargs:
-        arg_string = g_toolargs["ngdbuild"]
+    log_message (flow, "INFO: Starting ngdbuild process ...")
+    if "ngdbuild" in flow.toolargs:
+        arg_string = flow.toolargs["ngdbuild"]
     else:
         arg_string = ""
 
-    if g_constraints == "":
+    if flow.constraints == "":
         cons_arg = ""
     else:
-        cons_arg = "-uc %s" % g_constraints    
+        cons_arg = "-uc %s" % flow.constraints    
 
     command_list = ["ngdbuild -dd _ngo -p %s %s %s.ngc %s.ngd %s\n" \
-        % (g_target,cons_arg,g_module,g_module,arg_string) ]
+        % (flow.target,cons_arg,flow.module,flow.module,arg_string) ]
 
     # Write a shell command to run the xst process, 
-    runfile = "run_ngdbuild_%s.sh" % g_module 
-    create_run_file( runfile, command_list )
-    return launch_command( "cd %s ; ./%s" % (g_directory, runfile) )
+    runfile = "run_ngdbuild_%s.sh" % flow.module 
+    create_run_file( flow, runfile, command_list )
+    if flow.constraints == "":
+        inputs = ()
+    else:
+        inputs = ( flow.constraints, )
+    return run_step( flow, "ngdbuild", runfile, inputs, tools=("ngdbuild",) )
 
-def synthesis():
+def synthesis( flow ):
     '''
     Run synthesis and ngdbuild process. Return True if successful, false otherwise. 
     '''
 
-    print "INFO: Starting xst synthesis process ..."
-    if "xst" in g_toolargs:
-        arg_string = g_toolargs["xst"]
+    log_message (flow, "INFO: Starting xst synthesis process ...")
+    if "xst" in flow.toolargs:
+        arg_string = flow.toolargs["xst"]
     else:
         arg_string = ""
     
     # Write the run commands to an input script file
-    xstfile = "%s.xst" % g_module
-    f = open( os.path.join(g_directory, xstfile), 'w')
+    xstfile = "%s.xst" % flow.module
+    f = open( os.path.join(flow.directory, xstfile), 'w')
     command_list= ["set -tmpdir ./tmp\n"]
     command_list.append("set -xsthdpdir ./xst\n")
-    command_list.append("run -ifn %s -p %s -ifmt mixed  " % (g_project_file, g_target))
-    command_list.append("-ofn %s -ofmt NGC -top %s -opt_mode %s " % (g_module,g_module,g_optimize) )
+    # With a shared synthesis cache, CPLDs are synthesized for the whole family
+    # so that the result can be reused for every device in it
+    if flow.synth_cache != "":
+        part = device_family(flow.target)
+    else:
+        part = flow.target
+    command_list.append("run -ifn %s -p %s -ifmt mixed  " % (flow.project_file, part))
+    command_list.append("-ofn %s -ofmt NGC -top %s -opt_mode %s " % (flow.module,flow.module,flow.optimize) )
     command_list.append("-opt_level 2 ")
-    command_list.append("-iuc NO -lso %s.lso -keep_hierarchy %s " % (g_module,g_keephierarchy) )
+    command_list.append("-iuc NO -lso %s.lso -keep_hierarchy %s " % (flow.module,flow.keephierarchy) )
     command_list.append("-netlist_hierarchy as_optimized  -rtlview Yes ")
     command_list.append("""-hierarchy_separator /  -bus_delimiter <>  """)
     command_list.append("-case maintain  -verilog2001 YES  -fsm_extract YES ")
     command_list.append("-fsm_encoding COMPACT  -safe_implementation No  ")
     command_list.append("-mux_extract YES  -resource_sharing YES  -iobuf YES ")
-    if not g_fpga_flow:
+    if not flow.fpga_flow:
         command_list.append("-pld_mp YES  -pld_xp YES  -wysiwyg NO  ")
     command_list.append("-equivalent_register_removal YES ")
     command_list.append( arg_string + "\n")
     f.write( "".join(command_list) )
     f.close()
 
-    command_list = ["xst -ifn %s -intstyle xflow -ofn ./%s.syr\n" % (xstfile,g_module)]
+    command_list = ["xst -ifn %s -intstyle xflow -ofn ./%s.syr\n" % (xstfile,flow.module)]
     # Write a shell command to run the xst process, 
-    runfile = "run_xst_%s.sh" % g_module 
-    create_run_file( runfile, command_list )
-    return launch_command( "cd %s ; ./%s" % (g_directory, runfile) )
+    runfile = "run_xst_%s.sh" % flow.module 
+    create_run_file( flow, runfile, command_list )
+    # The sources are keyed by their normalized digest rather than contents so
+    # that edits which can't change the netlist don't rerun the flow
+    inputs = [ os.path.join(flow.directory, xstfile) ]
+    sources = sources_digest(flow)
+    if flow.synth_cache == "":
+        return run_step( flow, "synthesis", runfile, inputs, tools=("xst",), keys=(sources,) )
+
+    # Key the shared cache on the xst script, which covers module, family,
+    # optimization and defines, and the sources
+    h = hashlib.sha1()
+    h.update(("%s:%s\n%s\n" % (xstfile, file_digest(inputs[0]), sources)).encode())
+    key = "%s-%s-%s" % (flow.module, part, h.hexdigest()[:16])
+    return run_step( flow, "synthesis", runfile, inputs, tools=("xst",), shared_key=key,
+                     shared_files=["%s.syr" % flow.module], keys=(sources,) )
+
+def flow_steps( flow ):
+    """
+    Return the list of steps in the flow for the current target.
+    """
+    if flow.fpga_flow :
+        return [ Step("synthesis", synthesis, [], [".ngc"]),
+                 Step("ngdbuild", ngdbuild, [".ngc"], [".ngd"]),
+                 Step("fpgapnr", fpgapnr, [".ngd"], ["_map.ncd", ".ncd", ".pcf"]),
+                 Step("sta", sta, [".ncd", ".pcf"], [".twr"]),
+                 Step("create_jedec", create_jedec, [".ncd"], [".bit", ".mcs"]),
+                 Step("create_sim_netlist", create_sim_netlist, ["_map.ncd"], ["_map.v"]) ] + \
+               ( [ Step("gatesim", gatesim, ["_map.v"], ["_gatesim.log"]) ] if flow.gatesim else [] )
+    else:
+        steps = [ Step("synthesis", synthesis, [], [".ngc"]),
+                  Step("ngdbuild", ngdbuild, [".ngc"], [".ngd"]),
+                  Step("cpldfit", cpldfit, [".ngd"], [".vm6"]),
+                  Step("sta", sta, [".vm6"], [".nga", ".tim"]),
+                  Step("create_jedec", create_jedec, [".vm6"], [".jed"]) ]
+        if flow.gatesim:
+            steps.append(Step("create_timesim_netlist", create_timesim_netlist, [".vm6"], ["_timesim.v"]))
+            steps.append(Step("gatesim", gatesim, ["_timesim.v"], ["_gatesim.log"]))
+        return steps
+
+def find_step( flow, name ):
+    for step in flow.steps:
+        if step.name == name:
+            return step
+    return None
+
+def step_dependencies( flow, step ):
+    """
+    Return the steps which produce the inputs of a step.
+    """
+    return [ s for s in flow.steps if set(s.outputs) & set(step.inputs) ]
+
+def goal_steps( flow, goals ):
+    """
+    Return the steps needed to build a list of goals, each a step name or an
+    artifact extension (eg "jed", "tim" or ".ngd"), in flow order. An empty list
+    of goals selects the whole flow. Raises ValueError for an unknown goal.
+    """
+    if not goals:
+        return list(flow.steps)
+    needed = set()
+    def add( step ):
+        if step.name not in needed:
+            needed.add(step.name)
+            for d in step_dependencies(flow, step):
+                add(d)
+    for goal in goals:
+        ext = goal if goal.startswith(".") or goal.startswith("_") else "." + goal
+        matches = [ s for s in flow.steps if s.name == goal or ext in s.outputs ]
+        if not matches:
+            raise ValueError("no step in the %s flow builds '%s'" % \
+                ("FPGA" if flow.fpga_flow else "CPLD", goal))
+        add(matches[0])
+    return [ s for s in flow.steps if s.name in needed ]
+
+def run_flow( flow, steps ):
+    """
+    Run a list of steps, each in its own thread as soon as all of the steps it
+    depends on have finished, so that independent branches of the flow run
+    concurrently. No new steps are started after a failure, or once the flow
+    has been stopped. Return True if all steps were successful.
+    """
+    try:
+        import queue
+    except ImportError:
+        import Queue as queue
+    finished = queue.Queue()
+    def worker( step ):
+        try:
+            ok = step.function(flow)
+        except Exception as e:
+            log_message (flow, "ERROR: %s: %s" % (step.name, e))
+            ok = False
+        finished.put( (step, ok) )
+
+    pending = list(steps)
+    names = set( s.name for s in steps )
+    done = set()
+    ok = True
+    flow.running = 0
+    while pending or flow.running:
+        ready = [ s for s in pending
+                  if all( d.name in done or d.name not in names for d in step_dependencies(flow, s) ) ]
+        if ok and not flow.stopping:
+            for step in ready:
+                pending.remove(step)
+                flow.running += 1
+                if flow.noexecute:
+                    worker(step)
+                else:
+                    t = threading.Thread(target=worker, args=(step,))
+                    t.daemon = True
+                    t.start()
+        if not flow.running:
+            break
+        (step, step_ok) = finished.get()
+        flow.running -= 1
+        if step_ok:
+            done.add(step.name)
+            log_message (flow, "INFO: Done %s" % step.name)
+        else:
+            ok = False
+    return ok and not pending
 
-def main_loop():
+def main_loop( flow ):
     """
-    Main Device flows controlled from here
+    Main Device flows controlled from here. Steps whose inputs are unchanged since
+    the last run in the same directory are skipped, see run_step().
     """
-    if g_fresh and os.path.exists(g_directory) :
-        remove_dir_contents(g_directory)
+    if flow.fresh and os.path.exists(flow.directory) :
+        remove_dir_contents(flow.directory)
     
-    create_files()
+    create_files(flow)
+    load_manifest(flow)
+    flow.step_hashes.clear()
+    del flow.profile[:]
+    flow.steps = flow_steps(flow)
 
-    if g_fpga_flow :
-        steps = ( synthesis, ngdbuild, fpgapnr, sta, create_jedec, create_sim_netlist )
+    try:
+        steps = goal_steps( flow, flow.goals )
+    except ValueError as e:
+        log_message (flow, "ERROR: %s" % e)
+        return False
+    key = None
+    reused = False
+    if flow.pin_check and not check_pins(flow):
+        log_message (flow, "ERROR: pin constraints are inconsistent, not running the flow")
+        ok = False
+    else:
+        if flow.store != "" and not flow.noexecute:
+            key = result_key(flow)
+            reused = reuse_artifacts(flow, key)
+        ok = reused or run_flow( flow, steps )
+    if not ok:
+        log_message (flow, "ERROR - completed with errors, check log files")
+
+    if not flow.noexecute:
+        write_profile(flow, ok)
+        if flow.show_profile:
+            print_profile(flow)
+        if flow.metrics != "":
+            record_metrics(flow, ok)
+        if ok and flow.store != "" and not reused:
+            store_artifacts(flow, key)
+    return ok
+
+def check_pins( flow ):
+    """
+    Check the LOC constraints in a UCF constraints file against the ports of
+    the top level module, with the xst defines applied, and against the pins
+    of the target device on the PCB netlists, before any tool is run. The
+    boards are those given with --board, or by default the one in ../pcb from
+    the sources whose nets on the device's pins match the constraints, if only
+    one does. Print any problems and return False if there are errors.
+    """
+    if not flow.constraints.lower().endswith(".ucf") or not os.path.isfile(flow.constraints):
+        return True
+    start = time.time()
+    sources = [ f for f in project_sources(flow) if f.endswith(".v") ]
+    try:
+        ports = pins.module_ports(sources, flow.module, xst_defines(flow.toolargs.get("xst", "")))
+    except (ValueError, IndexError) as e:
+        log_message (flow, "WARNING: can't read the ports of %s, not checking pins: %s" % (flow.module, e))
+        return True
+    if ports is None:
+        return True
+    boards = flow.boards
+    if not boards:
+        boards = pins.find_boards(os.path.join(flow.source_dir, "..", "pcb"), flow.target, flow.constraints)
+        if len(boards) > 1:
+            log_message (flow, "WARNING: %s match %s, not checking any board, use --board to choose one" %
+                   (", ".join( os.path.basename(b) for b in boards ), os.path.basename(flow.constraints)))
+            boards = []
+    problems = pins.check(flow.constraints, ports, flow.target, boards)
+    for problem in problems:
+        log_message (flow, "%s: %s" % problem)
+    errors = len([ p for p in problems if p.severity == "ERROR" ])
+    log_message (flow, "INFO: Pin check of %s against %d ports%s: %d errors, %d warnings (%.0f ms)" % \
+        (os.path.basename(flow.constraints), len(ports),
+         "".join( " and %s" % os.path.basename(b) for b in boards ), errors,
+         len(problems) - errors, (time.time() - start) * 1000))
+    return errors == 0
+
+def git_commit( flow ):
+    """
+    Return the git commit of the source directory, marked -dirty if there are
+    uncommitted changes, or "unknown" if it isn't in a git repository.
+    """
+    try:
+        p = Popen("git describe --always --dirty --abbrev=40", shell=True, cwd=flow.source_dir,
+                  stdout=PIPE, stderr=PIPE, universal_newlines=True)
+        (sout, serr) = p.communicate()
+    except OSError:
+        return "unknown"
+    if p.returncode != 0 or sout.strip() == "":
+        return "unknown"
+    return sout.strip()
+
+def record_metrics( flow, ok ):
+    """
+    Parse the reports from the build and append a record of the results to the
+    metrics store.
+    """
+    entry = { "module"    : flow.module,
+              "target"    : flow.target,
+              "optimize"  : flow.optimize,
+              "commit"    : git_commit(flow),
+              "date"      : time.strftime("%Y-%m-%d %H:%M:%S"),
+              "directory" : os.path.abspath(flow.directory),
+              "ok"        : ok,
+              "steps"     : [ { "step": step["step"], "seconds": step["wall"], "skipped": step["skipped"] }
+                              for step in flow.profile ] }
+    entry.update( reports_to_json(reports.build_reports(flow.directory, flow.module)) )
+    reports.append_metrics(flow.metrics, entry)
+
+def reports_to_json( parsed ):
+    """
+    Return the parsed reports of a build as a dictionary which can be saved as JSON.
+    """
+    result = dict()
+    for (name, record) in parsed.items():
+        if isinstance(record, tuple) and hasattr(record, "_asdict"):
+            result[name] = reports.record_to_json(record)
+        else:
+            result[name] = record
+    return result
+
+def reuse_artifacts( flow, key ):
+    """
+    If the artifact store has a build with the same result key (see
+    result_key(flow)), copy its programming files and reports into the working
+    directory instead of running the flow and return True. A fresh build
+    always runs the flow.
+    """
+    if flow.fresh:
+        return False
+    store = artifacts.ArtifactStore(flow.store)
+    record = store.find_key(flow.module, flow.target, key)
+    if record is None:
+        return False
+    store.restore(record, flow.directory)
+    log_message (flow, "INFO: sources and options are equivalent to stored build %s, reusing its results" % \
+        record["id"])
+    return True
+
+def store_artifacts( flow, key ):
+    """
+    Add the outputs of the build to the artifact store under its result key,
+    say whether the programmed image changed since the last stored build of
+    the module and target, then apply the retention policy.
+    """
+    store = artifacts.ArtifactStore(flow.store)
+    parsed = reports.build_reports(flow.directory, flow.module)
+    info = { "key"      : key,
+             "target"   : flow.target,
+             "optimize" : flow.optimize,
+             "commit"   : git_commit(flow),
+             "date"     : time.strftime("%Y-%m-%d %H:%M:%S"),
+             "ok"       : True,
+             "fit"      : reports.record_to_json(parsed["fit"]),
+             "timing"   : reports.record_to_json(parsed["timing"]) }
+    record = store.add_build(flow.directory, flow.module, info)
+    previous = store.previous(record)
+    if previous is None:
+        change = "first stored build"
+    elif previous["images"] == record["images"]:
+        change = "programmed image unchanged from %s" % previous["id"]
     else:
-        steps = ( synthesis, ngdbuild, cpldfit, sta, create_jedec )
+        change = "programmed image differs from %s" % previous["id"]
+    log_message (flow, "INFO: stored %s in %s, %s" % (record["id"], flow.store, change))
+    for evicted in store.evict(flow.store_keep):
+        log_message (flow, "INFO: evicted stored build %s" % evicted["id"])
+    store.collect()
+
+def is_fpga_target( target ):
+    return ( target.startswith("xc3s") or
+             target.startswith("xc2v") or
+             (target.find("spartan") > -1))
+
+def prepare_directory( flow ):
+    """
+    Create the working directory for a build run in a worker, emptying it
+    first for a fresh build.
+    """
+    if flow.fresh and os.path.exists(flow.directory):
+        remove_dir_contents(flow.directory)
+    flow.fresh = False
+    if not os.path.exists(flow.directory):
+        os.makedirs(flow.directory)
+
+def isolated_build( directory ):
+    """
+    Run a single build in a worker process, in the given directory, with all
+    output, including that of the tools, going to build.log there. Returns a
+    tuple of the directory, a success flag, elapsed time and the parsed reports.
+    """
+    config = current_config()
+    config.directory = directory
+    flow = Flow(config)
+    prepare_directory(flow)
+
+    log = open(os.path.join(flow.directory, "build.log"), 'w')
+    sys.stdout.flush()
+    os.dup2(log.fileno(), sys.stdout.fileno())
+    os.dup2(log.fileno(), sys.stderr.fileno())
+    start = time.time()
+    try:
+        ok = main_loop(flow)
+    except Exception as e:
+        print ("ERROR: %s" % e)
+        ok = False
+    sys.stdout.flush()
+    return ( directory, ok, time.time() - start, reports.build_reports(flow.directory, flow.module) )
+
+# In-process build API. All of the state of a build is held in its Flow,
+# which is passed to every step, so builds can run concurrently in threads
+# or an asyncio event loop of one process.
+BuildResult = collections.namedtuple("BuildResult", ["ok", "directory", "elapsed", "log",
+                                                     "reports", "profile"])
+
+class BuildConfig(object):
+    """
+    The options for one build, with the same meanings and defaults as the
+    command line options, except that no metrics are recorded by default.
+    Relative paths are taken from source_dir, which holds the sources, and
+    the working directory defaults to <module>-<target>-<datestamp> there.
+    toolargs maps tool names to argument strings and abort_patterns are
+    added to the FATAL_ERROR pattern.
+    """
+    def __init__( self, module, target="xc9500", optimize="area", constraints="",
+                  project_file="", directory="", source_dir=".", toolargs=None,
+                  keephierarchy=False, fresh=False, all_sources=False, goals=(),
+                  abort_patterns=(), synth_cache="", synth_cache_size=2048, store="",
+                  store_keep=20, gatesim="", metrics="", verbose=False, noexecute=False,
+                  pin_check=True, boards=(), show_profile=False ):
+        self.module = module
+        self.target = target
+        self.optimize = optimize
+        self.constraints = constraints
+        self.project_file = project_file
+        self.directory = directory
+        self.source_dir = source_dir
+        self.toolargs = dict(toolargs or {})
+        self.keephierarchy = keephierarchy
+        self.fresh = fresh
+        self.all_sources = all_sources
+        self.goals = list(goals)
+        self.abort_patterns = list(abort_patterns)
+        self.synth_cache = synth_cache
+        self.synth_cache_size = synth_cache_size
+        self.store = store
+        self.store_keep = store_keep
+        self.gatesim = gatesim
+        self.metrics = metrics
+        self.verbose = verbose
+        self.noexecute = noexecute
+        self.pin_check = pin_check
+        self.boards = list(boards)
+        self.show_profile = show_profile
+
+class Flow(object):
+    """
+    The state of one build: its options, taken from a BuildConfig with the
+    paths made absolute, the steps of its flow, the step manifest and hashes,
+    its profile and the file its messages go to (stdout if log is None).
+    launch runs each command, see popen_launch(), and stopping is set to
+    stop the flow starting any more steps or commands.
+    """
+    def __init__( self, config ):
+        self.source_dir = os.path.abspath(config.source_dir)
+        path = lambda p: os.path.join(self.source_dir, p) if p != "" else ""
+        self.module = config.module
+        self.target = config.target.lower()
+        self.optimize = config.optimize.lower()
+        self.constraints = path(config.constraints.replace("%m", self.module))
+        self.project_file = path(config.project_file)
+        self.directory = path(config.directory or "%s-%s-%s" % (self.module, self.target, timestamp()))
+        self.toolargs = dict(config.toolargs)
+        self.keephierarchy = "Yes" if config.keephierarchy else "No"
+        self.fresh = config.fresh
+        self.all_sources = config.all_sources
+        self.goals = list(config.goals)
+        self.abort_patterns = [ r"^FATAL_ERROR" ] + list(config.abort_patterns)
+        self.synth_cache = path(config.synth_cache)
+        self.synth_cache_size = config.synth_cache_size
+        self.store = path(config.store)
+        self.store_keep = config.store_keep
+        self.gatesim = path(config.gatesim)
+        self.metrics = path(config.metrics)
+        self.verbose = config.verbose
+        self.noexecute = config.noexecute
+        self.pin_check = config.pin_check
+        self.boards = [ path(b) for b in config.boards ]
+        self.show_profile = config.show_profile
+        self.fpga_flow = is_fpga_target(self.target)
+
+        self.steps = []
+        self.include_files = []
+        # Step cache state: manifest of step input hashes/outputs, and the input
+        # hash of each step run so far, which is included in the hashes of the
+        # steps that depend on it so that any change invalidates everything downstream
+        self.manifest = dict()
+        self.step_hashes = dict()
+        self.lock = threading.Lock()
+        self.running = 0
+        self.profile = []
+        self.log = None
+        self.launch = popen_launch
+        self.stopping = False
+
+def current_config():
+    """
+    Return a BuildConfig for the build set up by the command line options.
+    """
+    return BuildConfig( g_module, target=g_target, optimize=g_optimize, constraints=g_constraints,
+                        project_file=g_project_file, directory=g_directory,
+                        source_dir=g_source_dir, toolargs=g_toolargs,
+                        keephierarchy=(g_keephierarchy == "Yes"), fresh=g_fresh,
+                        all_sources=g_all_sources, goals=g_goals,
+                        abort_patterns=g_abort_patterns[1:], synth_cache=g_synth_cache,
+                        synth_cache_size=g_synth_cache_size, store=g_store,
+                        store_keep=g_store_keep, gatesim=g_gatesim, metrics=g_metrics,
+                        verbose=g_verbose, noexecute=g_noexecute, pin_check=g_pin_check,
+                        boards=g_boards, show_profile=g_show_profile )
+
+def start_build( config ):
+    """
+    Return the Flow for a build described by a BuildConfig, with its working
+    directory prepared and its messages going to build.log there.
+    """
+    flow = Flow(config)
+    prepare_directory(flow)
+    flow.log = open(os.path.join(flow.directory, "build.log"), 'w')
+    return flow
 
-    for step in steps :
-        if not step():
-            print "ERROR - completed with errors, check log files"
-            sys.exit(1) 
+def run_build( flow ):
+    """
+    Run the build of a Flow from start_build(), close its log and return a
+    BuildResult.
+    """
+    start = time.time()
+    try:
+        ok = main_loop(flow)
+    except Exception as e:
+        log_message (flow, "ERROR: %s" % e)
+        ok = False
+    finally:
+        flow.log.close()
+    return BuildResult( ok=ok, directory=flow.directory, elapsed=time.time() - start,
+                        log=flow.log.name, reports=reports.build_reports(flow.directory, flow.module),
+                        profile=list(flow.profile) )
+
+def build( config ):
+    """
+    Run a build described by a BuildConfig in this process and return a
+    BuildResult. Safe to call from several threads at once, as long as each
+    build has its own working directory.
+    """
+    return run_build( start_build(config) )
+
+def build_async( config ):
+    """
+    Return a coroutine which runs a build described by a BuildConfig in the
+    running asyncio event loop and returns a BuildResult. The tools are run as
+    asyncio subprocesses; cancelling the coroutine kills them and fails the
+    build. Python 3 only, see asyncbuild.py.
+    """
+    import asyncbuild
+    return asyncbuild.build(config, start_build, run_build)
+
+def result_to_json( result ):
+    """
+    Return a BuildResult as a dictionary which can be saved as JSON.
+    """
+    entry = dict(result._asdict())
+    entry["reports"] = reports_to_json(result.reports)
+    return entry
+
+def sweep_build( combination ):
+    """
+    Run a single build of a sweep in a worker process. Returns a tuple of the
+    combination, its directory, a success flag, elapsed time and the parsed
+    reports.
+    """
+    global g_module, g_target, g_optimize, g_constraints, g_fpga_flow
+    (g_module, g_target, g_optimize) = combination
+    g_constraints = g_constraints.replace("%m", g_module)
+    g_fpga_flow = is_fpga_target(g_target)
+    return (combination,) + isolated_build( os.path.join(g_directory, "%s-%s-%s" % combination) )
+
+def sweep( modules, targets, optimizations ):
+    """
+    Build every module x target x optimization combination in a bounded pool of
+    worker processes and print a summary table. Return True if all builds passed.
+    """
+    combinations = [ (m, t, o) for m in modules for t in targets for o in optimizations ]
+    jobs = g_jobs if g_jobs > 0 else multiprocessing.cpu_count()
+    print ("INFO: Sweeping %d builds, %d at a time, in %s ..." % \
+        (len(combinations), jobs, g_directory))
+    if not os.path.exists(g_directory):
+        os.makedirs(g_directory)
+
+    # Workers modify the globals and redirect their output, so use a fresh
+    # process for every build
+    pool = multiprocessing.Pool(processes=min(jobs, len(combinations)), maxtasksperchild=1)
+    results = []
+    try:
+        for result in pool.imap_unordered(sweep_build, combinations):
+            results.append(result)
+            print ("INFO: [%d/%d] %s %s" % (len(results), len(combinations),
+                                            "-".join(result[0]), "ok" if result[2] else "FAILED"))
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    pool.join()
+
+    results.sort()
+    print ("")
+    print ("%-20s %-20s %-8s %-6s %8s %-10s %8s  %s" % \
+        ("Module", "Target", "Optimize", "Result", "Time(s)", "Usage", "Worst ns", "Directory"))
+    print ("-" * 120)
+    for (combination, directory, ok, elapsed, parsed) in results:
+        if parsed["fit"] is not None:
+            usage = reports.format_usage(parsed["fit"].macrocells)
         else:
-            print "INFO: Done"
-    return
+            usage = reports.format_usage(parsed["luts"])
+        worst = parsed["timing"].worst_delay if parsed["timing"] is not None else None
+        print ("%-20s %-20s %-8s %-6s %8.1f %-10s %8s  %s" % \
+            (combination + ("PASS" if ok else "FAIL", elapsed, usage,
+                            reports.format_value(worst), directory)))
+    failures = len([ r for r in results if not r[2] ])
+    print ("-" * 120)
+    print ("%d passed, %d failed" % (len(results) - failures, failures))
+    return failures == 0
+
+def parse_variant( spec ):
+    """
+    Parse a variant given as '[name:]DEFINE,DEFINE=value,...' and return a
+    (name, defines) tuple. The name defaults to the defines joined by '_', or
+    'base' for a variant with no defines.
+    """
+    name = ""
+    if ":" in spec:
+        (name, spec) = spec.split(":", 1)
+    defines = [ d.strip() for d in spec.split(",") if d.strip() != "" ]
+    if name == "":
+        name = "_".join( d.split("=")[0] for d in defines ) or "base"
+    return (name, defines)
+
+def add_defines( arg_string, defines ):
+    """
+    Add Verilog defines to a string of xst arguments, merging them into any
+    -define option already there since xst only uses one.
+    """
+    if not defines:
+        return arg_string
+    m = re.search(r"-define\s*\{([^}]*)\}", arg_string)
+    if m is None:
+        return "%s -define {%s}" % (arg_string, " ".join(defines))
+    merged = " ".join(m.group(1).split() + defines)
+    return arg_string[:m.start()] + "-define {%s}" % merged + arg_string[m.end():]
+
+def xst_defines( arg_string ):
+    """
+    Return the Verilog defines in a string of xst arguments as a dictionary of
+    name to value, "" for a define without one.
+    """
+    m = re.search(r"-define\s*\{([^}]*)\}", arg_string)
+    if m is None:
+        return dict()
+    return dict( (d.split("=", 1) + [""])[:2] for d in m.group(1).split() )
+
+def variant_macros():
+    """
+    Return the set of macro names referred to by the module's sources.
+    """
+    flow = Flow(current_config())
+    if g_project_file != "":
+        sources = [ f for f in project_sources(flow) if f.endswith(".v") ]
+    else:
+        sources = [ f for f in project_candidates(flow) if f.endswith(".v") ]
+    macros = set()
+    for filename in sources:
+        macros.update(verilog.scan_file(filename).macros)
+    return macros
+
+def variant_build( variant ):
+    """
+    Build one variant in a worker process. Returns a tuple of the variant, its
+    directory, a success flag, elapsed time and the parsed reports.
+    """
+    global g_constraints
+    (name, defines) = variant
+    g_constraints = g_constraints.replace("%v", name)
+    g_toolargs["xst"] = add_defines(g_toolargs.get("xst", ""), defines)
+    return (variant,) + isolated_build( os.path.join(g_directory, name) )
+
+def variants( specs ):
+    """
+    Build every variant (a list of (name, defines) tuples) of the module from
+    the same sources, concurrently, and print their fit and timing side by
+    side. Defines which none of the sources refer to are dropped, and variants
+    left with the same defines and constraints share a single build. Return True if all builds
+    passed.
+    """
+    if not os.path.exists(g_directory):
+        os.makedirs(g_directory)
+    macros = variant_macros()
+    groups = collections.OrderedDict()
+    for (name, defines) in specs:
+        used = tuple(sorted( d for d in defines if d.split("=")[0] in macros ))
+        unused = [ d for d in defines if d.split("=")[0] not in macros ]
+        if unused:
+            print ("INFO: variant %s: %s not used by any source of %s" % \
+                (name, " ".join(unused), g_module))
+        # Variants can only share a build if they share a constraints file too
+        groups.setdefault((used, g_constraints.replace("%v", name)), []).append(name)
+    builds = [ (names[0], list(used)) for ((used, constraints), names) in groups.items() ]
+    jobs = g_jobs if g_jobs > 0 else multiprocessing.cpu_count()
+    print ("INFO: Building %d variants as %d builds, %d at a time, in %s ..." % \
+        (len(specs), len(builds), jobs, g_directory))
+
+    pool = multiprocessing.Pool(processes=min(jobs, len(builds)), maxtasksperchild=1)
+    results = dict()
+    try:
+        for result in pool.imap_unordered(variant_build, builds):
+            results[result[0][0]] = result
+            print ("INFO: [%d/%d] %s %s" % (len(results), len(builds), result[0][0],
+                                            "ok" if result[2] else "FAILED"))
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    pool.join()
+
+    # One column per variant, sharing the results of the build they map to
+    columns = []
+    for ((used, constraints), names) in groups.items():
+        for name in names:
+            columns.append((name, used, results[names[0]]))
+    rows = [ ("Defines", lambda u, r: " ".join(u) or "-"),
+             ("Built in", lambda u, r: os.path.basename(r[1])),
+             ("Result", lambda u, r: "PASS" if r[2] else "FAIL"),
+             ("Time(s)", lambda u, r: "%.1f" % r[3]),
+             ("Macrocells", lambda u, r: reports.format_usage(r[4]["fit"].macrocells if r[4]["fit"] else None)),
+             ("Pterms", lambda u, r: reports.format_usage(r[4]["fit"].pterms if r[4]["fit"] else None)),
+             ("Registers", lambda u, r: reports.format_usage(r[4]["fit"].registers if r[4]["fit"] else None)),
+             ("Pins", lambda u, r: reports.format_usage(r[4]["fit"].pins if r[4]["fit"] else None)),
+             ("LUTs", lambda u, r: reports.format_usage(r[4]["luts"])),
+             ("Worst ns", lambda u, r: reports.format_value(r[4]["timing"].worst_delay if r[4]["timing"] else None)),
+             ("Fmax MHz", lambda u, r: reports.format_value(r[4]["timing"].fmax if r[4]["timing"] else None)) ]
+    print ("")
+    print ("%-12s" % "Variant" + "".join( " %-20s" % name[:20] for (name, used, result) in columns ))
+    print ("-" * (12 + 21 * len(columns)))
+    for (label, value) in rows:
+        print ("%-12s" % label + "".join( " %-20s" % value(used, result)[:20]
+                                         for (name, used, result) in columns ))
+    failures = len([ r for r in results.values() if not r[2] ])
+    print ("-" * (12 + 21 * len(columns)))
+    print ("%d builds passed, %d failed" % (len(results) - failures, failures))
+    return failures == 0
+
+# Speed grades of each CPLD family, fastest first
+SPEED_GRADES = { "xc9500"   : [ "5", "6", "7", "10", "15", "20" ],
+                 "xc9500xl" : [ "4", "5", "7", "10" ],
+                 "xc9500xv" : [ "4", "5", "7" ],
+                 "acr2"     : [ "3", "4", "5", "6", "7" ],
+                 "xpla3"    : [ "5", "7", "10" ] }
+
+re_cpld_device = re.compile(r"^(xc\w+|xcr\w+)-(\d+)-(\w+)$")
+
+def faster_targets( target ):
+    """
+    Return the same CPLD device in each faster speed grade, slowest first, or
+    [] if the target isn't a specific CPLD device.
+    """
+    m = re_cpld_device.match(target)
+    grades = SPEED_GRADES.get(device_family(target), [])
+    if m is None or m.group(2) not in grades:
+        return []
+    faster = grades[:grades.index(m.group(2))]
+    return [ "%s-%s-%s" % (m.group(1), g, m.group(3)) for g in reversed(faster) ]
+
+def closure_strategies():
+    """
+    Return the prioritized list of (name, build.py arguments) to try for timing
+    closure: the build as given, then changes of optimization, hierarchy and
+    fitter limits, then each faster speed grade of the device.
+    """
+    strategies = [ ("as-given", []),
+                   ("speed", [ "-o", "speed" ]),
+                   ("speed-keephier", [ "-o", "speed", "-k" ]),
+                   ("area", [ "-o", "area" ]) ]
+    if not g_fpga_flow:
+        for (inputs, pterms) in ( (36, 30), (28, 20), (24, 15) ):
+            strategies.append(("speed-in%d-pt%d" % (inputs, pterms),
+                               [ "-o", "speed", "-a", "cpldfit: -inputs %d -pterms %d" % (inputs, pterms) ]))
+    for target in faster_targets(g_target):
+        strategies.append(("speed-%s" % target, [ "-o", "speed", "-t", target ]))
+    return strategies
+
+def closure_base_args():
+    """
+    Return the build.py arguments given on the command line, less those which
+    only make sense for the closure search itself.
+    """
+    opts, args = getopt.getopt(g_argv, SHORT_OPTIONS, LONG_OPTIONS)
+    base = []
+    for (opt, arg) in opts:
+        if opt in ( "-d", "--dir", "-j", "--jobs", "--closure", "-f", "--fresh" ):
+            continue
+        if opt in ( "-c", "--constraints", "-p", "--project", "-S", "--synth-cache", "-M", "--metrics",
+                    "--store", "--gatesim", "--board" ):
+            # Keep the saved options usable from another directory
+            arg = os.path.abspath(arg)
+        base.append(opt)
+        if opt.lstrip("-") + "=" in LONG_OPTIONS or \
+           (len(opt) == 2 and SHORT_OPTIONS.find(opt[1] + ":") > -1):
+            base.append(arg)
+    return base
+
+def closure_result( ok, parsed ):
+    """
+    Return (met, delay) for a finished candidate: whether it fitted and its
+    worst pad to pad delay (or worst delay if there is none) is within the goal.
+    """
+    fit = parsed["fit"]
+    timing = parsed["timing"]
+    delay = None
+    if timing is not None:
+        delay = timing.pad_to_pad if timing.pad_to_pad is not None else timing.worst_delay
+    met = ok and (fit is None or fit.fitted) and delay is not None and delay <= g_closure
+    return (met, delay)
+
+def closure():
+    """
+    Build the module with each strategy from closure_strategies() in turn, up to
+    g_jobs at a time, until one meets the goal of fitting with a worst pad to
+    pad delay of at most g_closure ns and every strategy before it has finished
+    without meeting it. The other builds are then stopped and the winning
+    arguments saved to <module>.closure.json for reuse with --reuse.
+    Return True if the goal was met.
+    """
+    if not os.path.exists(g_directory):
+        os.makedirs(g_directory)
+    base = closure_base_args()
+    strategies = closure_strategies()
+    jobs = g_jobs if g_jobs > 0 else multiprocessing.cpu_count()
+    print ("INFO: Searching %d strategies, %d at a time, for a fit with worst delay <= %.1f ns in %s ..." % \
+        (len(strategies), jobs, g_closure, g_directory))
+
+    pending = list(strategies)
+    running = dict()                # name -> (Popen, start time)
+    results = collections.OrderedDict( (name, None) for (name, args) in strategies )
+    winner = None
+    try:
+        while winner is None and (pending or running):
+            while pending and len(running) < jobs:
+                (name, extra) = pending.pop(0)
+                directory = os.path.join(g_directory, name)
+                if not os.path.exists(directory):
+                    os.makedirs(directory)
+                command = [ sys.executable, os.path.abspath(__file__).replace(".pyc", ".py") ] + \
+                          base + extra + [ "-d", directory ]
+                log = open(os.path.join(directory, "build.log"), 'w')
+                proc = Popen( command, stdout=log, stderr=STDOUT, **NEW_SESSION )
+                log.close()
+                running[name] = (proc, time.time())
+            time.sleep(0.2)
+            for name in list(running):
+                (proc, start) = running[name]
+                if proc.poll() is None:
+                    continue
+                del running[name]
+                parsed = reports.build_reports(os.path.join(g_directory, name), g_module)
+                (met, delay) = closure_result(proc.returncode == 0, parsed)
+                results[name] = (proc.returncode == 0, met, delay, time.time() - start, parsed)
+                print ("INFO: %s %s" % (name, "meets the goal" if met else
+                                        "worst delay %s ns" % reports.format_value(delay)
+                                        if proc.returncode == 0 else "FAILED"))
+            # The winner is the first strategy in priority order to meet the goal,
+            # whichever finishes first, so wait for all those before it
+            for (name, extra) in strategies:
+                if results[name] is None:
+                    break
+                if results[name][1]:
+                    winner = (name, base + extra)
+                    break
+    finally:
+        for name in running:
+            os.killpg(running[name][0].pid, signal.SIGTERM)
+            running[name][0].wait()
+            print ("INFO: stopped %s" % name)
+
+    print ("")
+    print ("%-32s %-8s %-8s %10s %8s" % ("Strategy", "Result", "Goal", "Worst ns", "Time(s)"))
+    print ("-" * 72)
+    for (name, result) in results.items():
+        if result is None:
+            print ("%-32s %-8s" % (name, "stopped" if name in running else "not run"))
+            continue
+        (ok, met, delay, elapsed, parsed) = result
+        print ("%-32s %-8s %-8s %10s %8.1f" % (name, "PASS" if ok else "FAIL", "met" if met else "-",
+                                               reports.format_value(delay), elapsed))
+    print ("-" * 72)
+
+    if winner is None:
+        print ("ERROR: no strategy met the goal of %.1f ns" % g_closure)
+        return False
+    (name, args) = winner
+    config = "%s.closure.json" % g_module
+    f = open(config, 'w')
+    json.dump({ "module": g_module, "target": g_target, "goal_ns": g_closure, "strategy": name,
+                "delay_ns": results[name][2], "args": args,
+                "directory": os.path.abspath(os.path.join(g_directory, name)) },
+              f, indent=2, sort_keys=True)
+    f.close()
+    print ("INFO: strategy %s met the goal, saved to %s; rebuild with: build.py --reuse %s" % \
+        (name, config, config))
+    return True
+
+def expand_reuse( argv ):
+    """
+    Replace any '--reuse <file>' in the arguments by the arguments saved in a
+    closure file, so that options given after it still take precedence.
+    """
+    expanded = []
+    i = 0
+    while i < len(argv):
+        if argv[i] == "--reuse" and i + 1 < len(argv):
+            f = open(argv[i + 1], 'r')
+            expanded.extend(json.load(f)["args"])
+            f.close()
+            i += 2
+        elif argv[i].startswith("--reuse="):
+            f = open(argv[i][len("--reuse="):], 'r')
+            expanded.extend(json.load(f)["args"])
+            f.close()
+            i += 1
+        else:
+            expanded.append(argv[i])
+            i += 1
+    return expanded
+
+def parse_explore_space( spec ):
+    """
+    Parse a --space string such as "inputs=16,20 pterms=10,20 optimize=speed fbk=on"
+    into a dictionary of value lists, filling in defaults for missing parameters.
+    """
+    space = dict(g_explore_defaults)
+    for field in spec.split():
+        (name, sep, values) = field.partition("=")
+        if name not in space or values == "":
+            raise ValueError("bad --space parameter '%s'" % field)
+        space[name] = values
+    return { "inputs"   : [ int(v) for v in space["inputs"].split(",") ],
+             "pterms"   : [ int(v) for v in space["pterms"].split(",") ],
+             "optimize" : space["optimize"].split(","),
+             "fbk"      : [ v == "on" for v in space["fbk"].split(",") ] }
+
+def explore_fit_dir( flow, point ):
+    (optimize, feedback, inputs, pterms) = point
+    return os.path.join(flow.directory, "explore", "fit_%s_%s_i%d_p%d" % \
+        (optimize, "fbk" if feedback else "nofbk", inputs, pterms))
+
+def explore_start_fit( flow, point ):
+    """
+    Launch cpldfit for one point in the parameter space in its own directory,
+    against the shared .ngd, and return the Popen object.
+    """
+    (optimize, feedback, inputs, pterms) = point
+    fitdir = explore_fit_dir(flow, point)
+    if os.path.exists(fitdir):
+        remove_dir_contents(fitdir)
+    else:
+        os.makedirs(fitdir)
+    ngd = "%s.ngd" % flow.module
+    shutil.copyfile(os.path.join(flow.directory, ngd), os.path.join(fitdir, ngd))
+
+    runfile = "run_cpldfit_%s.sh" % flow.module
+    create_run_file( flow, runfile, cpldfit_command_list(flow, optimize, inputs, pterms, feedback), fitdir )
+    log = open(os.path.join(fitdir, "cpldfit.log"), 'w')
+    # Run in a new session so that the shell and fitter can be killed together
+    proc = Popen( "./%s" % runfile, cwd=fitdir, shell=True, stdout=log, stderr=STDOUT,
+                  **NEW_SESSION )
+    log.close()
+    return proc
+
+def explore( flow ):
+    """
+    Synthesize the design of a flow once, then fit it with every combination of cpldfit
+    settings in the parameter space, g_jobs fits at a time, tightest first.
+    With g_explore_prune, once the fitter reports that a point doesn't fit,
+    the points with the same optimization and feedback settings and at least
+    as many inputs and pterms are skipped or cancelled. A fit which fails
+    without a report saying so, eg because cpldfit crashed, prunes nothing.
+    Return True if any point fits.
+    """
+    if flow.fpga_flow:
+        print ("ERROR: --explore is only available for CPLD targets")
+        return False
+    if flow.fresh and os.path.exists(flow.directory) :
+        remove_dir_contents(flow.directory)
+    create_files(flow)
+    load_manifest(flow)
+    flow.step_hashes.clear()
+    flow.steps = flow_steps(flow)
+    if not run_flow( flow, goal_steps( flow, ["ngd"] ) ):
+        print ("ERROR - completed with errors, check log files")
+        return False
+    if flow.noexecute:
+        return True
+
+    space = parse_explore_space(g_explore_space)
+    feedback = space["fbk"] if has_feedback_options(flow) else [ True ]
+    points = list(itertools.product(space["optimize"], sorted(set(feedback)),
+                                    space["inputs"], space["pterms"]))
+    points.sort(key=lambda p: p[2] + p[3])
+    jobs = g_jobs if g_jobs > 0 else multiprocessing.cpu_count()
+    print ("INFO: Exploring %d cpldfit settings for %s, %d at a time ..." % \
+        (len(points), flow.target, jobs))
+
+    def dominated( point, failure ):
+        return point[:2] == failure[:2] and point[2] >= failure[2] and point[3] >= failure[3]
+
+    pending = list(points)
+    running = dict()
+    results = dict()
+    try:
+        while pending or running:
+            while pending and len(running) < jobs:
+                point = pending.pop(0)
+                running[point] = explore_start_fit(flow, point)
+            time.sleep(0.1)
+            for (point, proc) in list(running.items()):
+                if point not in running or proc.poll() is None:
+                    continue
+                del running[point]
+                report = reports.parse_fitter_report(
+                    os.path.join(explore_fit_dir(flow, point), "%s.rpt" % flow.module))
+                if proc.returncode == 0 and report is not None and report.fitted:
+                    results[point] = ("PASS", report)
+                    continue
+                if report is None or report.fitted:
+                    # cpldfit failed without reporting that the design doesn't fit
+                    results[point] = ("ERROR", report)
+                    continue
+                results[point] = ("FAIL", report)
+                if not g_explore_prune:
+                    continue
+                for p in [ p for p in pending if dominated(p, point) ]:
+                    pending.remove(p)
+                    results[p] = ("PRUNED", None)
+                for p in [ p for p in running if dominated(p, point) ]:
+                    os.killpg(running[p].pid, signal.SIGTERM)
+                    running.pop(p).wait()
+                    results[p] = ("PRUNED", None)
+    finally:
+        for proc in running.values():
+            os.killpg(proc.pid, signal.SIGTERM)
+            proc.wait()
+
+    print ("")
+    print ("%-8s %-5s %6s %6s %-6s %-10s %-10s %-10s %-10s" % \
+        ("Optimize", "Fbk", "Inputs", "Pterms", "Result", "Macrocells", "PT used", "FB Inps", "Pins"))
+    print ("-" * 80)
+    for point in points:
+        (status, report) = results[point]
+        if report is None:
+            usage = ("-",) * 4
+        else:
+            usage = tuple( reports.format_usage(r) for r in
+                           (report.macrocells, report.pterms, report.fb_inputs, report.pins) )
+        print ("%-8s %-5s %6d %6d %-6s %-10s %-10s %-10s %-10s" % \
+            ((point[0], "on" if point[1] else "off", point[2], point[3], status) + usage))
+    count = lambda status: len([ r for r in results.values() if r[0] == status ])
+    passes = count("PASS")
+    print ("-" * 80)
+    print ("%d fitted, %d failed, %d errors, %d pruned" % \
+        (passes, count("FAIL"), count("ERROR"), count("PRUNED")))
+    return passes > 0
 
 
     
+SHORT_OPTIONS = "m:p:t:c:o:d:a:j:M:A:g:S:V:kfhvnsxP"
+LONG_OPTIONS = ["module=","project=","target=",
+                "constraints=", "optimize=","dir=",
+                "toolargs=","keephierarchy","fresh", "help", "verbose", "no-execute",
+                "sweep", "jobs=", "explore", "space=", "metrics=", "abort-on=", "profile", "goal=",
+                "synth-cache=", "synth-cache-size=", "all-sources", "variant=", "closure=",
+                "gatesim=", "store=", "store-keep=", "json", "board=", "no-pin-check", "prune"]
+
 def main ( argv ) :
-    print ( "Executing build.py ", sys.argv ) ;
+    if len(argv) > 3 and argv[1] == "--profile-tool":
+        profile_tool( argv[2], argv[3:] )
+    if "--json" not in argv:
+        print ( "Executing build.py ", sys.argv ) ;
     global g_directory
     global g_noexecute
     global g_verbose
@@ -501,13 +2355,35 @@ def main ( argv ) :
     global g_keephierarchy
     global g_fresh
     global g_fpga_flow
+    global g_sweep
+    global g_jobs
+    global g_explore
+    global g_explore_space
+    global g_explore_prune
+    global g_metrics
+    global g_show_profile
+    global g_goals
+    global g_synth_cache
+    global g_synth_cache_size
+    global g_store
+    global g_store_keep
+    global g_all_sources
+    global g_variants
+    global g_closure
+    global g_gatesim
+    global g_json
+    global g_pin_check
+    global g_argv
 
     ## Use getopts to process arguments
     try:
-        opts, args = getopt.getopt( argv[1:], "m:p:t:c:o:d:a:kfhvn",
-                                     ["module=","project=","target=",
-                                     "constraints=", "optimize=","dir=",
-                                     "toolargs=","keephierarchy","fresh", "help", "verbose", "no-execute"])
+        argv = argv[:1] + expand_reuse(argv[1:])
+    except (IOError, ValueError, KeyError) as e:
+        print ("ERROR: can't read the --reuse file: %s" % e)
+        sys.exit(1)
+    g_argv = argv[1:]
+    try:
+        opts, args = getopt.getopt( argv[1:], SHORT_OPTIONS, LONG_OPTIONS)
     except getopt.GetoptError:
         usage()
         sys.exit(0)
@@ -527,8 +2403,12 @@ def main ( argv ) :
         if opt in ( "-d", "--directory", "--dir" ) :
             g_directory = arg
         if opt in ( "-a", "--toolargs" ) :
-            fields = (arg).split(":")
-            g_toolargs[fields[0].lower()] = fields[1]
+            fields = (arg).split(":", 1)
+            tool = fields[0].strip().lower()
+            if tool in g_toolargs:
+                g_toolargs[tool] += " " + fields[1]
+            else:
+                g_toolargs[tool] = fields[1]
         if opt in ( "-k", "--keephierarchy" ) :
             g_keephierarchy = "Yes"
         if opt in ( "-f", "--fresh" ) :
@@ -537,6 +2417,51 @@ def main ( argv ) :
             g_verbose = True
         if opt in ( "-n", "--no-execute" ) :
             g_noexecute = True
+        if opt in ( "-s", "--sweep" ) :
+            g_sweep = True
+        if opt in ( "-j", "--jobs" ) :
+            g_jobs = int(arg)
+        if opt in ( "-x", "--explore" ) :
+            g_explore = True
+        if opt in ( "--space", ) :
+            g_explore_space = arg
+        if opt in ( "--prune", ) :
+            g_explore_prune = True
+        if opt in ( "-M", "--metrics" ) :
+            g_metrics = arg
+        if opt in ( "-S", "--synth-cache" ) :
+            g_synth_cache = os.path.abspath(arg)
+        if opt in ( "--synth-cache-size", ) :
+            g_synth_cache_size = int(arg)
+        if opt in ( "--store", ) :
+            g_store = os.path.abspath(arg)
+        if opt in ( "--store-keep", ) :
+            g_store_keep = int(arg)
+        if opt in ( "-V", "--variant" ) :
+            g_variants.append(parse_variant(arg))
+        if opt in ( "--closure", ) :
+            g_closure = float(arg)
+        if opt in ( "--gatesim", ) :
+            g_gatesim = os.path.abspath(arg)
+        if opt in ( "--all-sources", ) :
+            g_all_sources = True
+        if opt in ( "--json", ) :
+            g_json = True
+        if opt in ( "--board", ) :
+            g_boards.append(os.path.abspath(arg))
+        if opt in ( "--no-pin-check", ) :
+            g_pin_check = False
+        if opt in ( "-g", "--goal" ) :
+            g_goals = arg.split(",")
+        if opt in ( "-P", "--profile" ) :
+            g_show_profile = True
+        if opt in ( "-A", "--abort-on" ) :
+            try:
+                re.compile(arg)
+            except re.error:
+                print ("ERROR: bad --abort-on pattern '%s'" % arg)
+                sys.exit(1)
+            g_abort_patterns.append(arg)
         if opt in ( "-h","--help" ) :            
             usage()
             sys.exit(0)
@@ -545,15 +2470,57 @@ def main ( argv ) :
     if ( g_module == "" ) :
         usage()
         sys.exit(1)
-    if (g_directory == "" ) :
-        g_directory = "%s-%s-%s" % ( g_module, g_target, timestamp())
 
-    g_fpga_flow = ( g_target.startswith("xc3s") or 
-                    g_target.startswith("xc2v") or 
-                    (g_target.find("spartan") > -1))
+    if g_metrics != "":
+        g_metrics = os.path.abspath(g_metrics)
+
+    if g_json and (g_sweep or g_variants or g_explore or g_closure is not None):
+        print ("ERROR: --json can't be used with --sweep, --variant, --explore or --closure")
+        sys.exit(1)
+
+    if g_sweep:
+        if g_variants:
+            print ("ERROR: --variant can't be used with --sweep")
+            sys.exit(1)
+        if (g_directory == "" ) :
+            g_directory = "sweep-%s" % timestamp()
+        ok = sweep( g_module.split(","), g_target.split(","), g_optimize.split(",") )
+        sys.exit(0 if ok else 1)
 
-    main_loop()
-    sys.exit(0)
+    if (g_directory == "" ) :
+        g_directory = "%s-%s-%s" % ( g_module, g_target, timestamp())
+    g_constraints = g_constraints.replace("%m", g_module)
+    g_fpga_flow = is_fpga_target(g_target)
+
+    if g_json:
+        result = build( current_config() )
+        print (json.dumps(result_to_json(result), indent=2, sort_keys=True))
+        sys.exit(0 if result.ok else 1)
+
+    if g_closure is not None:
+        if g_explore or g_variants:
+            print ("ERROR: --closure can't be used with --explore or --variant")
+            sys.exit(1)
+        ok = closure()
+        sys.exit(0 if ok else 1)
+
+    if g_variants:
+        if g_explore:
+            print ("ERROR: --variant can't be used with --explore")
+            sys.exit(1)
+        ok = variants( g_variants )
+        sys.exit(0 if ok else 1)
+
+    if g_explore:
+        try:
+            parse_explore_space(g_explore_space)
+        except ValueError as e:
+            print ("ERROR: %s" % e)
+            sys.exit(1)
+        ok = explore( Flow(current_config()) )
+    else:
+        ok = main_loop( Flow(current_config()) )
+    sys.exit(0 if ok else 1)
     
 if __name__ == "__main__":
     main( sys.argv)
@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+## **************************************************************************
+##   buildd.py - persistent local build server for build.py
+##
+##   COPYRIGHT 2010 Richard Evans, Ed Spittles
+##
+##   buildd.py is free software: you can redistribute it and/or modify
+##   it under the terms of the GNU Lesser General Public License as published by
+##   the Free Software Foundation, either version 3 of the License, or
+##   (at your option) any later version.
+##
+##   tube is distributed in the hope that it will be useful,
+##   but WITHOUT ANY WARRANTY; without even the implied warranty of
+##   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##   GNU Lesser General Public License for more details.
+##
+##   You should have received a copy of the GNU Lesser General Public License
+##   along with tube.  If not, see <http://www.gnu.org/licenses/>.
+##
+## **************************************************************************
+"""
+buildd.py
+
+     Long running build server which accepts build.py requests over a Unix
+     socket, keeps a warm working directory for each distinct build, merges
+     identical requests which are already queued or running, and runs queued
+     builds a configurable number at a time.
+
+"""
+
+from __future__ import print_function
+
+import collections, getopt, hashlib, json, os, os.path, socket, sys, threading, time
+from subprocess import Popen, PIPE, STDOUT
+
+try:
+    import socketserver
+    import queue
+except ImportError:
+    import SocketServer as socketserver
+    import Queue as queue
+
+import build
+
+g_socket = os.path.join(os.path.expanduser("~"), ".beeb816-buildd.sock")
+g_workroot = os.path.join(os.path.expanduser("~"), ".beeb816-buildd")
+g_jobs = 2
+
+
+def usage() :
+    print (__doc__ + """
+  USAGE:
+
+    buildd.py serve  [-s|--socket <path>] [-j|--jobs <n>] [-w|--workroot <dir>]
+    buildd.py submit [-s|--socket <path>] -- <build.py options>
+    buildd.py status [-s|--socket <path>]
+    buildd.py stop   [-s|--socket <path>]
+
+  COMMANDS
+
+    serve     Run the server in the foreground. Each build runs build.py in a
+              process of its own, at most -j at a time (default %d).
+    submit    Queue a build with the given build.py options, relative to the
+              current directory, stream its output and exit with its status.
+              An identical request from the same directory which is already
+              queued or running is joined rather than started again.
+    status    List the queued, running and recently finished builds.
+    stop      Stop the server once the running builds have finished. Queued
+              builds fail, and new ones are refused straight away.
+
+  OPTIONAL SWITCHES
+
+    -s --socket <path>       Socket to serve on or connect to. Default is
+                             %s
+    -j --jobs <n>            Number of builds to run at once.
+    -w --workroot <dir>      Where to keep working directories for builds
+                             submitted without -d. Default is
+                             %s
+
+  A build submitted without -d gets a working directory under the workroot
+  named from the module, target and a hash of the request, and keeps it, so
+  later builds of the same thing only rerun the steps whose inputs changed.
+    """ % (g_jobs, g_socket, g_workroot))
+    return
+
+
+class Job(object):
+    """
+    One build request and the output it has produced so far. Clients following
+    the job wait on cond for more output or for it to finish.
+    """
+    def __init__( self, key, cwd, argv ):
+        self.key = key
+        self.cwd = cwd
+        self.argv = argv
+        self.state = "queued"
+        self.status = None
+        self.lines = []
+        self.clients = 0
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.cond = threading.Condition()
+
+    def add_output( self, line ):
+        with self.cond:
+            self.lines.append(line)
+            self.cond.notify_all()
+
+    def finish( self, status ):
+        with self.cond:
+            self.state = "done"
+            self.status = status
+            self.finished = time.time()
+            self.cond.notify_all()
+
+
+def warm_directory( cwd, argv ):
+    """
+    Return the build.py arguments for a request with a -d option added, if
+    there isn't one, naming a persistent working directory for the request.
+    Sweeps and explorations manage their own directories so are left alone.
+    """
+    try:
+        opts, args = getopt.getopt(argv, build.SHORT_OPTIONS, build.LONG_OPTIONS)
+    except getopt.GetoptError:
+        return argv
+    options = dict(opts)
+    for o in ("-d", "--dir", "-s", "--sweep", "-x", "--explore"):
+        if o in options:
+            return argv
+    module = options.get("-m", options.get("--module", "build"))
+    target = options.get("-t", options.get("--target", build.g_target)).lower()
+    key = hashlib.sha1(json.dumps([ cwd, argv ]).encode()).hexdigest()[:12]
+    return argv + [ "-d", os.path.join(g_workroot, "%s-%s-%s" % (module, target, key)) ]
+
+def run_build( job ):
+    """
+    Run build.py for a job in its own process, in the job's directory, sending
+    its output to the job. A new process rather than a fork of this one, as the
+    server is multithreaded and a forked child could deadlock on a lock held by
+    another thread. Returns the exit status.
+    """
+    script = os.path.abspath(build.__file__).replace(".pyc", ".py")
+    env = dict(os.environ)
+    env["PYTHONUNBUFFERED"] = "1"
+    devnull = open(os.devnull, 'r')
+    try:
+        p = Popen([ sys.executable, script ] + job.argv, cwd=job.cwd, env=env, stdin=devnull,
+                  stdout=PIPE, stderr=STDOUT, universal_newlines=True)
+    finally:
+        devnull.close()
+    for line in iter(p.stdout.readline, ""):
+        job.add_output(line)
+    p.stdout.close()
+    rc = p.wait()
+    # Killed by a signal
+    return rc if rc >= 0 else 1
+
+
+class BuildServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Unix socket server holding the job queue and the worker threads which
+    run it.
+    """
+    daemon_threads = True
+
+    def __init__( self, path, jobs ):
+        socketserver.UnixStreamServer.__init__(self, path, RequestHandler)
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.inflight = dict()          # key -> Job, queued or running
+        self.finished = collections.deque(maxlen=20)
+        self.stopping = False
+        self.workers = [ threading.Thread(target=self.worker) for i in range(jobs) ]
+        for w in self.workers:
+            w.daemon = True
+            w.start()
+
+    def submit( self, cwd, argv ):
+        """
+        Return the Job for a request, joining an identical one already in flight,
+        or None if the server is stopping.
+        """
+        argv = warm_directory(cwd, argv)
+        key = json.dumps([ cwd, argv ])
+        with self.lock:
+            if self.stopping:
+                return None
+            job = self.inflight.get(key)
+            if job is None:
+                job = Job(key, cwd, argv)
+                self.inflight[key] = job
+                self.queue.put(job)
+            job.clients += 1
+        return job
+
+    def worker( self ):
+        while True:
+            job = self.queue.get()
+            job.state = "running"
+            job.started = time.time()
+            if self.stopping:
+                job.add_output("ERROR: build server stopped before the build started\n")
+                status = 1
+            else:
+                try:
+                    status = run_build(job)
+                except Exception as e:
+                    job.add_output("ERROR: %s\n" % e)
+                    status = 1
+            with self.lock:
+                del self.inflight[job.key]
+                self.finished.append(job)
+            job.finish(status)
+
+    def stop( self ):
+        """
+        Refuse new builds from now on, and stop serving once the running ones
+        have finished. Requests are still answered until then.
+        """
+        with self.lock:
+            self.stopping = True
+        def drain_and_shutdown():
+            self.drain()
+            self.shutdown()
+        threading.Thread(target=drain_and_shutdown).start()
+
+    def drain( self ):
+        """
+        Fail any queued builds and wait for the running ones to finish.
+        """
+        with self.lock:
+            self.stopping = True
+        while True:
+            with self.lock:
+                if not self.inflight:
+                    return
+            time.sleep(0.2)
+
+    def jobs( self ):
+        with self.lock:
+            return list(self.finished) + sorted(self.inflight.values(), key=lambda j: j.submitted)
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """
+    Handle one client connection. Requests and replies are JSON, one object
+    per line.
+    """
+    def reply( self, message ):
+        self.wfile.write((json.dumps(message) + "\n").encode())
+        self.wfile.flush()
+
+    def handle( self ):
+        try:
+            request = json.loads(self.rfile.readline().decode())
+        except ValueError:
+            self.reply({ "error": "bad request" })
+            return
+        command = request.get("command")
+        if command == "build":
+            job = self.server.submit(request["cwd"], request["argv"])
+            if job is None:
+                self.reply({ "error": "the build server is stopping" })
+                return
+            self.follow(job)
+        elif command == "status":
+            self.reply({ "jobs": [ { "argv": j.argv, "cwd": j.cwd, "state": j.state,
+                                     "status": j.status, "clients": j.clients,
+                                     "seconds": round((j.finished or time.time()) -
+                                                      (j.started or time.time()), 1) }
+                                   for j in self.server.jobs() ] })
+        elif command == "stop":
+            self.reply({ "stopping": True })
+            self.server.stop()
+        else:
+            self.reply({ "error": "unknown command %s" % command })
+
+    def follow( self, job ):
+        """
+        Send the job's output from the start, then as it arrives, then its status.
+        """
+        self.reply({ "queued": job.state == "queued", "argv": job.argv })
+        sent = 0
+        while True:
+            with job.cond:
+                while sent == len(job.lines) and job.state != "done":
+                    job.cond.wait(1.0)
+                lines = job.lines[sent:]
+                done = job.state == "done"
+            sent += len(lines)
+            for line in lines:
+                self.reply({ "output": line })
+            if done and sent == len(job.lines):
+                break
+        self.reply({ "status": job.status })
+
+
+def serve():
+    if os.path.exists(g_socket):
+        # Refuse to start twice, but clean up after a server which died
+        try:
+            s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            s.connect(g_socket)
+            s.close()
+            print ("ERROR: a build server is already listening on %s" % g_socket)
+            sys.exit(1)
+        except socket.error:
+            os.unlink(g_socket)
+    if not os.path.isdir(g_workroot):
+        os.makedirs(g_workroot)
+    server = BuildServer(g_socket, g_jobs)
+    print ("INFO: serving on %s, %d builds at a time, working directories in %s" % \
+        (g_socket, g_jobs, g_workroot))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print ("INFO: stopping, waiting for running builds to finish")
+    server.drain()
+    server.server_close()
+    os.unlink(g_socket)
+
+def request( message ):
+    """
+    Send a request to the server and yield each reply.
+    """
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(g_socket)
+    except socket.error as e:
+        print ("ERROR: can't connect to the build server on %s: %s" % (g_socket, e))
+        sys.exit(1)
+    s.sendall((json.dumps(message) + "\n").encode())
+    f = s.makefile('rb')
+    for line in iter(f.readline, b""):
+        yield json.loads(line.decode())
+    f.close()
+    s.close()
+
+def submit( argv ):
+    status = 1
+    for reply in request({ "command": "build", "cwd": os.getcwd(), "argv": argv }):
+        if "output" in reply:
+            sys.stdout.write(reply["output"])
+            sys.stdout.flush()
+        elif "queued" in reply:
+            print ("INFO: %s build.py %s" % ("queued" if reply["queued"] else "joined running",
+                                           " ".join(reply["argv"])))
+        elif "status" in reply:
+            status = reply["status"]
+        elif "error" in reply:
+            print ("ERROR: %s" % reply["error"])
+    return status
+
+def status():
+    for reply in request({ "command": "status" }):
+        print ("%-8s %6s %7s %8s  %s" % ("State", "Status", "Clients", "Time(s)", "Build"))
+        print ("-" * 80)
+        for j in reply.get("jobs", []):
+            print ("%-8s %6s %7d %8.1f  %s: build.py %s" % \
+                (j["state"], "-" if j["status"] is None else j["status"], j["clients"],
+                 j["seconds"], j["cwd"], " ".join(j["argv"])))
+
+def main( argv ):
+    global g_socket, g_workroot, g_jobs
+
+    if len(argv) < 2 or argv[1] not in ("serve", "submit", "status", "stop"):
+        usage()
+        sys.exit(1)
+    try:
+        opts, args = getopt.getopt( argv[2:], "s:j:w:h", ["socket=", "jobs=", "workroot=", "help"])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(1)
+    for opt, arg in opts:
+        if opt in ( "-s", "--socket" ):
+            g_socket = os.path.abspath(arg)
+        if opt in ( "-j", "--jobs" ):
+            g_jobs = int(arg)
+        if opt in ( "-w", "--workroot" ):
+            g_workroot = os.path.abspath(arg)
+        if opt in ( "-h", "--help" ):
+            usage()
+            sys.exit(0)
+
+    if argv[1] == "serve":
+        serve()
+    elif argv[1] == "submit":
+        if not args:
+            usage()
+            sys.exit(1)
+        sys.exit(submit(args))
+    elif argv[1] == "status":
+        status()
+    else:
+        for reply in request({ "command": "stop" }):
+            pass
+
+if __name__ == "__main__":
+    main( sys.argv )
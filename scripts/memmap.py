@@ -0,0 +1,486 @@
+#!/usr/bin/env python
+## **************************************************************************
+##   memmap.py - vectorized model of the level1b_mk2_m address decode
+##
+##   COPYRIGHT 2010 Richard Evans, Ed Spittles
+##
+##   memmap.py is free software: you can redistribute it and/or modify
+##   it under the terms of the GNU Lesser General Public License as published by
+##   the Free Software Foundation, either version 3 of the License, or
+##   (at your option) any later version.
+##
+##   tube is distributed in the hope that it will be useful,
+##   but WITHOUT ANY WARRANTY; without even the implied warranty of
+##   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##   GNU Lesser General Public License for more details.
+##
+##   You should have received a copy of the GNU Lesser General Public License
+##   along with tube.  If not, see <http://www.gnu.org/licenses/>.
+##
+## **************************************************************************
+"""
+memmap.py
+
+     A cycle level model of the high address latch, RAM/ROM remapping and
+     register decode in rtl/level1b_mk2_m.v, evaluated with numpy over whole
+     arrays of addresses. It sweeps every 24 bit 65816 address in every
+     mapping mode checking the memory map rules, prints the map of bank 0 and
+     cross-checks the model against the RTL in a VCD dump of the testbench.
+
+"""
+
+from __future__ import print_function
+
+import collections, getopt, itertools, multiprocessing, sys, time
+
+import numpy
+
+# The CPLD registers the decode depends on, as in map_data_q, bbc_pagereg_q,
+# mos_vdu_sync_q and (MARK2B only) mos_vdu_sync_acccon_q, ram_at_8000 and
+# acccon_y. Any field may be a numpy array, to evaluate many states at once.
+State = collections.namedtuple("State", ["host", "shadow", "map_rom", "pagereg", "vdu_sync",
+                                         "vdu_sync_acccon", "ram_at_8000", "acccon_y"])
+
+# The value each cycle latches in cpu_hiaddr_lat_q, cpu_a15/a14_lat_q,
+# write_thru_lat_q and rom_wr_protect_lat_q, and the register selects and IO
+# access flag sampled at the end of the cycle
+Decode = collections.namedtuple("Decode", ["hiaddr", "a15", "a14", "write_thru", "rom_protect",
+                                           "map_cc_sel", "pagereg_sel", "shadow_sel", "io_access"])
+
+# One failed rule of the memory map, in one mapping mode
+Failure = collections.namedtuple("Failure", ["mode", "rule", "count", "example"])
+
+# Host type field of map_data_q[6:5]
+HOSTS = collections.OrderedDict([ ("beeb", 0), ("bplus", 1), ("elk", 2), ("master", 3) ])
+
+# Bus cycle types the register states are swept with: valid program or data
+# addresses, internal operations and native mode interrupt vector pulls
+CYCLES = [ ("", dict(vpa=1, vda=1)), (",internal", dict(vpa=0, vda=0)),
+           (",native_int", dict(vpa=1, vda=1, native_int=1)) ]
+
+PAGED_ROM_SEL = 0xFE30
+ELK_PAGED_ROM_SEL = 0xFE05
+BPLUS_SHADOW_RAM_SEL = 0xFE34
+
+# Signals read from the testbench dump by crosscheck(), under dut0_u
+VCD_INPUTS = [ "cpu_adr", "cpu_data", "cpu_vpa", "cpu_vda", "cpu_vpb", "cpu_e", "map_data_q",
+               "bbc_pagereg_q", "mos_vdu_sync_q" ]
+VCD_MASTER_INPUTS = [ "mos_vdu_sync_acccon_q", "ram_at_8000", "acccon_y" ]
+VCD_OUTPUTS = [ "cpu_hiaddr_lat_d", "cpu_a15_lat_d", "cpu_a14_lat_d", "write_thru_d",
+                "remapped_mos_access_r", "remapped_romAB_access_r", "remapped_romCF_access_r" ]
+
+
+def make_state( host=0, shadow=0, map_rom=0, pagereg=0, vdu_sync=0, vdu_sync_acccon=0,
+                ram_at_8000=0, acccon_y=0 ):
+    return State(host, shadow, map_rom, pagereg, vdu_sync, vdu_sync_acccon, ram_at_8000, acccon_y)
+
+def fill( shape, default, choices ):
+    """
+    Return a uint8 array of the given shape holding default, overridden by the
+    first of the (condition, value) choices which is true at each element, as
+    an if/else if chain would.
+    """
+    out = numpy.empty(shape, dtype=numpy.uint8)
+    out[...] = default
+    for (condition, value) in reversed(choices):
+        numpy.copyto(out, numpy.asarray(value, dtype=numpy.uint8), where=condition)
+    return out
+
+def decode( bank, adr, state, vpa=1, vda=1, native_int=0, mark2b=False ):
+    """
+    Evaluate the decode for the high address byte on cpu_data during PHI1
+    (bank), the CPU address and the cycle type. All arguments broadcast
+    against each other, so eg a (256, 1) array of banks and a (65536,) array
+    of addresses evaluate all 16M addresses at once. mark2b selects the
+    MARK2B build, which adds the BBC Master host. Returns a Decode.
+
+    Only bit 7 of the bank takes part in the remapping, so the remapping is
+    worked out without the bank and combined with it last, keeping the work
+    done at full size to a few operations.
+    """
+    bank = numpy.asarray(bank, dtype=numpy.uint32)
+    adr = numpy.asarray(adr, dtype=numpy.uint32)
+    host = numpy.asarray(state.host)
+    pagereg = numpy.asarray(state.pagereg)
+    bit = lambda value, n: ((value >> n) & 1) == 1
+
+    master = (host == HOSTS["master"]) if mark2b else numpy.zeros(host.shape, dtype=bool)
+    elk = host == HOSTS["elk"]
+    bplus = host == HOSTS["bplus"]
+    host_space = ~bit(bank, 7)
+    (a15, a14, a13, a12) = (bit(adr, 15), bit(adr, 14), bit(adr, 13), bit(adr, 12))
+    valid = (numpy.asarray(vpa) | numpy.asarray(vda)) != 0
+    native_int = numpy.asarray(native_int) != 0
+
+    # ROM remapping, for host space
+    rom = a15 & valid & (numpy.asarray(state.map_rom) != 0)
+    paged = rom & ~a14
+    if mark2b:
+        paged = paged & (a12 | a13 | (numpy.asarray(state.ram_at_8000) == 0))
+    rom_cf = paged & ((pagereg & 0xC) == 0xC)
+    rom_ab = paged & ((pagereg & 0xE) == 0xA)
+    rom_47 = paged & ((pagereg & 0xC) == 0x4)
+    # MOS from C000-FBFF only, not IO space and vectors
+    mos = rom & a14 & ((adr & 0x3C00) != 0x3C00)
+    if mark2b:
+        mos = mos & (a13 | (numpy.asarray(state.acccon_y) == 0))
+
+    # RAM remapping, for host space
+    ram = ~a15
+    lowmem_1k = (adr & 0xFC00) == 0
+    lowmem_12k = ~(a14 | (a13 & a12))
+    shadow = numpy.asarray(state.shadow) != 0
+    vdu_sync = numpy.asarray(state.vdu_sync) != 0
+    vdu_sync_acccon = numpy.asarray(state.vdu_sync_acccon) != 0
+    ram_fd = ram & ~lowmem_1k & ((master & ~lowmem_12k & vdu_sync_acccon) |
+                                 (~master & shadow & ~vdu_sync))
+
+    # The remapped bank, or 0 for none, which is never a remapped bank
+    local = numpy.broadcast(adr, host, pagereg, rom, ram_fd, native_int, shadow, vdu_sync).shape
+    remapped = fill(local, 0, [ (native_int, 0xFF),
+                                (mos, 0xFF),
+                                (ram_fd, 0xFD),
+                                (ram, 0xFF),
+                                (rom_47, 0xFC),
+                                (rom_ab, 0xFD),
+                                (rom_cf, 0xFE) ])
+    remapped_rom = ~native_int & ~mos & ~ram & (rom_47 | rom_ab | rom_cf)
+    write_thru = ~native_int & ~mos & ram & ~lowmem_1k & (master | ~shadow | vdu_sync)
+    fe4x = ((adr >> 4) == 0xFE4) | ((adr >> 9) == 0x7E)
+    shadow_reg = (bplus | master) if mark2b else bplus
+
+    shape = numpy.broadcast(bank, numpy.empty(local, dtype=bool)).shape
+    # Native mode interrupts go to bank FF whatever the bank
+    hiaddr = numpy.where(native_int, numpy.uint8(0xFF),
+                         numpy.where(host_space & (remapped != 0), remapped, bank.astype(numpy.uint8)))
+    remapped_rom = host_space & remapped_rom
+    return Decode(hiaddr=hiaddr,
+                  a15=numpy.where(remapped_rom, bit(pagereg, 1), a15),
+                  a14=numpy.where(remapped_rom, bit(pagereg, 0), a14),
+                  write_thru=numpy.broadcast_to(host_space & write_thru, shape),
+                  rom_protect=numpy.broadcast_to(host_space & (mos | rom_cf | rom_ab), shape),
+                  map_cc_sel=numpy.broadcast_to((bank & 0xC0) == 0x80, shape),
+                  pagereg_sel=numpy.broadcast_to(host_space & numpy.where(
+                      elk, adr == ELK_PAGED_ROM_SEL, adr == PAGED_ROM_SEL), shape),
+                  shadow_sel=numpy.broadcast_to(host_space & shadow_reg &
+                                                (adr == BPLUS_SHADOW_RAM_SEL), shape),
+                  io_access=(hiaddr < 0x80) & fe4x & (numpy.asarray(vda) != 0))
+
+def ram_address( d, adr ):
+    """
+    Return the 19 bit address the RAM sees for a Decode, ie ram_adr[18:14]
+    and the low 14 bits of the CPU address.
+    """
+    return ((d.hiaddr.astype(numpy.uint32) & 7) << 16) | (d.a15.astype(numpy.uint32) << 15) | \
+        (d.a14.astype(numpy.uint32) << 14) | (numpy.asarray(adr, dtype=numpy.uint32) & 0x3FFF)
+
+def modes( mark2b=False ):
+    """
+    Return the mapping modes to sweep, as (name, host, shadow, map_rom).
+    """
+    hosts = list(HOSTS.items()) if mark2b else list(HOSTS.items())[:3]
+    return [ ("%s%s%s" % (name, ",shadow" if shadow else "", ",rom" if map_rom else ""),
+              host, shadow, map_rom)
+             for (name, host) in hosts for shadow in (0, 1) for map_rom in (0, 1) ]
+
+def check_rules( d, banks, adrs, state, native_int=0 ):
+    """
+    Check the rules of the memory map for a Decode of banks x adrs in one
+    or more states. Returns a list of (rule, number of addresses breaking it,
+    index of the first one in the decode).
+    """
+    native = numpy.asarray(native_int) != 0
+    host_space = banks < 0x80
+    remapped = host_space & ~native & (d.hiaddr != banks)
+    rules = [
+        # Native mode interrupts go to bank FF, from any bank
+        ("native interrupt not in bank FF", native & (d.hiaddr != 0xFF)),
+        # 0b11xxxxxx is on-board RAM, passed straight through
+        ("himem address altered", ((banks & 0xC0) == 0xC0) & ~native & (
+            (d.hiaddr != banks) | (d.a15 != (adrs >> 15 & 1)) | (d.a14 != (adrs >> 14 & 1)) |
+            d.write_thru | d.rom_protect)),
+        # 0b10xxxxxx is the CPLD's own register
+        ("register select wrong", d.map_cc_sel != ((banks & 0xC0) == 0x80)),
+        # The bottom 1K is always fast RAM in bank FF, for all hosts
+        ("low 1K not in bank FF", host_space & (adrs < 0x400) & (d.hiaddr != 0xFF)),
+        # IO space and vectors, FC00-FFFF, always go to the host
+        ("IO/vectors remapped", host_space & (adrs >= 0xFC00) & remapped),
+        ("remapped outside banks FC-FF", remapped & (d.hiaddr < 0xFC)),
+        # Sideways RAM in ROM slots 4-7 is the only writable remapped ROM
+        ("remapped ROM writable", remapped & (adrs >= 0x8000) & ~d.rom_protect &
+            ~((adrs < 0xC000) & ((state.pagereg & 0xC) == 0x4))),
+        ("write through outside RAM", d.write_thru & ((adrs >= 0x8000) | ~host_space)),
+    ]
+    if not state.map_rom:
+        rules.append( ("ROM remapped with remapping off", remapped & (adrs >= 0x8000)) )
+    found = []
+    for (rule, bad) in rules:
+        count = int(numpy.count_nonzero(bad))
+        if count:
+            bad = numpy.broadcast_to(bad, d.hiaddr.shape)
+            found.append( (rule, count, numpy.unravel_index(numpy.argmax(bad), bad.shape)) )
+    return found
+
+def register_states( mark2b ):
+    """
+    Return the (label, fields) of the register states swept in each mapping
+    mode besides its mapping register: every ROM page register value, with
+    and without VDU sync, and for the MARK2B the ACCCON bits.
+    """
+    syncs = [ ("", {}), (",vdu", dict(vdu_sync=1)) ]
+    if mark2b:
+        syncs.extend([ (",acccon_x", dict(vdu_sync_acccon=1)), (",acccon_y", dict(acccon_y=1)),
+                       (",ram_at_8000", dict(ram_at_8000=1)) ])
+    return [ ("%s,pagereg=%X" % (label, pagereg), dict(fields, pagereg=pagereg))
+             for (label, fields) in syncs for pagereg in range(16) ]
+
+def sweep_mode( mode ):
+    """
+    Check the memory map rules in one mapping mode, given as (name, host,
+    shadow, map_rom, mark2b): over all 16M addresses with the other registers
+    reset, and over a host bank in every other register state and cycle type,
+    as only bit 7 of the bank takes part in the remapping, and native mode
+    interrupts from every bank. Also check that the paged ROMs land in their
+    own RAM. Returns (number of addresses decoded, list of Failures).
+    """
+    (name, host, shadow, map_rom, mark2b) = mode
+    banks = numpy.arange(256, dtype=numpy.uint8).reshape(256, 1)
+    adrs = numpy.arange(65536, dtype=numpy.uint32)
+    failures = []
+    state = make_state(host=host, shadow=shadow, map_rom=map_rom)
+    for (rule, count, (bank, adr)) in check_rules(decode(banks, adrs, state, mark2b=mark2b),
+                                                  banks, adrs, state):
+        failures.append(Failure(name, rule, count, "%02X%04X" % (bank, adr)))
+    decoded = 1 << 24
+
+    # All the other states at once, one per row
+    rows = [ (state_label + cycle_label, dict(fields, **cycle))
+             for ((state_label, fields), (cycle_label, cycle)) in
+             itertools.product(register_states(mark2b), CYCLES) ]
+    column = lambda field, default: numpy.array([ f.get(field, default) for (l, f) in rows ]).reshape(len(rows), 1)
+    s = state._replace(**dict( (field, column(field, getattr(state, field)))
+                               for field in State._fields if field not in ("host", "shadow", "map_rom") ))
+    native_int = column("native_int", 0)
+    d = decode(0, adrs, s, vpa=column("vpa", 1), vda=column("vda", 1), native_int=native_int,
+               mark2b=mark2b)
+    for (rule, count, (row, adr)) in check_rules(d, 0, adrs, s, native_int):
+        failures.append(Failure(name + rows[row][0], rule, count, "00%04X" % adr))
+    decoded += len(rows) << 16
+
+    # Native mode interrupts from every bank, at the native vectors
+    vectors = numpy.arange(0xFFE0, 0x10000, dtype=numpy.uint32)
+    d = decode(banks, vectors, state, native_int=1, mark2b=mark2b)
+    for (rule, count, (bank, adr)) in check_rules(d, banks, vectors, state, 1):
+        failures.append(Failure(name + ",native_int", rule, count, "%02X%04X" % (bank, vectors[adr])))
+    decoded += 256 * len(vectors)
+
+    # Paged ROMs must each land in their own 16K RAM pages, clear of main and
+    # shadow RAM and the MOS
+    regions = [ ("main RAM", 0x0000, 0x7FFF, state._replace(vdu_sync=1)),
+                ("shadow RAM", 0x0000, 0x7FFF, state._replace(vdu_sync_acccon=1)) ]
+    if map_rom:
+        regions.append( ("MOS", 0xC000, 0xFBFF, state) )
+        regions.extend( ("ROM %X" % p, 0x8000, 0xBFFF, state._replace(pagereg=p)) for p in range(16) )
+    used = dict()
+    for (label, first, last, s) in regions:
+        a = numpy.arange(first, last + 1, dtype=numpy.uint32)
+        d = decode(0, a, s, mark2b=mark2b)
+        inside = d.hiaddr >= 0xFC
+        for page in numpy.unique(ram_address(d, a)[inside] >> 14):
+            used.setdefault(int(page), set()).add(label)
+    for (page, labels) in sorted(used.items()):
+        if len(labels) > 1 and any( l.startswith("ROM") for l in labels ):
+            failures.append(Failure(name, "paged ROM shares RAM with %s" % ", ".join(sorted(labels)),
+                                    len(labels), "RAM %05X" % (page << 14)))
+    return (decoded, failures)
+
+def sweep( mark2b=False, jobs=1 ):
+    """
+    Run sweep_mode() for every mapping mode, jobs at a time. Returns (number
+    of addresses decoded, list of Failures).
+    """
+    work = [ m + (mark2b,) for m in modes(mark2b) ]
+    if jobs == 1:
+        results = [ sweep_mode(m) for m in work ]
+    else:
+        pool = multiprocessing.Pool(processes=jobs if jobs > 0 else None)
+        try:
+            results = pool.map(sweep_mode, work)
+            pool.close()
+        except KeyboardInterrupt:
+            pool.terminate()
+            raise
+        pool.join()
+    return (sum( r[0] for r in results ), [ f for r in results for f in r[1] ])
+
+def describe( d, i, adr ):
+    """
+    Describe where one decoded address goes.
+    """
+    hiaddr = int(d.hiaddr.flat[i])
+    if d.map_cc_sel.flat[i]:
+        return "CPLD register"
+    target = []
+    if hiaddr & 0x80 == 0:
+        target.append("host")
+    if hiaddr & 0x40:
+        ram = int(ram_address(d, adr).flat[i])
+        target.append("RAM %05X%s" % (ram, " (wt)" if d.write_thru.flat[i] else ""))
+    if d.rom_protect.flat[i]:
+        target.append("read only")
+    return " ".join(target) if target else "dummy access"
+
+def print_map( state, bank=0, mark2b=False ):
+    """
+    Print the map of one bank as runs of addresses with the same treatment.
+    """
+    adrs = numpy.arange(65536, dtype=numpy.uint32)
+    d = decode(bank, adrs, state, mark2b=mark2b)
+    ram = ram_address(d, adrs)
+    # Addresses continue a run if everything but the RAM address is the same and
+    # the RAM address follows on
+    key = numpy.stack([ d.hiaddr, d.write_thru, d.rom_protect, d.map_cc_sel ]).T
+    breaks = numpy.nonzero(numpy.any(key[1:] != key[:-1], axis=1) | (ram[1:] != ram[:-1] + 1))[0] + 1
+    starts = numpy.concatenate([ [0], breaks ])
+    ends = numpy.concatenate([ breaks - 1, [65535] ])
+    for (first, last) in zip(starts, ends):
+        print ("  %02X%04X-%02X%04X  %s" % (bank, first, bank, last, describe(d, first, adrs)))
+
+def crosscheck( filename, limit=20 ):
+    """
+    Compare the model with the RTL at the end of PHI1 of every valid cycle in a
+    VCD dump of the testbench. The build variant is found from the signals in
+    the dump. Returns (cycles compared, list of mismatch messages).
+    """
+    import vcd
+    dump = vcd.read_vcd(filename, [ "dut0_u." + s for s in
+                                    VCD_INPUTS + VCD_MASTER_INPUTS + VCD_OUTPUTS + [ "cpu_phi2_w" ] ])
+    missing = [ s for s in VCD_INPUTS + VCD_OUTPUTS + [ "cpu_phi2_w" ]
+                if dump.trace("dut0_u." + s) is None ]
+    if missing:
+        return (0, [ "signal(s) not in dump: %s" % " ".join("dut0_u." + s for s in missing) ])
+    mark2b = dump.trace("dut0_u.acccon_y") is not None
+
+    # The high address latch closes as PHI2 rises, so sample one tick earlier
+    times = dump.trace("dut0_u.cpu_phi2_w").edges("posedge") - 1
+    names = VCD_INPUTS + (VCD_MASTER_INPUTS if mark2b else []) + VCD_OUTPUTS
+    v = dict( (s, dump.trace("dut0_u." + s).value_at(times)) for s in names )
+    known = numpy.all([ v[s] != vcd.UNKNOWN for s in names ], axis=0) & \
+        ((v["cpu_vpa"] | v["cpu_vda"]) == 1)
+    times = times[known]
+    v = dict( (s, v[s][known]) for s in names )
+
+    zero = numpy.zeros(len(times), dtype=numpy.int64)
+    state = State(host=(v["map_data_q"] >> 5) & 3, shadow=(v["map_data_q"] >> 7) & 1,
+                  map_rom=(v["map_data_q"] >> 4) & 1, pagereg=v["bbc_pagereg_q"],
+                  vdu_sync=v["mos_vdu_sync_q"],
+                  vdu_sync_acccon=v["mos_vdu_sync_acccon_q"] if mark2b else zero,
+                  ram_at_8000=v["ram_at_8000"] if mark2b else zero,
+                  acccon_y=v["acccon_y"] if mark2b else zero)
+    d = decode(v["cpu_data"], v["cpu_adr"], state, vpa=v["cpu_vpa"], vda=v["cpu_vda"],
+               native_int=(v["cpu_vpb"] == 0) & (v["cpu_e"] == 0), mark2b=mark2b)
+    rtl = [ ("hiaddr", v["cpu_hiaddr_lat_d"], d.hiaddr),
+            ("a15", v["cpu_a15_lat_d"], d.a15),
+            ("a14", v["cpu_a14_lat_d"], d.a14),
+            ("write_thru", v["write_thru_d"], d.write_thru),
+            ("rom_protect", v["remapped_mos_access_r"] | v["remapped_romAB_access_r"] |
+                            v["remapped_romCF_access_r"], d.rom_protect) ]
+    bad = numpy.any([ expected != numpy.asarray(model, dtype=numpy.int64)
+                      for (label, expected, model) in rtl ], axis=0)
+    messages = []
+    for i in numpy.nonzero(bad)[0][:limit]:
+        diffs = [ "%s rtl %X model %X" % (label, expected[i], int(model[i]))
+                  for (label, expected, model) in rtl if expected[i] != int(model[i]) ]
+        messages.append("%12.1f ns %02X%04X: %s" % (dump.ns(times[i]), v["cpu_data"][i],
+                                                    v["cpu_adr"][i], ", ".join(diffs)))
+    if numpy.count_nonzero(bad) > limit:
+        messages.append("... %d mismatches in all" % numpy.count_nonzero(bad))
+    return (len(times), messages)
+
+def usage() :
+    print (__doc__ + """
+  USAGE:
+
+    memmap.py [-2|--mark2b] [-s|--sweep] [-j|--jobs <n>]
+    memmap.py [-2|--mark2b] -m|--map "<host>[,shadow][,rom][,vdu][,pagereg=<n>]" [-b|--bank <hex>]
+    memmap.py -c|--crosscheck <vcd file>
+
+  OPTIONS
+
+    -2 --mark2b        Model the MARK2B build, which adds the BBC Master host and
+                       the ACCCON register. Default is the Mark2A build.
+    -s --sweep         Decode all 16M addresses in every mapping mode, and bank 0 in
+                       every ROM page register, VDU sync and ACCCON state, and
+                       check the memory map rules. This is the default. Exits with
+                       status 1 if any rule fails.
+    -j --jobs <n>      Number of mapping modes to sweep in parallel. Default is the
+                       number of CPUs.
+    -m --map <mode>    Print the map of one bank for a mode: host is one of
+                       %s.
+    -b --bank <hex>    Bank for --map, default 00.
+    -c --crosscheck    Compare the model with the RTL's high address latch inputs
+                       at the end of PHI1 of every valid cycle in a dump.vcd from
+                       the testbench. The build is found from the dump.
+    """ % ", ".join(HOSTS))
+
+def main( argv ):
+    try:
+        opts, args = getopt.getopt( argv[1:], "2sj:m:b:c:h",
+                                    ["mark2b", "sweep", "jobs=", "map=", "bank=", "crosscheck=",
+                                     "help"])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(1)
+    mark2b = False
+    mode = None
+    bank = 0
+    vcdfile = None
+    jobs = 0
+    for opt, arg in opts:
+        if opt in ( "-2", "--mark2b" ):
+            mark2b = True
+        if opt in ( "-j", "--jobs" ):
+            jobs = int(arg)
+        if opt in ( "-m", "--map" ):
+            mode = arg
+        if opt in ( "-b", "--bank" ):
+            bank = int(arg, 16)
+        if opt in ( "-c", "--crosscheck" ):
+            vcdfile = arg
+        if opt in ( "-h", "--help" ):
+            usage()
+            sys.exit(0)
+
+    if vcdfile is not None:
+        (cycles, messages) = crosscheck(vcdfile)
+        for m in messages:
+            print ("FAIL: %s" % m)
+        print ("%s: %d cycles compared, %d mismatches" % \
+            ("FAIL" if messages else "PASS", cycles, len(messages)))
+        sys.exit(1 if messages or cycles == 0 else 0)
+
+    if mode is not None:
+        fields = mode.split(",")
+        if fields[0] not in HOSTS:
+            usage()
+            sys.exit(1)
+        settings = dict( f.split("=") if "=" in f else (f, "1") for f in fields[1:] )
+        state = make_state(host=HOSTS[fields[0]], shadow=int(settings.get("shadow", 0)),
+                           map_rom=int(settings.get("rom", 0)),
+                           pagereg=int(settings.get("pagereg", "0"), 16),
+                           vdu_sync=int(settings.get("vdu", 0)))
+        print ("%s%s, bank %02X" % ("MARK2B " if mark2b else "", mode, bank))
+        print_map(state, bank, mark2b)
+        sys.exit(0)
+
+    start = time.time()
+    (decoded, failures) = sweep(mark2b, jobs)
+    for f in failures:
+        print ("FAIL: %-32s %-48s %9d addresses, eg %s" % (f.mode, f.rule, f.count, f.example))
+    print ("%s: %d modes, %.0fM addresses decoded in %.1f s, %d rule failures" % \
+        ("FAIL" if failures else "PASS", len(modes(mark2b)), decoded / 1e6, time.time() - start,
+         len(failures)))
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main( sys.argv )
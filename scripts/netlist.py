@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+## **************************************************************************
+##   netlist.py - generate the PCB netlists and Eagle scripts for the boards
+##
+##   COPYRIGHT 2010 Richard Evans, Ed Spittles
+##
+##   netlist.py is free software: you can redistribute it and/or modify
+##   it under the terms of the GNU Lesser General Public License as published by
+##   the Free Software Foundation, either version 3 of the License, or
+##   (at your option) any later version.
+##
+##   tube is distributed in the hope that it will be useful,
+##   but WITHOUT ANY WARRANTY; without even the implied warranty of
+##   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##   GNU Lesser General Public License for more details.
+##
+##   You should have received a copy of the GNU Lesser General Public License
+##   along with tube.  If not, see <http://www.gnu.org/licenses/>.
+##
+## **************************************************************************
+"""
+netlist.py
+
+     Run netlister.py on each board in the pcb directory to make its Eagle
+     script (.scr) and netlist (.net), all boards at once. The component
+     libraries are indexed by part once and the index is cached, and a board
+     is only regenerated when its structural hash changes: the board's
+     Verilog without comments or layout, its footer, and the library
+     definitions of the parts it uses.
+
+"""
+
+from __future__ import print_function
+
+import getopt, hashlib, json, multiprocessing, os, os.path, re, shutil, sys, threading
+from subprocess import Popen, PIPE, STDOUT
+
+import verilog
+
+# The libraries passed to netlister.py by the pcb/Makefile recipe for each
+# format, in the same order, as the first library to define a part is the one
+# used. The %.net recipe has xilinx.lib before cpu.lib.
+LIBRARIES = { "scr": [ "memory.lib", "idc_connectors.lib", "l1a-custom.lib", "l1b-custom.lib",
+                       "cpu.lib", "xilinx.lib", "rcl.lib", "triac.lib", "diode.lib",
+                       "74series.lib", "74series_soic.lib", "switches.lib", "i2c.lib" ],
+              "net": [ "memory.lib", "idc_connectors.lib", "l1a-custom.lib", "l1b-custom.lib",
+                       "xilinx.lib", "cpu.lib", "rcl.lib", "triac.lib", "diode.lib",
+                       "74series.lib", "74series_soic.lib", "switches.lib", "i2c.lib" ] }
+
+FORMATS = ( "scr", "net" )
+
+# Autorouter and design rule files which the Eagle scripts expect in /tmp
+ROUTER_FILES = [ "auto-params-l1b.ctl", "fine_routing.ctl", "design_rules.dru",
+                 "design_rules_smd.dru" ]
+
+# The start of a part definition in a library. Anything before the first one
+# is a header which applies to all parts in the library.
+re_part = re.compile(r"^[ \t]*(?:module|device|component|part)[ \t]+([A-Za-z_][\w.\-]*)", re.M | re.I)
+
+
+def file_digest( filename ):
+    h = hashlib.sha1()
+    f = open(filename, 'rb')
+    for block in iter(lambda: f.read(1 << 20), b""):
+        h.update(block)
+    f.close()
+    return h.hexdigest()
+
+def text_digest( text ):
+    """
+    Return the digest of text with its layout ignored.
+    """
+    return hashlib.sha1(" ".join(text.split()).encode("utf-8")).hexdigest()
+
+def index_library( text ):
+    """
+    Split a library into its part definitions and return a dictionary of the
+    digest of the whole file, of the header before the first part and of each
+    part definition, by part name. If a name is defined more than once the
+    first definition is the one used.
+    """
+    starts = list(re_part.finditer(text))
+    parts = dict()
+    for (i, m) in enumerate(starts):
+        end = starts[i + 1].start() if i + 1 < len(starts) else len(text)
+        parts.setdefault(m.group(1), text_digest(text[m.start():end]))
+    header = text[:starts[0].start()] if starts else text
+    return { "sha1": hashlib.sha1(text.encode("utf-8")).hexdigest(),
+             "header": text_digest(header), "parts": parts }
+
+class NetlistCache(object):
+    """
+    The library indexes and the structural hash of each generated file, kept
+    in a JSON file between runs. A library is only indexed again if its size
+    or mtime has changed.
+    """
+    def __init__( self, filename ):
+        self.filename = filename
+        self.libraries = dict()
+        self.outputs = dict()
+        self.lock = threading.Lock()
+        if os.path.isfile(filename):
+            try:
+                f = open(filename, 'r')
+                data = json.load(f)
+                f.close()
+                self.libraries = data.get("libraries", {})
+                self.outputs = data.get("outputs", {})
+            except ValueError:
+                pass
+
+    def library( self, filename ):
+        path = os.path.abspath(filename)
+        st = os.stat(path)
+        entry = self.libraries.get(path)
+        if entry is None or entry["mtime"] != st.st_mtime or entry["size"] != st.st_size:
+            f = open(path, 'rb')
+            entry = index_library(f.read().decode("latin-1"))
+            f.close()
+            entry.update({ "mtime": st.st_mtime, "size": st.st_size })
+            self.libraries[path] = entry
+        return entry
+
+    def save( self ):
+        with self.lock:
+            f = open(self.filename, 'w')
+            json.dump({ "libraries": self.libraries, "outputs": self.outputs }, f, indent=1,
+                      sort_keys=True)
+            f.close()
+
+def board_hash( board, fmt, libraries, cache, netlister ):
+    """
+    Return the structural hash of a board's output in a format. Parts which
+    no library is seen to define bring in the whole of every library.
+    """
+    f = open(board, 'rb')
+    text = f.read().decode("latin-1")
+    f.close()
+    h = hashlib.sha1()
+    h.update(("%s\n%s\n" % (fmt, file_digest(netlister))).encode())
+    try:
+        h.update(("\0".join(verilog.normalize(text, dict(), board)) + "\n").encode("utf-8"))
+    except ValueError:
+        h.update(text.encode("utf-8"))
+    if fmt == "scr":
+        h.update(("footer:%s\n" % file_digest(footer_file(board))).encode())
+    indexes = [ (os.path.basename(lib), cache.library(lib)) for lib in libraries ]
+    unresolved = False
+    for part in verilog.scan_text(text).instances:
+        for (name, index) in indexes:
+            if part in index["parts"]:
+                h.update(("%s:%s:%s:%s\n" % (part, name, index["header"],
+                                             index["parts"][part])).encode())
+                break
+        else:
+            unresolved = True
+    if unresolved:
+        for (name, index) in indexes:
+            h.update(("%s:%s\n" % (name, index["sha1"])).encode())
+    return h.hexdigest()
+
+def footer_file( board ):
+    return "%s_footer.scr" % os.path.splitext(board)[0]
+
+def output_file( board, fmt ):
+    return "%s.%s" % (os.path.splitext(board)[0], fmt)
+
+def netlister_command( netlister, board, fmt, libraries ):
+    command = [ netlister, "-i", board ]
+    for lib in libraries:
+        command += [ "-l", lib ]
+    command += [ "-o", output_file(board, fmt) ]
+    if fmt == "scr":
+        command += [ "-f", "scr", "-u", "-t", footer_file(board) ]
+    else:
+        command += [ "-u", "-f", "net" ]
+    return command
+
+def run_netlister( command, cwd ):
+    """
+    Run netlister.py and return (success, output).
+    """
+    try:
+        p = Popen(command, cwd=cwd, stdout=PIPE, stderr=STDOUT)
+    except OSError as e:
+        return (False, "%s: %s" % (command[0], e))
+    output = p.communicate()[0].decode("latin-1")
+    return (p.returncode == 0, output)
+
+def build_boards( directory, boards, formats, netlister, libraries, cache, jobs, force=False,
+                  verbose=False ):
+    """
+    Generate every format of every board whose structural hash has changed,
+    jobs at a time, with the list of libraries for that format from the
+    libraries dictionary. Returns a dictionary of (board, format) to "built",
+    "unchanged" or "failed".
+    """
+    try:
+        import queue
+    except ImportError:
+        import Queue as queue
+    results = dict()
+    work = queue.Queue()
+    for board in boards:
+        for fmt in formats:
+            output = output_file(board, fmt)
+            digest = board_hash(os.path.join(directory, board), fmt, libraries[fmt], cache,
+                                netlister)
+            if not force and cache.outputs.get(output) == digest and \
+                    os.path.isfile(os.path.join(directory, output)):
+                results[(board, fmt)] = "unchanged"
+            else:
+                work.put( (board, fmt, digest) )
+    cache.save()
+
+    def worker():
+        while True:
+            try:
+                (board, fmt, digest) = work.get_nowait()
+            except queue.Empty:
+                return
+            (ok, output) = run_netlister(netlister_command(netlister, board, fmt, libraries[fmt]),
+                                         directory)
+            with cache.lock:
+                if verbose or not ok:
+                    print ("INFO: %s" % output_file(board, fmt))
+                    print (output.rstrip())
+                results[(board, fmt)] = "built" if ok else "failed"
+                if ok:
+                    cache.outputs[output_file(board, fmt)] = digest
+                else:
+                    cache.outputs.pop(output_file(board, fmt), None)
+            if ok:
+                cache.save()
+
+    threads = [ threading.Thread(target=worker) for i in range(max(1, min(jobs, work.qsize()))) ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    cache.save()
+    return results
+
+def find_boards( directory ):
+    """
+    Return the board netlists in directory: the Verilog files with a top module.
+    """
+    return [ f for f in sorted(os.listdir(directory)) if f.endswith(".v") and
+             verilog.scan_file(os.path.join(directory, f)).modules ]
+
+def usage() :
+    print (__doc__ + """
+  USAGE:
+
+    netlist.py [-n|--netlister <netlister directory>] [-d|--dir <pcb directory>]
+               [-l|--lib <library>]... [-f|--format scr,net] [-j|--jobs <n>]
+               [-c|--cache <file>] [-F|--force] [-v|--verbose] [<board.v>...]
+
+  OPTIONS
+
+    -n --netlister <dir>  Checkout of netlister, with src/netlister.py and lib/. Default
+                          is $NETLISTER_DIR, or ~/Documents/nas/Development/git/netlister
+    -d --dir <dir>        Directory with the boards, default '.'
+    -l --lib <file>       Component library, in lib/ of the netlister checkout unless a
+                          path is given. May be given more than once, and used for
+                          every format. Default is the same libraries as pcb/Makefile,
+                          which orders them differently for .scr and .net.
+    -f --format <list>    Outputs to make, default "scr,net". The .scr needs a
+                          <board>_footer.scr.
+    -j --jobs <n>         Number of netlister runs at once, default the number of CPUs
+    -c --cache <file>     Library index and board hashes, default .netlist_cache.json
+                          in the board directory
+    -F --force            Regenerate every output whether its hash changed or not
+    -v --verbose          Show the output of every netlister run, not just failures
+
+    All boards in the directory are made if none are named.
+    """)
+
+def main( argv ):
+    try:
+        opts, args = getopt.gnu_getopt( argv[1:], "n:d:l:f:j:c:Fvh",
+                                        ["netlister=", "dir=", "lib=", "format=", "jobs=",
+                                         "cache=", "force", "verbose", "help"])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(1)
+    netlister_dir = os.environ.get("NETLISTER_DIR", "~/Documents/nas/Development/git/netlister")
+    directory = "."
+    libraries = []
+    formats = list(FORMATS)
+    jobs = multiprocessing.cpu_count()
+    cachefile = ""
+    force = False
+    verbose = False
+    for opt, arg in opts:
+        if opt in ( "-n", "--netlister" ):
+            netlister_dir = arg
+        if opt in ( "-d", "--dir" ):
+            directory = arg
+        if opt in ( "-l", "--lib" ):
+            libraries.append(arg)
+        if opt in ( "-f", "--format" ):
+            formats = [ f.strip() for f in arg.split(",") if f.strip() != "" ]
+        if opt in ( "-j", "--jobs" ):
+            jobs = int(arg)
+        if opt in ( "-c", "--cache" ):
+            cachefile = arg
+        if opt in ( "-F", "--force" ):
+            force = True
+        if opt in ( "-v", "--verbose" ):
+            verbose = True
+        if opt in ( "-h", "--help" ):
+            usage()
+            sys.exit(0)
+    if [ f for f in formats if f not in FORMATS ]:
+        print ("ERROR: formats are %s" % ",".join(FORMATS))
+        sys.exit(1)
+
+    netlister_dir = os.path.abspath(os.path.expanduser(netlister_dir))
+    netlister = os.path.join(netlister_dir, "src", "netlister.py")
+    libraries = dict( (fmt, [ os.path.abspath(lib if os.sep in lib else
+                                              os.path.join(netlister_dir, "lib", lib))
+                              for lib in (libraries or LIBRARIES[fmt]) ]) for fmt in formats )
+    for filename in [ netlister ] + sorted(set(sum(libraries.values(), []))):
+        if not os.path.isfile(filename):
+            print ("ERROR: %s not found, set the netlister checkout with -n" % filename)
+            sys.exit(1)
+    boards = [ os.path.basename(b) for b in args ] or find_boards(directory)
+    missing = [ b for b in boards if "scr" in formats and
+                not os.path.isfile(os.path.join(directory, footer_file(b))) ]
+    if missing:
+        print ("ERROR: no footer script for %s" % ", ".join(missing))
+        sys.exit(1)
+
+    cache = NetlistCache(cachefile or os.path.join(directory, ".netlist_cache.json"))
+    results = build_boards(directory, boards, formats, netlister, libraries, cache, jobs,
+                           force, verbose)
+    if "built" in results.values():
+        for f in ROUTER_FILES:
+            if os.path.isfile(os.path.join(directory, f)):
+                shutil.copy(os.path.join(directory, f), "/tmp")
+    for board in boards:
+        print (("%-24s %s" % (board, "  ".join( "%s %-9s" % (fmt, results[(board, fmt)])
+                                               for fmt in formats ))).rstrip())
+    sys.exit(0 if "failed" not in results.values() else 1)
+
+if __name__ == "__main__":
+    main( sys.argv )
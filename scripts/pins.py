@@ -0,0 +1,444 @@
+#!/usr/bin/env python
+## **************************************************************************
+##   pins.py - check UCF pin locations against the RTL and the PCB netlists
+##
+##   COPYRIGHT 2010 Richard Evans, Ed Spittles
+##
+##   pins.py is free software: you can redistribute it and/or modify
+##   it under the terms of the GNU Lesser General Public License as published by
+##   the Free Software Foundation, either version 3 of the License, or
+##   (at your option) any later version.
+##
+##   tube is distributed in the hope that it will be useful,
+##   but WITHOUT ANY WARRANTY; without even the implied warranty of
+##   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##   GNU Lesser General Public License for more details.
+##
+##   You should have received a copy of the GNU Lesser General Public License
+##   along with tube.  If not, see <http://www.gnu.org/licenses/>.
+##
+## **************************************************************************
+"""
+pins.py
+
+     Check the LOC constraints in a UCF file against the ports of the top
+     level module, with defines applied, and against the pins of the device
+     on the PCB netlists which use it, before any Xilinx tool is run.
+
+"""
+
+from __future__ import print_function
+
+import collections, getopt, os, os.path, re, sys
+
+import verilog
+
+# One LOC constraint: the net (a port bit, eg "cpu_data[3]"), the pin and the
+# line of the UCF file it is on
+Loc = collections.namedtuple("Loc", ["net", "pin", "line"])
+
+# A module port: bus is True if it has a range, and msb and lsb are None if
+# the range can't be worked out
+Port = collections.namedtuple("Port", ["direction", "msb", "lsb", "bus"])
+
+# A problem found by check(): severity is "ERROR" or "WARNING"
+Problem = collections.namedtuple("Problem", ["severity", "message"])
+
+re_ucf_statement = re.compile(r'^\s*(?:PIN|NET|INST)\s+"?([^"\s]+)"?\s+(.*)$', re.I | re.S)
+re_ucf_loc = re.compile(r'\bLOC\s*=\s*"?([\w]+)"?', re.I)
+re_numbered_pin = re.compile(r"^(?:PIN|P)(\d+)$", re.I)
+re_package = re.compile(r"^[a-z]{2,3}(\d+)$")
+
+DIRECTIONS = ( "input", "output", "inout" )
+
+# Nets on a board which are power rather than signals, besides supply0/supply1 wires
+re_power = re.compile(r"^(GND|VSS|VCC|VDD)", re.I)
+
+
+def canonical_pin( pin ):
+    """
+    Return a package pin in one spelling, eg P9 for p9 or PIN9.
+    """
+    m = re_numbered_pin.match(pin)
+    return "P%d" % int(m.group(1)) if m else pin.upper()
+
+def canonical_net( net ):
+    """
+    Return a UCF net name with either bus delimiter as name[bit], in lower case.
+    """
+    return re.sub(r"<(\d+)>$", r"[\1]", net).lower()
+
+def read_ucf( filename ):
+    """
+    Return the list of LOC constraints in a UCF file, as Locs.
+    """
+    locs = []
+    f = open(filename, 'r')
+    for (number, line) in enumerate(f):
+        for statement in line.split("#", 1)[0].split(";"):
+            m = re_ucf_statement.match(statement)
+            if m is None:
+                continue
+            loc = re_ucf_loc.search(m.group(2))
+            if loc is not None:
+                locs.append( Loc(canonical_net(m.group(1)), canonical_pin(loc.group(1)), number + 1) )
+    f.close()
+    return locs
+
+def evaluate( tokens ):
+    """
+    Return the value of a constant integer expression given as tokens, or None.
+    """
+    text = " ".join(tokens)
+    if not re.match(r"^[\d\s+\-*/()]+$", text):
+        return None
+    try:
+        return int(eval(text.replace("/", "//"), {"__builtins__": {}}))
+    except (SyntaxError, ZeroDivisionError):
+        return None
+
+def parse_ports( tokens, start ):
+    """
+    Return a dictionary of port name to Port for the module whose name is at
+    tokens[start]. The direction of a port named in a non-ANSI header but not
+    declared is None.
+    """
+    ports = collections.OrderedDict()
+    i = start + 1
+    if tokens[i] == "#":
+        depth = 0
+        i += 1
+        while True:
+            depth += { "(": 1, ")": -1 }.get(tokens[i], 0)
+            i += 1
+            if depth == 0:
+                break
+
+    def declaration( i, direction, names_only ):
+        # Parse one port declaration, return the index after it
+        rng = (None, None, False)
+        while tokens[i] in ("wire", "reg", "signed", "tri", "supply0", "supply1"):
+            i += 1
+        if tokens[i] == "[":
+            end = tokens.index("]", i)
+            colon = tokens.index(":", i, end) if ":" in tokens[i:end] else end
+            rng = (evaluate(tokens[i + 1:colon]), evaluate(tokens[colon + 1:end]), True)
+            i = end + 1
+        while re.match(r"^[A-Za-z_]", tokens[i]):
+            if not names_only or tokens[i] in ports:
+                ports[tokens[i]] = Port(direction, *rng)
+            i += 1
+            if tokens[i] != ",":
+                break
+            if tokens[i + 1] in DIRECTIONS:
+                break
+            i += 1
+            if tokens[i] in ("[", "wire", "reg", "signed"):
+                # A new range without a direction keeps the direction
+                break
+        return i
+
+    # Port list in the module header
+    if tokens[i] == "(":
+        i += 1
+        direction = None
+        while tokens[i] != ")":
+            if tokens[i] in DIRECTIONS:
+                direction = tokens[i]
+                i = declaration(i + 1, direction, False)
+            elif direction is not None and tokens[i] in ("[", "wire", "reg", "signed"):
+                i = declaration(i, direction, False)
+            elif re.match(r"^[A-Za-z_]", tokens[i]):
+                # A non-ANSI header names the ports, which are declared in the body
+                ports[tokens[i]] = Port(None, None, None, False)
+                i += 1
+            else:
+                i += 1
+    # Port declarations in the body, skipping functions and tasks
+    depth = 0
+    while i < len(tokens) and tokens[i] not in ("endmodule", "endprimitive"):
+        if tokens[i] in ("function", "task"):
+            depth += 1
+        elif tokens[i] in ("endfunction", "endtask"):
+            depth -= 1
+        elif depth == 0 and tokens[i] in DIRECTIONS and (tokens[i - 1] == ";"):
+            i = declaration(i + 1, tokens[i], True)
+            continue
+        i += 1
+    return ports
+
+def module_ports( filenames, module, defines=None ):
+    """
+    Return the ports of a module defined in one of the source files, compiled
+    in order with the defines set, as a dictionary of name to Port, or None if
+    it isn't found.
+    """
+    macros = dict(defines or {})
+    for filename in filenames:
+        f = open(filename, 'rb')
+        text = f.read().decode("latin-1")
+        f.close()
+        tokens = verilog.normalize(text, macros, filename)
+        for i in range(len(tokens) - 1):
+            if tokens[i] in ("module", "macromodule") and tokens[i + 1] == module:
+                return parse_ports(tokens, i + 1)
+    return None
+
+def port_bits( ports ):
+    """
+    Return the set of port bit names, eg cpu_data[3], in lower case, and the
+    set of names of ports whose width isn't known.
+    """
+    bits = set()
+    unknown = set()
+    for (name, port) in ports.items():
+        if port.direction is None or (port.bus and (port.msb is None or port.lsb is None)):
+            unknown.add(name.lower())
+        elif not port.bus:
+            bits.add(name.lower())
+        else:
+            for bit in range(min(port.msb, port.lsb), max(port.msb, port.lsb) + 1):
+                bits.add("%s[%d]" % (name.lower(), bit))
+    return (bits, unknown)
+
+def device_part( target ):
+    """
+    Return the device and package of a target, eg ("xc95108", "pc84") for
+    xc95108-15-pc84, with the package "" if the target doesn't name one.
+    """
+    fields = target.lower().split("-")
+    packages = [ f for f in fields[1:] if re_package.match(f) ]
+    return (fields[0], packages[0] if packages else "")
+
+def board_devices( filename, target ):
+    """
+    Return a list of (instance name, pins) for the instances of the target's
+    device in a PCB netlist, where pins maps each pin of the part to the net
+    on it ("" if unconnected), and the set of power nets on the board.
+    """
+    (device, package) = device_part(target)
+    f = open(filename, 'rb')
+    text = f.read().decode("latin-1")
+    f.close()
+    tokens = verilog.normalize(text, dict(), filename)
+    power = set()
+    devices = []
+    i = 0
+    while i < len(tokens):
+        if tokens[i] in ("supply0", "supply1"):
+            i += 1
+            while tokens[i] != ";":
+                if tokens[i] != ",":
+                    power.add(tokens[i])
+                i += 1
+        elif package != "" and re.sub(r"[^a-z0-9]", "", tokens[i].lower()) == device + package \
+                and i + 2 < len(tokens) and tokens[i + 2] == "(":
+            name = tokens[i + 1]
+            pins = dict()
+            depth = 0
+            i += 2
+            while True:
+                depth += { "(": 1, ")": -1 }.get(tokens[i], 0)
+                if depth == 0:
+                    break
+                if tokens[i] == "." and tokens[i + 2] == "(":
+                    net = tokens[i + 3] if tokens[i + 3] != ")" else ""
+                    pins[canonical_pin(tokens[i + 1])] = net
+                i += 1
+            devices.append( (name, pins) )
+        i += 1
+    return (devices, power)
+
+def net_key( net ):
+    """
+    Return a net or port bit name as (name, bit) for matching, eg ("bbc_d", "6")
+    for bbc_d6 and ("bbc_data", "6") for bbc_data[6], with bit "" if it has none.
+    """
+    m = re.match(r"^(.*?)_?\[?(\d*)\]?$", net.lower())
+    return (m.group(1), m.group(2))
+
+def nets_match( port, net ):
+    """
+    Return True if a UCF net and a board net look like the same signal: the
+    same bit, and one name is the start or end of the other, eg bbc_data[6] and
+    bbc_d6, ram_adr[14] and ram_a14, or bbc_phi0 and phi0.
+    """
+    ((a, abit), (b, bbit)) = (net_key(port), net_key(net))
+    if abit != bbit or a == "" or b == "":
+        return False
+    return a.startswith(b) or b.startswith(a) or a.endswith(b) or b.endswith(a)
+
+def board_match( board, target, locs ):
+    """
+    Return the fraction of the LOCs which are on pins carrying a net of a
+    similar name, for the instance of the target's device on the board which
+    matches best.
+    """
+    (devices, power) = board_devices(board, target)
+    best = 0.0
+    for (instance, pins) in devices:
+        matched = len([ l for l in locs if nets_match(l.net, pins.get(l.pin, "")) ])
+        best = max(best, float(matched) / max(len(locs), 1))
+    return best
+
+# The fraction of LOCs which must match the nets on a board for the board to be
+# taken as the one the UCF file is for
+BOARD_MATCH = 0.5
+
+def find_boards( directory, target, ucf ):
+    """
+    Return the PCB netlists in directory with the target's device on them whose
+    nets on the device's pins match the nets in the UCF file (see nets_match()),
+    since the same device can be used for more than one module. The caller
+    should only check against a board if exactly one is found.
+    """
+    if not os.path.isdir(directory):
+        return []
+    (device, package) = device_part(target)
+    if package == "":
+        return []
+    locs = read_ucf(ucf)
+    boards = []
+    for f in sorted(os.listdir(directory)):
+        if f.endswith(".v"):
+            path = os.path.join(directory, f)
+            scan = verilog.scan_file(path)
+            if any( re.sub(r"[^a-z0-9]", "", i.lower()) == device + package for i in scan.instances ) \
+                    and board_match(path, target, locs) >= BOARD_MATCH:
+                boards.append(path)
+    return boards
+
+def check( ucf, ports, target, boards=() ):
+    """
+    Check the LOC constraints in the UCF file against the module's ports (from
+    module_ports()) and the target's device on each of the boards, and return
+    a list of Problems. Errors are constraints which can't be right: on nets
+    which aren't ports, on the same pin or with two pins for one net, beyond
+    the package's pins, or on a pin the board doesn't connect or has power
+    on. Warnings are ports with no LOC and board signals on pins with no LOC.
+    """
+    problems = []
+    name = os.path.basename(ucf)
+    locs = read_ucf(ucf)
+    (bits, unknown) = port_bits(ports)
+    by_net = collections.OrderedDict()
+    by_pin = collections.OrderedDict()
+    for loc in locs:
+        by_net.setdefault(loc.net, []).append(loc)
+        by_pin.setdefault(loc.pin, []).append(loc)
+        if loc.net not in bits and loc.net.split("[")[0] not in unknown:
+            problems.append( Problem("ERROR", "%s:%d: %s is not a port of the module" %
+                                     (name, loc.line, loc.net)) )
+    for (net, same) in by_net.items():
+        if len(same) > 1:
+            severity = "ERROR" if len(set( l.pin for l in same )) > 1 else "WARNING"
+            problems.append( Problem(severity, "%s:%s: %s is located more than once, at %s" %
+                                     (name, ",".join( str(l.line) for l in same ), net,
+                                      ", ".join( l.pin for l in same ))) )
+    for (pin, same) in by_pin.items():
+        nets = sorted(set( l.net for l in same ))
+        if len(nets) > 1:
+            problems.append( Problem("ERROR", "%s:%s: %s is the LOC of more than one net: %s" %
+                                     (name, ",".join( str(l.line) for l in same ), pin,
+                                      ", ".join(nets))) )
+    (device, package) = device_part(target)
+    if package != "":
+        count = int(re_package.match(package).group(1))
+        for loc in locs:
+            m = re_numbered_pin.match(loc.pin)
+            if m and not 1 <= int(m.group(1)) <= count:
+                problems.append( Problem("ERROR", "%s:%d: %s is not a pin of the %s package" %
+                                         (name, loc.line, loc.pin, package)) )
+    for bit in sorted(bits - set(by_net)):
+        problems.append( Problem("WARNING", "%s: port %s has no LOC" % (name, bit)) )
+
+    for board in boards:
+        (devices, power) = board_devices(board, target)
+        for (instance, pins) in devices:
+            where = "%s %s" % (os.path.basename(board), instance)
+            for loc in locs:
+                if loc.pin not in pins:
+                    continue
+                net = pins[loc.pin]
+                if net == "":
+                    problems.append( Problem("ERROR", "%s:%d: %s (%s) is not connected on %s" %
+                                             (name, loc.line, loc.pin, loc.net, where)) )
+                elif net in power or re_power.match(net):
+                    problems.append( Problem("ERROR", "%s:%d: %s (%s) is on power net %s on %s" %
+                                             (name, loc.line, loc.pin, loc.net, net, where)) )
+            for (pin, net) in sorted(pins.items()):
+                if re_numbered_pin.match(pin) and net != "" and net not in power and \
+                        not re_power.match(net) and pin not in by_pin:
+                    problems.append( Problem("WARNING", "%s: %s has net %s on %s but no LOC" %
+                                             (name, where, net, pin)) )
+    return problems
+
+def usage() :
+    print (__doc__ + """
+  USAGE:
+
+    pins.py -m|--module <module> -c|--constraints <ucf file> -t|--target <device>
+            [-D|--define NAME[=value]]... [-b|--board <pcb netlist>]... <verilog file>...
+
+    Errors are LOCs on nets which aren't ports of the module, more than one net
+    on a pin or pin for a net, pins the package doesn't have, and pins the board
+    leaves unconnected or has power on. Warnings are ports with no LOC and board
+    signals on pins with no LOC. With no -b the board in ../pcb relative to the
+    first Verilog file whose nets on the device's pins match the UCF nets is
+    checked, or none if more than one board matches.
+
+    Exits with 1 if there are errors.
+    """)
+
+def main( argv ):
+    try:
+        opts, args = getopt.gnu_getopt( argv[1:], "m:c:t:D:b:h",
+                                        ["module=", "constraints=", "target=", "define=", "board=",
+                                         "help"])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(1)
+    module = ""
+    ucf = ""
+    target = ""
+    defines = dict()
+    boards = []
+    for opt, arg in opts:
+        if opt in ( "-m", "--module" ):
+            module = arg
+        if opt in ( "-c", "--constraints" ):
+            ucf = arg
+        if opt in ( "-t", "--target" ):
+            target = arg.lower()
+        if opt in ( "-D", "--define" ):
+            (name, value) = (arg.split("=", 1) + [""])[:2]
+            defines[name] = value
+        if opt in ( "-b", "--board" ):
+            boards.append(arg)
+        if opt in ( "-h", "--help" ):
+            usage()
+            sys.exit(0)
+    if module == "" or ucf == "" or target == "" or not args:
+        usage()
+        sys.exit(1)
+    ports = module_ports(args, module, defines)
+    if ports is None:
+        print ("ERROR: module %s not found" % module)
+        sys.exit(1)
+    if not boards:
+        boards = find_boards(os.path.join(os.path.dirname(os.path.abspath(args[0])), "..", "pcb"),
+                             target, ucf)
+        if len(boards) > 1:
+            print ("WARNING: %s match %s, not checking any board, use -b to choose one" %
+                   (", ".join( os.path.basename(b) for b in boards ), os.path.basename(ucf)))
+            boards = []
+    problems = check(ucf, ports, target, boards)
+    for problem in problems:
+        print ("%s: %s" % problem)
+    errors = len([ p for p in problems if p.severity == "ERROR" ])
+    print ("INFO: %d LOCs, %d ports, %d boards checked, %d errors, %d warnings" %
+           (len(read_ucf(ucf)), len(ports), len(boards), errors, len(problems) - errors))
+    sys.exit(1 if errors else 0)
+
+if __name__ == "__main__":
+    main( sys.argv )
@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+## **************************************************************************
+##   regress.py - run the iverilog testbench regression in parallel
+##
+##   COPYRIGHT 2010 Richard Evans, Ed Spittles
+##
+##   regress.py is free software: you can redistribute it and/or modify
+##   it under the terms of the GNU Lesser General Public License as published by
+##   the Free Software Foundation, either version 3 of the License, or
+##   (at your option) any later version.
+##
+##   tube is distributed in the hope that it will be useful,
+##   but WITHOUT ANY WARRANTY; without even the implied warranty of
+##   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##   GNU Lesser General Public License for more details.
+##
+##   You should have received a copy of the GNU Lesser General Public License
+##   along with tube.  If not, see <http://www.gnu.org/licenses/>.
+##
+## **************************************************************************
+"""
+regress.py
+
+     Find all testbenches, compile each distinct iverilog configuration once
+     and run every testbench/variant combination in parallel.
+
+"""
+
+from __future__ import print_function
+
+import collections, getopt, glob, hashlib, json, multiprocessing, os, os.path, re, shutil
+import sys, time
+from subprocess import Popen, PIPE, STDOUT
+
+import verilog
+try:
+    import vcd, memmap
+except ImportError:
+    vcd = None
+    memmap = None
+
+g_script_dir = os.path.dirname(os.path.abspath(__file__))
+g_testbench_dir = os.path.normpath(os.path.join(g_script_dir, "..", "testbench"))
+g_rtl_dir = os.path.normpath(os.path.join(g_script_dir, "..", "rtl"))
+g_work_dir = os.path.join(g_testbench_dir, "regress")
+g_jobs = 0
+g_iverilog = "iverilog"
+g_vvp = "vvp"
+g_clock_checks = True
+
+# Variants to run every testbench with, each a comma separated list of defines.
+# Defines which none of a testbench's sources refer to are dropped, so variants
+# which differ only in those share a compiled simulation.
+g_default_variants = [ "STOP_ON_PHI2", "STOP_ON_PHI2,MARK2B" ]
+
+# A test is one testbench top module built with one set of defines, and
+# config is the key of the compiled simulation it runs
+Test = collections.namedtuple("Test", ["name", "top", "defines", "files", "missing", "config"])
+
+# Lines in the simulation output which mean that the test has failed
+re_failure = re.compile(r"^\s*(FAIL|ERROR|Error)\b")
+
+
+def usage() :
+    print (__doc__ + """
+  USAGE:
+
+    regress.py [-t|--testbench <top module>] ... \\
+               [-V|--variant "<define>,<define>..."] ... \\
+               [-j|--jobs <number of parallel jobs>] \\
+               [--no-clock-checks] [-l|--list] [-h|--help]
+
+  OPTIONAL SWITCHES
+
+    -t --testbench <module>               Only run this testbench. May be given more than once.
+                                          Default is every top level module in testbench/
+    -V --variant <define,define...>       Run each testbench with this set of defines. May be
+                                          given more than once. Default is
+                                          %s
+    -j --jobs <n>                         Number of compiles and simulations to run in
+                                          parallel. Default is the number of CPUs.
+    --no-clock-checks                     Don't run the vcd.py clock checks on the dump.vcd
+                                          left by testbenches which have them, or the
+                                          memmap.py address decode cross-check.
+    -l --list                             List the tests and their configurations and exit.
+    -h --help                             Produce this help information.
+
+  Compiled simulations are cached in testbench/regress/cache keyed by the
+  contents of their sources and the defines used, and each test runs in
+  testbench/regress/<test name>/ leaving its log and any dump.vcd there.
+    """ % " ".join('"%s"' % v for v in g_default_variants))
+    return
+
+def file_digest( filename ):
+    f = open(filename, 'rb')
+    digest = hashlib.sha1(f.read()).hexdigest()
+    f.close()
+    return digest
+
+def source_files():
+    return sorted(glob.glob(os.path.join(g_testbench_dir, "*.v")) +
+                  glob.glob(os.path.join(g_rtl_dir, "*.v")))
+
+def find_testbenches():
+    """
+    Return the names of all modules defined in the testbench directory which
+    aren't instantiated anywhere, ie the testbench top levels.
+    """
+    defined = []
+    instantiated = set()
+    for filename in source_files():
+        scan = verilog.scan_file(filename)
+        if os.path.dirname(filename) == g_testbench_dir:
+            defined.extend(scan.modules)
+        instantiated.update(scan.instances)
+    return [ m for m in defined if m not in instantiated ]
+
+def config_key( top, defines, files ):
+    """
+    Return the key for a compiled simulation, from its top module, the defines
+    used and the names and contents of its source files.
+    """
+    h = hashlib.sha1()
+    h.update(("%s:%s\n" % (top, ",".join(defines))).encode())
+    for filename in files:
+        h.update(("%s:%s\n" % (os.path.basename(filename), file_digest(filename))).encode())
+    return h.hexdigest()[:16]
+
+def make_test( top, variant, files=None, name=None ):
+    """
+    Return the Test for a testbench top module and a comma separated list of
+    defines. The sources are found by scanning all files in the testbench and
+    rtl directories unless files is given.
+    """
+    defines = [ d for d in variant.split(",") if d != "" ]
+    missing = set()
+    if files is None:
+        (files, includes, missing) = verilog.hierarchy(top, source_files())
+    else:
+        files = [ os.path.abspath(f) for f in files ]
+    macros = set()
+    for filename in files:
+        macros.update(verilog.scan_file(filename).macros)
+    used = sorted( d for d in defines if d.split("=")[0] in macros )
+    if name is None:
+        name = "-".join([ top ] + [ d.split("=")[0] for d in defines ])
+    return Test(name=name, top=top, defines=used, files=files, missing=sorted(missing),
+                config=config_key(top, used, files))
+
+def cache_dir():
+    return os.path.join(g_work_dir, "cache")
+
+def compile_config( test ):
+    """
+    Compile the simulation for a test's configuration into the cache, unless it
+    is already there. Returns (config, status) where status is "cached",
+    "built" or "FAIL".
+    """
+    exe = os.path.join(cache_dir(), "%s.vvp" % test.config)
+    if os.path.isfile(exe):
+        return (test.config, "cached")
+    command = [ g_iverilog, "-s", test.top, "-o", exe + ".tmp" ]
+    for d in sorted(set( os.path.dirname(f) for f in test.files )):
+        command.extend([ "-I", d ])
+    for d in test.defines:
+        command.extend([ "-D", d ])
+    command.extend(test.files)
+    log = open(os.path.join(cache_dir(), "%s.log" % test.config), 'w')
+    log.write(" ".join(command) + "\n")
+    log.flush()
+    try:
+        rc = Popen(command, stdout=log, stderr=STDOUT).wait()
+    except OSError as e:
+        log.write("%s\n" % e)
+        rc = 1
+    log.close()
+    if rc != 0:
+        return (test.config, "FAIL")
+    os.rename(exe + ".tmp", exe)
+    return (test.config, "built")
+
+def run_test( test ):
+    """
+    Run a test's compiled simulation in its own directory, then the clock checks
+    for the testbench and, for the main testbench, the memmap.py cross-check of
+    the address decode on its dump.vcd. Returns (name, passed, seconds, number
+    of clock check violations and decode mismatches or None if the checks
+    weren't run).
+    """
+    rundir = os.path.join(g_work_dir, test.name)
+    if os.path.isdir(rundir):
+        shutil.rmtree(rundir)
+    os.makedirs(rundir)
+    exe = os.path.join(cache_dir(), "%s.vvp" % test.config)
+    log = open(os.path.join(rundir, "sim.log"), 'w')
+    start = time.time()
+    try:
+        rc = Popen([ g_vvp, "-n", exe ], cwd=rundir, stdout=log, stderr=STDOUT).wait()
+    except OSError as e:
+        log.write("%s\n" % e)
+        rc = 1
+    log.close()
+    elapsed = time.time() - start
+    f = open(os.path.join(rundir, "sim.log"), 'r')
+    failures = [ line for line in f if re_failure.match(line) ]
+    f.close()
+
+    violations = None
+    dumpfile = os.path.join(rundir, "dump.vcd")
+    if g_clock_checks and vcd is not None and test.top in vcd.CHECKS and os.path.isfile(dumpfile):
+        found = vcd.run_checks(dumpfile, vcd.CHECKS[test.top])
+        f = open(os.path.join(rundir, "clock_checks.log"), 'w')
+        for v in found:
+            f.write("FAIL: %12.1f ns %-16s %s\n" % (v.time, v.check, v.message))
+        f.close()
+        violations = len(found)
+    if g_clock_checks and memmap is not None and test.top == "testbench" and os.path.isfile(dumpfile):
+        (cycles, mismatches) = memmap.crosscheck(dumpfile)
+        f = open(os.path.join(rundir, "decode_checks.log"), 'w')
+        for m in mismatches:
+            f.write("FAIL: %s\n" % m)
+        f.write("%d cycles compared\n" % cycles)
+        f.close()
+        violations = (violations or 0) + len(mismatches)
+    return (test.name, rc == 0 and not failures and not violations, elapsed, violations)
+
+def regress( tests ):
+    """
+    Compile every distinct configuration needed by the tests, then run all of the
+    tests which compiled, each in a pool of g_jobs processes. Prints a summary
+    and returns a list of result dictionaries, one per test.
+    """
+    if not os.path.isdir(cache_dir()):
+        os.makedirs(cache_dir())
+    if g_clock_checks and vcd is None:
+        print ("WARNING: numpy isn't available so clock checks won't be run")
+    jobs = g_jobs if g_jobs > 0 else multiprocessing.cpu_count()
+    configs = collections.OrderedDict( (t.config, t) for t in tests )
+    print ("INFO: %d tests, %d distinct configurations, %d jobs at a time" % \
+        (len(tests), len(configs), jobs))
+
+    pool = multiprocessing.Pool(processes=jobs)
+    try:
+        compiled = dict(pool.map(compile_config, list(configs.values())))
+        runnable = [ t for t in tests if compiled[t.config] != "FAIL" ]
+        runs = dict( (r[0], r[1:]) for r in pool.map(run_test, runnable) )
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    pool.join()
+
+    results = []
+    for test in tests:
+        (ok, elapsed, violations) = runs.get(test.name, (False, 0.0, None))
+        results.append({ "test": test.name, "top": test.top, "defines": test.defines,
+                         "config": test.config, "compile": compiled[test.config],
+                         "passed": ok, "seconds": round(elapsed, 3),
+                         "clock_violations": violations,
+                         "missing": test.missing })
+
+    print ("")
+    print ("%-36s %-16s %-7s %-6s %8s %6s" % ("Test", "Config", "Compile", "Result", "Sim(s)", "Clock"))
+    print ("-" * 87)
+    for r in results:
+        clock = "-" if r["clock_violations"] is None else r["clock_violations"]
+        print ("%-36s %-16s %-7s %-6s %8.1f %6s" % (r["test"], r["config"], r["compile"],
+                                                   "PASS" if r["passed"] else "FAIL", r["seconds"],
+                                                   clock))
+        if r["clock_violations"]:
+            print ("    see %s and decode_checks.log there" % \
+                os.path.join(g_work_dir, r["test"], "clock_checks.log"))
+        if r["compile"] == "FAIL":
+            print ("    see %s" % os.path.join(cache_dir(), "%s.log" % r["config"]))
+            if r["missing"]:
+                print ("    undefined modules: %s" % " ".join(r["missing"]))
+    failures = len([ r for r in results if not r["passed"] ])
+    print ("-" * 87)
+    print ("%d passed, %d failed" % (len(results) - failures, failures))
+
+    f = open(os.path.join(g_work_dir, "results.json"), 'w')
+    json.dump(results, f, indent=2, sort_keys=True)
+    f.close()
+    return results
+
+def main( argv ):
+    global g_jobs, g_clock_checks
+
+    try:
+        opts, args = getopt.getopt( argv[1:], "t:V:j:lh",
+                                    ["testbench=", "variant=", "jobs=", "no-clock-checks",
+                                                    "list", "help"])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(1)
+
+    testbenches = []
+    variants = []
+    list_only = False
+    for opt, arg in opts:
+        if opt in ( "-t", "--testbench" ):
+            testbenches.append(arg)
+        if opt in ( "-V", "--variant" ):
+            variants.append(arg)
+        if opt in ( "-j", "--jobs" ):
+            g_jobs = int(arg)
+        if opt == "--no-clock-checks":
+            g_clock_checks = False
+        if opt in ( "-l", "--list" ):
+            list_only = True
+        if opt in ( "-h", "--help" ):
+            usage()
+            sys.exit(0)
+
+    if not testbenches:
+        testbenches = find_testbenches()
+    if not variants:
+        variants = g_default_variants
+    tests = [ make_test(top, variant) for top in testbenches for variant in variants ]
+
+    if list_only:
+        for test in tests:
+            print ("%-36s %-16s %s" % (test.name, test.config, " ".join(
+                [ "-D%s" % d for d in test.defines ] +
+                [ os.path.relpath(f, g_testbench_dir) for f in test.files ])))
+        sys.exit(0)
+
+    results = regress(tests)
+    sys.exit(0 if all( r["passed"] for r in results ) else 1)
+
+if __name__ == "__main__":
+    main( sys.argv )
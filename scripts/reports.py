@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+## **************************************************************************
+##   reports.py - parse the reports written by the Xilinx cpld/fpga tools
+##
+##   COPYRIGHT 2010 Richard Evans, Ed Spittles
+##
+##   reports.py is free software: you can redistribute it and/or modify
+##   it under the terms of the GNU Lesser General Public License as published by
+##   the Free Software Foundation, either version 3 of the License, or
+##   (at your option) any later version.
+##
+##   tube is distributed in the hope that it will be useful,
+##   but WITHOUT ANY WARRANTY; without even the implied warranty of
+##   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##   GNU Lesser General Public License for more details.
+##
+##   You should have received a copy of the GNU Lesser General Public License
+##   along with tube.  If not, see <http://www.gnu.org/licenses/>.
+##
+## **************************************************************************
+"""
+reports.py
+
+     Parsers for the report files left in a build.py working directory, and a
+     metrics store holding a summary record for every build.
+
+"""
+
+from __future__ import print_function
+
+import collections, getopt, json, os.path, re, sys
+
+# Resource usage is held as a (used, total) pair
+FitReport = collections.namedtuple("FitReport",
+    ["fitted", "device", "macrocells", "pterms", "fb_inputs", "registers", "pins"])
+
+# Order of the columns in the cpldfit 'Resource Summary' table
+FIT_RESOURCES = ("macrocells", "pterms", "fb_inputs", "registers", "pins")
+
+# xst .syr: run times and, for FPGAs, estimated LUT usage and timing
+SynthesisReport = collections.namedtuple("SynthesisReport",
+    ["seconds", "cpu_seconds", "luts", "min_period", "fmax"])
+
+# taengine .tim or trce .twr: worst path delay in ns (worst of all path types
+# for a CPLD), pad to pad delay (CPLD only), minimum clock period in ns and
+# fmax in MHz
+TimingReport = collections.namedtuple("TimingReport",
+    ["worst_delay", "pad_to_pad", "min_period", "fmax"])
+
+re_used_total = re.compile(r"(\d+)\s*/\s*(\d+)\s*\(\s*\d+%\)")
+re_fit_status = re.compile(r"Fitting Status:\s*(\w+)")
+re_device = re.compile(r"Device Used:\s*(\S+)")
+re_xst_real_time = re.compile(r"Total REAL time to Xst completion:\s*([\d.]+)\s*secs")
+re_xst_cpu_time = re.compile(r"Total CPU time to Xst completion:\s*([\d.]+)\s*secs")
+re_luts = re.compile(r"Number of (?:Slice LUTs|4 input LUTs):\s*([\d,]+)\s*out of\s*([\d,]+)")
+re_min_period = re.compile(r"Minimum (?:clock )?period:\s*([\d.]+)\s*ns", re.I)
+re_fmax = re.compile(r"Maximum (?:Frequency|Internal Clock Speed):\s*([\d.]+)\s*MHz", re.I)
+re_cpld_path = re.compile(r"^(.*\(t[A-Z]+\))\s*:\s*([\d.]+)\s*ns", re.M)
+re_pad_to_pad = re.compile(r"Pad to Pad \(tPD\)\s*:\s*([\d.]+)\s*ns")
+re_max_path = re.compile(r"Maximum (?:path|combinational path) delay[^:]*:\s*([\d.]+)\s*ns", re.I)
+
+
+def read_report( filename ):
+    """
+    Return the contents of a report file, or "" if it doesn't exist.
+    """
+    if not os.path.isfile(filename):
+        return ""
+    f = open(filename, 'r')
+    text = f.read()
+    f.close()
+    return text
+
+def parse_fitter_report( filename ):
+    """
+    Parse a cpldfit .rpt file and return a FitReport, or None if the fitter
+    didn't get as far as writing a report.
+    """
+    text = read_report(filename)
+    if text == "":
+        return None
+
+    m = re_fit_status.search(text)
+    fitted = m is not None and m.group(1).lower() == "successful"
+    m = re_device.search(text)
+    device = m.group(1) if m else ""
+
+    usage = dict( (r, None) for r in FIT_RESOURCES )
+    for line in text.splitlines():
+        fields = re_used_total.findall(line)
+        if len(fields) == len(FIT_RESOURCES):
+            for (name, (used, total)) in zip(FIT_RESOURCES, fields):
+                usage[name] = (int(used), int(total))
+            break
+    return FitReport(fitted=fitted, device=device, **usage)
+
+def first_float( regexp, text ):
+    """
+    Return the first group of the first match of regexp in text as a float, or None.
+    """
+    m = regexp.search(text)
+    if m is None:
+        return None
+    return float(m.group(1).replace(",", ""))
+
+def parse_synthesis_report( filename ):
+    """
+    Parse an xst .syr file and return a SynthesisReport, or None if there isn't one.
+    """
+    text = read_report(filename)
+    if text == "":
+        return None
+    m = re_luts.search(text)
+    luts = None
+    if m is not None:
+        luts = ( int(m.group(1).replace(",", "")), int(m.group(2).replace(",", "")) )
+    return SynthesisReport(seconds=first_float(re_xst_real_time, text),
+                           cpu_seconds=first_float(re_xst_cpu_time, text),
+                           luts=luts,
+                           min_period=first_float(re_min_period, text),
+                           fmax=first_float(re_fmax, text))
+
+def parse_map_luts( filename ):
+    """
+    Return the (used, total) LUT usage from an FPGA map .mrp report, or None.
+    """
+    m = re_luts.search(read_report(filename))
+    if m is None:
+        return None
+    return ( int(m.group(1).replace(",", "")), int(m.group(2).replace(",", "")) )
+
+def parse_timing_report( filename ):
+    """
+    Parse a CPLD taengine .tim or FPGA trce .twr file and return a TimingReport,
+    or None if there isn't one.
+    """
+    text = read_report(filename)
+    if text == "":
+        return None
+    if filename.endswith(".tim"):
+        delays = [ float(d) for (path, d) in re_cpld_path.findall(text) ]
+        worst_delay = max(delays) if delays else None
+    else:
+        worst_delay = first_float(re_max_path, text)
+        if worst_delay is None:
+            worst_delay = first_float(re_min_period, text)
+    return TimingReport(worst_delay=worst_delay,
+                        pad_to_pad=first_float(re_pad_to_pad, text),
+                        min_period=first_float(re_min_period, text),
+                        fmax=first_float(re_fmax, text))
+
+def build_reports( directory, module ):
+    """
+    Parse all of the reports in a build directory and return a dictionary of
+    the synthesis, fit (CPLD), luts (FPGA) and timing records, any of which may
+    be None.
+    """
+    path = lambda ext: os.path.join(directory, "%s%s" % (module, ext))
+    if os.path.isfile(path(".twr")):
+        timing = parse_timing_report(path(".twr"))
+    else:
+        timing = parse_timing_report(path(".tim"))
+    return { "synthesis" : parse_synthesis_report(path(".syr")),
+             "fit"       : parse_fitter_report(path(".rpt")),
+             "luts"      : parse_map_luts(path("_map.mrp")),
+             "timing"    : timing }
+
+def record_to_json( record ):
+    """
+    Convert a report record to something json can store.
+    """
+    if record is None:
+        return None
+    return dict(record._asdict())
+
+def append_metrics( filename, entry ):
+    """
+    Append one build's metrics, a dictionary, as a single line of the JSONL
+    metrics store.
+    """
+    f = open(filename, 'a')
+    f.write(json.dumps(entry, sort_keys=True) + "\n")
+    f.close()
+
+def read_metrics( filename, module="", target="" ):
+    """
+    Return the list of metrics entries from the store for the given module and
+    target ("" matches anything), oldest first.
+    """
+    entries = []
+    if not os.path.isfile(filename):
+        return entries
+    f = open(filename, 'r')
+    for line in f:
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            continue
+        if module not in ("", entry.get("module")) or target not in ("", entry.get("target")):
+            continue
+        entries.append(entry)
+    f.close()
+    return entries
+
+def format_usage( resource ):
+    """
+    Format a (used, total) pair for a summary table.
+    """
+    if resource is None:
+        return "-"
+    return "%d/%d" % tuple(resource)
+
+def format_value( value, fmt="%.1f" ):
+    if value is None:
+        return "-"
+    return fmt % value
+
+def usage() :
+    print (__doc__ + """
+  USAGE:
+
+    reports.py [-m|--module <module>] [-t|--target <target>] <metrics file>
+
+    - print the trend of build time, resource usage and timing for every build
+      recorded in a metrics file written by build.py, optionally only for one
+      module and/or target.
+    """)
+
+def main( argv ):
+    try:
+        opts, args = getopt.getopt( argv[1:], "m:t:h", ["module=", "target=", "help"])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(1)
+    module = ""
+    target = ""
+    for opt, arg in opts:
+        if opt in ( "-m", "--module" ):
+            module = arg
+        if opt in ( "-t", "--target" ):
+            target = arg.lower()
+        if opt in ( "-h", "--help" ):
+            usage()
+            sys.exit(0)
+    if len(args) != 1:
+        usage()
+        sys.exit(1)
+
+    print ("%-19s %-12s %-16s %-18s %-6s %8s %-10s %-10s %-10s %8s %8s" % \
+        ("Date", "Commit", "Module", "Target", "Result", "Time(s)", "Macrocells",
+         "Pterms", "LUTs", "Worst ns", "Fmax"))
+    print ("-" * 132)
+    for entry in read_metrics(args[0], module, target):
+        fit = entry.get("fit") or {}
+        timing = entry.get("timing") or {}
+        total = sum( s["seconds"] for s in entry.get("steps", []) )
+        print ("%-19s %-12s %-16s %-18s %-6s %8.1f %-10s %-10s %-10s %8s %8s" % \
+            (entry.get("date", ""), entry.get("commit", "")[:12], entry.get("module", ""),
+             entry.get("target", ""), "PASS" if entry.get("ok") else "FAIL", total,
+             format_usage(fit.get("macrocells")), format_usage(fit.get("pterms")),
+             format_usage(entry.get("luts")), format_value(timing.get("worst_delay")),
+             format_value(timing.get("fmax"))))
+
+if __name__ == "__main__":
+    main( sys.argv )
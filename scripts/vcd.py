@@ -0,0 +1,412 @@
+#!/usr/bin/env python
+## **************************************************************************
+##   vcd.py - streaming VCD reader and clock timing checks
+##
+##   COPYRIGHT 2010 Richard Evans, Ed Spittles
+##
+##   vcd.py is free software: you can redistribute it and/or modify
+##   it under the terms of the GNU Lesser General Public License as published by
+##   the Free Software Foundation, either version 3 of the License, or
+##   (at your option) any later version.
+##
+##   tube is distributed in the hope that it will be useful,
+##   but WITHOUT ANY WARRANTY; without even the implied warranty of
+##   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##   GNU Lesser General Public License for more details.
+##
+##   You should have received a copy of the GNU Lesser General Public License
+##   along with tube.  If not, see <http://www.gnu.org/licenses/>.
+##
+## **************************************************************************
+"""
+vcd.py
+
+     Read a VCD dump a line at a time, keeping only the transitions of the
+     signals asked for, and check clock pulse widths, glitches at clock
+     handover and edge alignment without opening gtkwave.
+
+"""
+
+from __future__ import print_function
+
+import array, collections, getopt, re, sys
+
+import numpy
+
+# Scalar values are held as 0 or 1, with X and Z (and any vector containing
+# them) held as UNKNOWN
+UNKNOWN = -1
+
+# One failed check, at a time in ns
+Violation = collections.namedtuple("Violation", ["check", "time", "message"])
+
+TIMESCALE_NS = { "s": 1e9, "ms": 1e6, "us": 1e3, "ns": 1.0, "ps": 1e-3, "fs": 1e-6 }
+
+re_timescale = re.compile(r"(\d+)\s*(s|ms|us|ns|ps|fs)")
+
+
+class Trace(object):
+    """
+    The transitions of one signal: times, in ticks of the dump's timescale,
+    and the value from each time on, both as numpy arrays.
+    """
+    def __init__( self, name, width, times, values ):
+        self.name = name
+        self.width = width
+        self.times = times
+        self.values = values
+
+    def value_at( self, times ):
+        """
+        Return the values at the given times (UNKNOWN before the first change).
+        """
+        idx = numpy.searchsorted(self.times, times, side='right') - 1
+        return numpy.where(idx >= 0, self.values[numpy.maximum(idx, 0)], UNKNOWN)
+
+    def edges( self, edge="posedge" ):
+        """
+        Return the times of the posedge or negedge transitions, ignoring
+        transitions to or from X/Z.
+        """
+        before = self.values[:-1]
+        after = self.values[1:]
+        if edge == "posedge":
+            hit = (before == 0) & (after == 1)
+        else:
+            hit = (before == 1) & (after == 0)
+        return self.times[1:][hit]
+
+    def changes( self ):
+        """
+        Return the times at which the value changes, after the initial value.
+        """
+        return self.times[1:][self.values[1:] != self.values[:-1]]
+
+    def pulses( self, level ):
+        """
+        Return (starts, widths) of every complete pulse at the given level,
+        including zero width pulses from two changes at the same time.
+        """
+        starts = numpy.nonzero(self.values[:-1] == level)[0]
+        return (self.times[starts], self.times[starts + 1] - self.times[starts])
+
+
+class Dump(object):
+    """
+    The traces read from a VCD file, by full hierarchical name, and the
+    timescale as ns per tick.
+    """
+    def __init__( self, tick_ns, end_time, traces ):
+        self.tick_ns = tick_ns
+        self.end_time = end_time
+        self.traces = traces
+
+    def ticks( self, ns ):
+        return int(round(ns / self.tick_ns))
+
+    def ns( self, ticks ):
+        return float(ticks) * self.tick_ns
+
+    def trace( self, name ):
+        """
+        Return the trace for a signal named in full or by a trailing part of
+        its hierarchy, or None.
+        """
+        if name in self.traces:
+            return self.traces[name]
+        for (full, trace) in sorted(self.traces.items()):
+            if match_signal(full, [ name ]):
+                return trace
+        return None
+
+
+def match_signal( name, patterns ):
+    """
+    Return True if a hierarchical signal name is one of the patterns, either in
+    full or as a trailing part of the hierarchy (eg 'dut0_u.hs_selected_w').
+    """
+    for p in patterns:
+        if name == p or name.endswith("." + p):
+            return True
+    return False
+
+def parse_value( text ):
+    """
+    Return the integer value of a VCD scalar or vector value, or UNKNOWN.
+    """
+    try:
+        return int(text, 2)
+    except ValueError:
+        return UNKNOWN
+
+def read_vcd( filename, signals ):
+    """
+    Read a VCD file and return a Dump holding traces for the signals whose
+    names match, as for match_signal(). The file is read a line at a time and
+    changes to other signals are skipped, so memory use depends only on the
+    number of transitions kept.
+    """
+    f = open(filename, 'r')
+
+    # Header: timescale and the variable declarations
+    tick_ns = 1.0
+    scope = []
+    codes = dict()          # id code -> list of (name, width)
+    keyword = None
+    body = []
+    for line in f:
+        tokens = line.split()
+        if not tokens:
+            continue
+        if keyword is None:
+            if not tokens[0].startswith("$"):
+                continue
+            keyword = tokens[0]
+            tokens = tokens[1:]
+        if "$end" in tokens:
+            body.extend(tokens[:tokens.index("$end")])
+            if keyword == "$timescale":
+                m = re_timescale.search(" ".join(body))
+                if m:
+                    tick_ns = int(m.group(1)) * TIMESCALE_NS[m.group(2)]
+            elif keyword == "$scope":
+                scope.append(body[1])
+            elif keyword == "$upscope":
+                scope.pop()
+            elif keyword == "$var":
+                name = ".".join(scope + [ body[3] ])
+                if match_signal(name, signals):
+                    codes.setdefault(body[2], []).append((name, int(body[1])))
+            elif keyword == "$enddefinitions":
+                break
+            keyword = None
+            body = []
+        else:
+            body.extend(tokens)
+
+    # Body: value changes, only kept for the signals asked for
+    times = dict( (code, array.array('q')) for code in codes )
+    values = dict( (code, array.array('q')) for code in codes )
+    now = 0
+    vector = None
+    comment = False
+    for line in f:
+        for token in line.split():
+            if comment:
+                comment = token != "$end"
+                continue
+            if vector is not None:
+                # Identifier code following a vector or real value
+                if token in codes:
+                    times[token].append(now)
+                    values[token].append(parse_value(vector))
+                vector = None
+                continue
+            c = token[0]
+            if c == '#':
+                now = int(token[1:])
+            elif c in "01xzXZ":
+                code = token[1:]
+                if code in codes:
+                    times[code].append(now)
+                    values[code].append(1 if c == '1' else 0 if c == '0' else UNKNOWN)
+            elif c in "bBrR":
+                vector = token[1:] if c in "bB" else "r"
+            elif token == "$comment":
+                comment = True
+    f.close()
+
+    traces = dict()
+    for (code, names) in codes.items():
+        t = numpy.frombuffer(times[code], dtype=numpy.int64).copy()
+        v = numpy.frombuffer(values[code], dtype=numpy.int64).copy()
+        for (name, width) in names:
+            traces[name] = Trace(name, width, t, v)
+    return Dump(tick_ns, now, traces)
+
+def min_pulse( dump, clock, high, low, after=0 ):
+    """
+    Check that every high and low pulse of the clock after time 'after' is at
+    least high/low ns wide.
+    """
+    trace = dump.trace(clock)
+    violations = []
+    for (level, limit) in ((1, high), (0, low)):
+        (starts, widths) = trace.pulses(level)
+        bad = (widths < dump.ticks(limit)) & (starts >= dump.ticks(after))
+        for (start, width) in zip(starts[bad], widths[bad]):
+            violations.append(Violation("min_pulse", dump.ns(start),
+                "%s %s pulse of %.1f ns, minimum is %.1f ns" % \
+                (clock, "high" if level else "low", dump.ns(width), limit)))
+    return violations
+
+def handover_glitch( dump, clock, select, window, width, after=0 ):
+    """
+    Check that there are no clock pulses narrower than width ns, and no X or Z
+    on the clock, within window ns either side of any change of the select
+    signal.
+    """
+    trace = dump.trace(clock)
+    changes = dump.trace(select).changes()
+    changes = changes[changes >= dump.ticks(after)]
+    violations = []
+    if len(changes) == 0:
+        return violations
+
+    def near_change( times ):
+        idx = numpy.searchsorted(changes, times)
+        before = numpy.abs(times - changes[numpy.maximum(idx - 1, 0)])
+        following = numpy.abs(changes[numpy.minimum(idx, len(changes) - 1)] - times)
+        return numpy.minimum(before, following) <= dump.ticks(window)
+
+    for level in (0, 1):
+        (starts, widths) = trace.pulses(level)
+        bad = (widths < dump.ticks(width)) & near_change(starts)
+        for (start, w) in zip(starts[bad], widths[bad]):
+            violations.append(Violation("handover_glitch", dump.ns(start),
+                "%s glitch of %.1f ns %s within %.0f ns of %s changing" % \
+                (clock, dump.ns(w), "high" if level else "low", window, select)))
+    unknown = trace.times[trace.values == UNKNOWN]
+    unknown = unknown[unknown >= dump.ticks(after)]
+    for t in unknown[near_change(unknown)]:
+        violations.append(Violation("handover_glitch", dump.ns(t),
+            "%s goes X/Z within %.0f ns of %s changing" % (clock, window, select)))
+    return violations
+
+def edge_alignment( dump, clock, reference, edge, min_delay, max_delay, when=None, after=0 ):
+    """
+    Check that every clock edge follows the last reference edge of the same
+    kind by between min_delay and max_delay ns. when is an optional (signal,
+    value) pair to only check edges where the signal has that value.
+    """
+    edges = dump.trace(clock).edges(edge)
+    edges = edges[edges >= dump.ticks(after)]
+    if when is not None:
+        edges = edges[dump.trace(when[0]).value_at(edges) == when[1]]
+    ref = dump.trace(reference).edges(edge)
+    idx = numpy.searchsorted(ref, edges, side='right') - 1
+    delay = edges - ref[numpy.maximum(idx, 0)]
+    bad = (idx < 0) | (delay < dump.ticks(min_delay)) | (delay > dump.ticks(max_delay))
+    violations = []
+    for (t, d, i) in zip(edges[bad], delay[bad], idx[bad]):
+        if i < 0:
+            message = "%s %s with no preceding %s %s" % (clock, edge, reference, edge)
+        else:
+            message = "%s %s %.1f ns after %s, expected %.1f to %.1f ns" % \
+                (clock, edge, dump.ns(d), reference, min_delay, max_delay)
+        violations.append(Violation("edge_alignment", dump.ns(t), message))
+    return violations
+
+CHECK_FUNCTIONS = { "min_pulse": min_pulse,
+                    "handover_glitch": handover_glitch,
+                    "edge_alignment": edge_alignment }
+
+# Checks for each testbench top module, as (check, arguments) with times in ns.
+#
+# testbench: hsclk has a 200 ns period so the CPU clock never has a legal
+# phase shorter than 200 ns, and the BBC clock phases are 1000 ns. With the
+# host clock selected, CPU PHI2 follows BBC PHI2 through the CLKDEL_PIPE_SZ
+# (3) stage hsclk delay pipe, plus up to one hsclk period of sampling.
+#
+# clkctrl_tb: hsclk has a 60 ns period, divided by 4 for the fast clock, so a
+# legal phase is at least 120 ns.
+CHECKS = {
+    "testbench": [
+        ("min_pulse", dict(clock="testbench.tb_cpu_ck_phi2_w", high=200, low=200, after=400)),
+        ("handover_glitch", dict(clock="testbench.tb_cpu_ck_phi2_w",
+                                 select="testbench.dut0_u.sel_hs_w",
+                                 window=4000, width=200, after=400)),
+        ("edge_alignment", dict(clock="testbench.tb_cpu_ck_phi2_w",
+                                reference="testbench.bbc_ck2_phi2_w", edge="negedge",
+                                min_delay=0, max_delay=800,
+                                when=("testbench.dut0_u.ls_selected_w", 1), after=400)),
+    ],
+    "clkctrl_tb": [
+        ("min_pulse", dict(clock="clkctrl_tb.clkout", high=120, low=120, after=500)),
+        ("handover_glitch", dict(clock="clkctrl_tb.clkout", select="clkctrl_tb.hienable_r",
+                                 window=2000, width=120, after=500)),
+    ],
+}
+
+def check_signals( checks ):
+    """
+    Return the names of all signals the checks need.
+    """
+    names = set()
+    for (check, args) in checks:
+        for key in ("clock", "select", "reference"):
+            if key in args:
+                names.add(args[key])
+        if args.get("when"):
+            names.add(args["when"][0])
+    return sorted(names)
+
+def run_checks( filename, checks ):
+    """
+    Read a VCD file and run a list of (check, arguments) on it. Returns a list
+    of Violations, including one for any signal missing from the dump.
+    """
+    dump = read_vcd(filename, check_signals(checks))
+    violations = []
+    for (check, args) in checks:
+        missing = [ n for n in check_signals([ (check, args) ]) if dump.trace(n) is None ]
+        if missing:
+            violations.append(Violation(check, 0.0, "signal(s) not in dump: %s" % " ".join(missing)))
+            continue
+        violations.extend(CHECK_FUNCTIONS[check](dump, **args))
+    return sorted(violations, key=lambda v: v.time)
+
+def usage() :
+    print (__doc__ + """
+  USAGE:
+
+    vcd.py [-t|--testbench <top module>] [-s|--signal <name>] ... <vcd file>
+
+    - with -t, run the clock checks for that testbench, printing any
+      violations, and exit with status 1 if there are any. Otherwise
+      print a summary of the transitions and pulse widths of each signal
+      given with -s. Signal names may be given in full or as a trailing
+      part of the hierarchy, eg dut0_u.hs_selected_w.
+
+    Testbenches with checks: %s
+    """ % " ".join(sorted(CHECKS)))
+
+def main( argv ):
+    try:
+        opts, args = getopt.getopt( argv[1:], "t:s:h", ["testbench=", "signal=", "help"])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(1)
+    testbench = ""
+    signals = []
+    for opt, arg in opts:
+        if opt in ( "-t", "--testbench" ):
+            testbench = arg
+        if opt in ( "-s", "--signal" ):
+            signals.append(arg)
+        if opt in ( "-h", "--help" ):
+            usage()
+            sys.exit(0)
+    if len(args) != 1 or (testbench == "" and not signals) or \
+       (testbench != "" and testbench not in CHECKS):
+        usage()
+        sys.exit(1)
+
+    if testbench != "":
+        violations = run_checks(args[0], CHECKS[testbench])
+        for v in violations:
+            print ("FAIL: %12.1f ns %-16s %s" % (v.time, v.check, v.message))
+        print ("%s: %d clock check violations" % ("FAIL" if violations else "PASS", len(violations)))
+        sys.exit(1 if violations else 0)
+
+    dump = read_vcd(args[0], signals)
+    print ("%-48s %5s %10s %10s %10s" % ("Signal", "Width", "Changes", "Min high", "Min low"))
+    print ("-" * 88)
+    for name in sorted(dump.traces):
+        trace = dump.traces[name]
+        widths = [ trace.pulses(level)[1] for level in (1, 0) ]
+        (high, low) = [ "%.1f" % dump.ns(w.min()) if len(w) else "-" for w in widths ]
+        print ("%-48s %5d %10d %10s %10s" % (name, trace.width, len(trace.times), high, low))
+
+if __name__ == "__main__":
+    main( sys.argv )
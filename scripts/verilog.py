@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+## **************************************************************************
+##   verilog.py - lightweight Verilog source scanner
+##
+##   COPYRIGHT 2010 Richard Evans, Ed Spittles
+##
+##   verilog.py is free software: you can redistribute it and/or modify
+##   it under the terms of the GNU Lesser General Public License as published by
+##   the Free Software Foundation, either version 3 of the License, or
+##   (at your option) any later version.
+##
+##   tube is distributed in the hope that it will be useful,
+##   but WITHOUT ANY WARRANTY; without even the implied warranty of
+##   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##   GNU Lesser General Public License for more details.
+##
+##   You should have received a copy of the GNU Lesser General Public License
+##   along with tube.  If not, see <http://www.gnu.org/licenses/>.
+##
+## **************************************************************************
+"""
+verilog.py
+
+     Find the modules defined and instantiated, the files included and the
+     macros referenced in Verilog source files, without a full parse, and
+     work out the set of files needed to build a top level module.
+
+     Sources can also be reduced to a canonical token stream with defines
+     applied, so that edits which can't change the design (comments,
+     layout, disabled `ifdef branches) give the same digest.
+
+"""
+
+from __future__ import print_function
+
+import collections, hashlib, json, os, os.path, re
+
+# Everything found in one source file
+FileScan = collections.namedtuple("FileScan", ["modules", "instances", "includes", "macros"])
+
+re_block_comment = re.compile(r"/\*.*?\*/", re.S)
+re_line_comment = re.compile(r"//[^\n]*")
+re_string = re.compile(r'"(?:[^"\\\n]|\\.)*"')
+re_module = re.compile(r"^\s*(?:module|macromodule|primitive)\s+(\w+)", re.M)
+re_instance = re.compile(r"(?:^|;|\bend\b|\bendcase\b|\bbegin\b|\belse\b)\s*([A-Za-z_]\w*)"
+                         r"(?:\s*#\s*\((?:[^()]|\([^()]*\))*\)\s*|\s+)([A-Za-z_]\w*)\s*"
+                         r"(?:\[[^\]]*\]\s*)?\(")
+re_include = re.compile(r'`include\s+"([^"]+)"')
+re_conditional = re.compile(r"`(?:ifdef|ifndef|elsif)\s+(\w+)")
+re_macro_use = re.compile(r"`(\w+)")
+
+# Tokens for normalize(). A `define takes the rest of the line, with any
+# backslash continuations, as its value.
+re_token = re.compile(r"""
+    (?P<space>\s+)
+  | (?P<comment>//[^\n]*|/\*.*?\*/)
+  | (?P<string>"(?:[^"\\\n]|\\.)*")
+  | (?P<define>`define[ \t]+(?P<name>\w+)(?P<value>(?:[^\n\\]|\\\n|\\.)*))
+  | (?P<directive>`\w+)
+  | (?P<number>(?:\d[\d_]*[ \t]*)?'[sS]?[bBoOdDhH][ \t]*[0-9a-fA-FxXzZ?_]+
+               | \d[\d_]*(?:\.\d[\d_]*)?(?:[eE][+-]?\d+)?)
+  | (?P<ident>[A-Za-z_][\w$]*|\\\S+)
+  | (?P<op><<<|>>>|===|!==|<<|>>|<=|>=|==|!=|&&|\|\||~&|~\||~\^|\^~|\*\*|->|\+:|-:|\S)
+""", re.S | re.X)
+re_directive_name = re.compile(r"[ \t]*(\w+)")
+re_directive_file = re.compile(r'[ \t]*"([^"]+)"')
+
+# Compiler directives, which aren't macro references
+DIRECTIVES = set(["define", "undef", "ifdef", "ifndef", "elsif", "else", "endif", "include",
+                  "timescale", "default_nettype", "resetall", "celldefine", "endcelldefine",
+                  "unconnected_drive", "nounconnected_drive", "line"])
+
+# Words which can be followed by something that looks like an instantiation
+KEYWORDS = set(["module", "macromodule", "primitive", "input", "output", "inout", "wire",
+                "reg", "integer", "real", "time", "parameter", "localparam", "assign",
+                "always", "initial", "if", "else", "for", "while", "repeat", "forever",
+                "case", "casex", "casez", "begin", "end", "task", "function", "return",
+                "posedge", "negedge", "or", "and", "not", "buf", "supply0", "supply1",
+                "tri", "wait", "disable", "genvar", "generate", "signed", "defparam"])
+
+
+def strip_comments( text ):
+    """
+    Remove comments from Verilog source, leaving line breaks in place.
+    """
+    text = re_block_comment.sub(lambda m: "\n" * m.group(0).count("\n"), text)
+    return re_line_comment.sub("", text)
+
+def scan_text( text ):
+    """
+    Scan Verilog source text and return a FileScan. Instances are the names of
+    all modules which look to be instantiated, whichever `ifdef branch they are
+    in, and macros are all macro names referenced by `ifdef/`ifndef/`elsif or
+    used directly.
+    """
+    text = strip_comments(text)
+    includes = re_include.findall(text)
+    macros = set(re_conditional.findall(text))
+    macros.update( m for m in re_macro_use.findall(text) if m not in DIRECTIVES )
+    text = re_string.sub('""', text)
+    # Directive lines would otherwise look like the end of a statement
+    text = re.sub(r"`\w+[^\n]*", ";", text)
+    modules = re_module.findall(text)
+    instances = set( m.group(1) for m in re_instance.finditer(text)
+                     if m.group(1) not in KEYWORDS and m.group(2) not in KEYWORDS )
+    return FileScan(modules=modules, instances=sorted(instances), includes=includes,
+                    macros=sorted(macros))
+
+def canonical_number( text ):
+    """
+    Return a Verilog number literal in one spelling: no whitespace or
+    underscores, lower case, and no redundant leading zeros.
+    """
+    text = re.sub(r"\s+", "", text).replace("_", "").lower()
+    if "'" not in text:
+        return str(int(text)) if text.isdigit() else text
+    (size, value) = text.split("'", 1)
+    if size != "":
+        size = str(int(size))
+    signed = "s" if value.startswith("s") else ""
+    value = value[len(signed):]
+    # A leading x or z extends to the full width, so a zero before one stays
+    digits = re.sub(r"^0+(?=[0-9a-f])", "", value[1:])
+    return "%s'%s%s%s" % (size, signed, value[0], digits)
+
+def normalize( text, macros=None, filename="", include_dirs=(), depth=0 ):
+    """
+    Return the canonical token list for Verilog source text. Comments and
+    whitespace are dropped, `ifdef/`ifndef/`elsif/`else/`endif are evaluated,
+    `include files are expanded in place and macros without arguments are
+    substituted, so that sources which only differ in ways that can't change
+    the design give the same tokens. macros maps names to values (strings)
+    and is updated by any `define or `undef in the text, so pass the same
+    dictionary for files compiled together. Macros with arguments are left
+    in place with their definitions kept in the token list.
+    """
+    if macros is None:
+        macros = dict()
+    if depth > 16:
+        raise ValueError("%s: `include or macro nesting too deep" % filename)
+    tokens = []
+    # One entry per open `ifdef: whether its enclosing text is active, and
+    # whether a branch of it has already been taken
+    stack = []
+    active = True
+    pos = 0
+    while pos < len(text):
+        m = re_token.match(text, pos)
+        pos = m.end()
+        kind = m.lastgroup
+        if kind in ("space", "comment"):
+            continue
+        word = m.group(0)
+        if kind == "directive" and word in ("`ifdef", "`ifndef", "`elsif", "`else", "`endif"):
+            name = None
+            if word in ("`ifdef", "`ifndef", "`elsif"):
+                n = re_directive_name.match(text, pos)
+                if n is None:
+                    raise ValueError("%s: %s without a macro name" % (filename, word))
+                name = n.group(1)
+                pos = n.end()
+            if word in ("`ifdef", "`ifndef"):
+                taken = (name in macros) == (word == "`ifdef")
+                stack.append( (active, taken) )
+                active = active and taken
+            elif not stack:
+                raise ValueError("%s: %s without `ifdef" % (filename, word))
+            elif word == "`endif":
+                (active, taken) = stack.pop()
+            else:
+                (outer, taken) = stack[-1]
+                branch = not taken and (word == "`else" or name in macros)
+                stack[-1] = (outer, taken or branch)
+                active = outer and branch
+            continue
+        if not active:
+            continue
+        if m.group("define"):
+            value = m.group("value").replace("\\\n", "\n")
+            if value.startswith("("):
+                macros.pop(m.group("name"), None)
+                tokens.extend( ["`define", m.group("name")] +
+                               normalize(value, dict(), filename, include_dirs, depth + 1) )
+            else:
+                macros[m.group("name")] = value
+        elif word == "`undef":
+            n = re_directive_name.match(text, pos)
+            if n is not None:
+                macros.pop(n.group(1), None)
+                pos = n.end()
+        elif word == "`include":
+            n = re_directive_file.match(text, pos)
+            path = None
+            if n is not None:
+                pos = n.end()
+                path = resolve_include(n.group(1), filename or ".", include_dirs)
+            if path is None:
+                tokens.append(word)
+                if n is not None:
+                    tokens.append('"%s"' % n.group(1))
+                continue
+            f = open(path, 'rb')
+            included = f.read().decode("latin-1")
+            f.close()
+            tokens.extend( normalize(included, macros, path, include_dirs, depth + 1) )
+        elif kind == "directive" and word[1:] in macros:
+            tokens.extend( normalize(macros[word[1:]], macros, filename, include_dirs, depth + 1) )
+        elif kind == "number":
+            tokens.append( canonical_number(word) )
+        else:
+            tokens.append(word)
+    if stack:
+        raise ValueError("%s: `ifdef without `endif" % filename)
+    return tokens
+
+def normalized_digest( filenames, defines=None, include_dirs=() ):
+    """
+    Return the SHA1 hex digest of the normalized tokens of the source files,
+    compiled in the given order with the defines (a dictionary of name to
+    value) set at the start.
+    """
+    macros = dict(defines or {})
+    h = hashlib.sha1()
+    for filename in filenames:
+        f = open(filename, 'rb')
+        text = f.read().decode("latin-1")
+        f.close()
+        h.update(("\0".join(normalize(text, macros, filename, include_dirs)) + "\n").encode("utf-8"))
+    return h.hexdigest()
+
+def scan_file( filename ):
+    f = open(filename, 'r')
+    text = f.read()
+    f.close()
+    return scan_text(text)
+
+class ScanCache(object):
+    """
+    Scan results for a set of files, kept in a JSON file between runs. A file
+    is only scanned again if its size or mtime has changed and then only if
+    its contents have too.
+    """
+    def __init__( self, filename ):
+        self.filename = filename
+        self.entries = dict()
+        self.changed = False
+        if os.path.isfile(filename):
+            try:
+                f = open(filename, 'r')
+                self.entries = json.load(f)
+                f.close()
+            except ValueError:
+                self.entries = dict()
+
+    def scan( self, filename ):
+        path = os.path.abspath(filename)
+        st = os.stat(path)
+        entry = self.entries.get(path)
+        if entry is not None and entry["mtime"] == st.st_mtime and entry["size"] == st.st_size:
+            return FileScan(**entry["scan"])
+        f = open(path, 'rb')
+        data = f.read()
+        f.close()
+        digest = hashlib.sha1(data).hexdigest()
+        if entry is not None and entry["sha1"] == digest:
+            result = FileScan(**entry["scan"])
+        else:
+            result = scan_text(data.decode("latin-1"))
+        self.entries[path] = { "mtime": st.st_mtime, "size": st.st_size, "sha1": digest,
+                               "scan": dict(result._asdict()) }
+        self.changed = True
+        return result
+
+    def save( self ):
+        if not self.changed:
+            return
+        f = open(self.filename, 'w')
+        json.dump(self.entries, f, indent=1, sort_keys=True)
+        f.close()
+        self.changed = False
+
+def resolve_include( name, filename, include_dirs=() ):
+    """
+    Return the path of an `include file, looking first beside the file which
+    includes it and then in the include directories, or None.
+    """
+    for d in [ os.path.dirname(os.path.abspath(filename)) ] + list(include_dirs):
+        path = os.path.join(d, name)
+        if os.path.isfile(path):
+            return os.path.abspath(path)
+    return None
+
+def hierarchy( top, filenames, include_dirs=(), scan=scan_file ):
+    """
+    Return (files, includes, missing) for the module top: the source files
+    needed to build it, breadth first from the top, the files they
+    `include, and the names of instantiated modules not defined in any of
+    the candidate filenames. scan is used to scan each file.
+    """
+    scans = dict( (os.path.abspath(f), scan(f)) for f in filenames )
+    defined = dict()
+    for (filename, s) in sorted(scans.items()):
+        for module in s.modules:
+            defined.setdefault(module, filename)
+    if top not in defined:
+        return ([], [], set([top]))
+
+    files = []
+    includes = []
+    missing = set()
+    queue = [ top ]
+    seen = set(queue)
+    while queue:
+        module = queue.pop(0)
+        filename = defined[module]
+        if filename not in files:
+            files.append(filename)
+            for name in scans[filename].includes:
+                path = resolve_include(name, filename, include_dirs)
+                if path is not None and path not in includes:
+                    includes.append(path)
+        for instance in scans[filename].instances:
+            if instance in seen:
+                continue
+            seen.add(instance)
+            if instance in defined:
+                queue.append(instance)
+            else:
+                missing.add(instance)
+    return (files, includes, missing)